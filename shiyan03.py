@@ -1,10 +1,46 @@
 import zipfile
 import os
+import io
 import re
+import bisect
+import csv
+import html
+import math
+import time
+import tempfile
+import shutil
+import glob
+import sys
+import json
+import pickle
+import zlib
+import struct
+import heapq
+import mmap
+import itertools
+import functools
+import threading
+import multiprocessing
+import multiprocessing.connection
+import socket
+import subprocess
+import argparse
+from array import array
 from collections import defaultdict
+from datetime import datetime, timedelta, timezone
+from email import message_from_bytes, policy as email_policy
+from email.parser import Parser
+from email.utils import parsedate_to_datetime
 import numpy as np
 import streamlit as st
 import pandas as pd
+from streamlit.runtime.scriptrunner import get_script_run_ctx
+try:
+    import pyarrow as pa
+    import pyarrow.ipc
+    import pyarrow.parquet as pq
+except ImportError:  # 未安装 pyarrow 时不提供 Arrow/Parquet 导出
+    pa = None
 
 # 停用词列表
 STOP_WORDS = set([
@@ -31,39 +67,671 @@ STOP_WORDS = set([
     'can', 'will', 'just', 'don', 'should', 'now'
 ])
 
+# 读取邮件时按 MIME 结构解析（解码字符集、只索引文本正文、跳过附件）
+MIME_AWARE_PARSING = os.environ.get('MIME_AWARE_PARSING', '1') == '1'
+
+# 建立索引时保留的邮件头
+EMAIL_HEADER_NAMES = ['From', 'To', 'Cc', 'Subject', 'Date']
+
+# 邮箱地址（字段索引中作为完整词项保存）
+EMAIL_ADDRESS_PATTERN = re.compile(r'[\w.+-]+@[\w-]+(?:\.[\w-]+)+')
+
+# mbox 文件中邮件之间的分隔行，以及邮件路径中 mbox 文件名与邮件起始字节偏移之间的分隔符（如 archive.mbox#1024）
+MBOX_SEPARATOR = b'\nFrom '
+MBOX_OFFSET_SEPARATOR = '#'
+MBOX_RELEASE_BYTES = 16 * 1024 * 1024  # 每读完这么多字节，释放 mbox 内存映射中已读部分占用的物理内存
+
+# 词项最大长度，超过的视为编码残留（如 base64 片段）而不进入索引
+MAX_TOKEN_LENGTH = int(os.environ.get('MAX_TOKEN_LENGTH', 40))
+
+# 中日韩文字分析：没有空格分词的连续中日韩文字切成重叠的二元组（bigram 分析，设为 off 时按普通词处理）
+# 开启 CJK_UNIGRAMS 时每个字也作为一元词项建立索引，可以检索单字
+CJK_ANALYZER = os.environ.get('CJK_ANALYZER', 'bigram')
+CJK_UNIGRAMS = os.environ.get('CJK_UNIGRAMS', '0') == '1'
+CJK_RUN_PATTERN = re.compile(r'[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\uac00-\ud7af]+')
+
+# 词干提取（本地实现的 Porter 算法）：开启后建索引和查询时都把词项归并为词干，词干缓存最多保存 STEM_CACHE_SIZE 个词形
+ENABLE_STEMMING = os.environ.get('ENABLE_STEMMING', '0') == '1'
+STEM_CACHE_SIZE = int(os.environ.get('STEM_CACHE_SIZE', 65536))
+
+# 会话空闲超时时间（秒），超时会话的查询和结果会被回收
+SESSION_IDLE_TIMEOUT = int(os.environ.get('SESSION_IDLE_TIMEOUT', 30 * 60))
+
+# 检索结果分页：可选的每页条数及默认值
+PAGE_SIZE_OPTIONS = [10, 20, 50, 100, 200]
+DEFAULT_PAGE_SIZE = int(os.environ.get('DEFAULT_PAGE_SIZE', 20))
+
+# 结果摘要：最多窗口数、每个窗口的词项数、窗口前保留的上下文词项数，以及无命中时显示的字符数
+SNIPPET_MAX_WINDOWS = 3
+SNIPPET_WINDOW_TOKENS = 12
+SNIPPET_CONTEXT_TOKENS = 3
+SNIPPET_FALLBACK_CHARS = 300
+
+# 是否启用位置索引（短语查询和 NEAR/k 邻近查询依赖位置索引，首次使用时构建）
+ENABLE_POSITIONAL_INDEX = os.environ.get('ENABLE_POSITIONAL_INDEX', '1') == '1'
+
+# 通配符查询：k-gram 索引的 k 值，以及每个通配符最多展开的词项数（超过时查询失败，提示输入更具体的模式）
+WILDCARD_KGRAM_SIZE = 2
+WILDCARD_MAX_EXPANSIONS = int(os.environ.get('WILDCARD_MAX_EXPANSIONS', 50))
+
+# 拼写校正：最大编辑距离，以及生成删除变体时只取词项的前若干个字符
+SPELL_MAX_EDIT_DISTANCE = 2
+SPELL_PREFIX_LENGTH = 7
+
+# 近似重复检测：off 关闭；collapse 检索页面提供折叠重复结果的开关（默认不折叠）；skip 建索引时跳过重复邮件
+DEDUP_MODE = os.environ.get('DEDUP_MODE', 'collapse')
+# MinHash 签名长度、shingle 词项数、分块计算的 shingle 数，LSH 分段数，以及判定为重复的相似度阈值
+MINHASH_NUM_PERM = 128
+SHINGLE_SIZE = 3
+MINHASH_CHUNK_SIZE = 65536
+MINHASH_BANDS = 16
+DUPLICATE_THRESHOLD = float(os.environ.get('DUPLICATE_THRESHOLD', 0.8))
+
+# Roaring 压缩位图：文档ID按高 16 位分块，每块不超过 ROARING_ARRAY_MAX 个文档时用有序数组，否则用 65536 位的位图，
+# 连续区间较多时用行程（起点, 长度-1）编码，取三者中占用最小的一种
+ROARING_CHUNK_BITS = 16
+ROARING_ARRAY_MAX = 4096
+ROARING_BITMAP_BYTES = (1 << ROARING_CHUNK_BITS) // 8
+
+# 分片并行检索：工作进程数（小于 2 时不启用），分片排序检索合并后保留的结果数，
+# 等待分片回复的最长时间（秒，超时或工作进程退出时重新启动该分片），以及等待分片启动并建好索引的最长时间（秒）
+NUM_SHARDS = int(os.environ.get('NUM_SHARDS', 0))
+RANKED_TOP_K = int(os.environ.get('RANKED_TOP_K', 1000))
+SHARD_REPLY_TIMEOUT = float(os.environ.get('SHARD_REPLY_TIMEOUT', 60))
+SHARD_START_TIMEOUT = float(os.environ.get('SHARD_START_TIMEOUT', 600))
+
+# 外存索引构建（SPIMI）：内存中倒排表的估算占用上限（字节），超过后排序写出一个临时分段
+SPIMI_MEMORY_BUDGET = int(os.environ.get('SPIMI_MEMORY_BUDGET', 256 * 1024 * 1024))
+SPIMI_TERM_OVERHEAD = 120  # 每个词项在内存词典中的估算开销（字节），每个倒排项按 4 字节计
+SPIMI_SEGMENT_SUFFIX = '.spimi'  # 外存索引目录放在解压目录旁边
+SPIMI_FLUSH_BATCH = 1 << 18  # 写出临时分段时每批编码的倒排项数
+
+# 分面统计：分面名称及显示标签；每个分面只为文档数最多的 FACET_MAX_VALUES 个取值建立位图
+FACET_NAMES = {'folder': '文件夹', 'sender_domain': '发件人域名', 'month': '月份'}
+FACET_MAX_VALUES = int(os.environ.get('FACET_MAX_VALUES', 50))
+
+# 量化排序索引：每个倒排项的影响分数（按文档向量长度归一化的 tf-idf 权重）存为 8 位有符号整数
+# 缩放系数按词项（term）或全局（global）计算；查询词权重量化为 IMPACT_QUERY_BITS 位整数，打分只做整数累加
+IMPACT_SCALE = os.environ.get('IMPACT_SCALE', 'term')
+IMPACT_QUERY_BITS = 16
+
+# 相似邮件（more like this）：随机超平面 LSH 的签名表数、每表位数上限、目标桶大小、
+# 多探针查找的汉明半径（查找与签名相差不超过这么多位的桶），以及返回的相似邮件数
+LSH_NUM_TABLES = int(os.environ.get('LSH_NUM_TABLES', 16))
+LSH_MAX_BITS = 16
+LSH_BUCKET_SIZE = int(os.environ.get('LSH_BUCKET_SIZE', 64))
+LSH_PROBE_RADIUS = int(os.environ.get('LSH_PROBE_RADIUS', 2))
+MLT_TOP_K = int(os.environ.get('MLT_TOP_K', 20))
+
+# 检索评价：P@k 和 nDCG@k 的截断位置
+EVAL_CUTOFF = int(os.environ.get('EVAL_CUTOFF', 10))
+# 可评价的检索方式（命令行参数名: (显示名称, 计时前预先构建的索引按需部分)），以及默认评价的检索方式
+# 文档关联矩阵是稠密的 词项数 × 邮件数 矩阵，默认不评价，估算大小超过 EVAL_MATRIX_MAX_BYTES 时不能参与评价
+EVAL_ENGINES = {
+    'matrix': ("布尔检索（文档关联矩阵）", ['term_doc_matrix']),
+    'inverted': ("布尔检索（倒排索引）", []),
+    'roaring': ("布尔检索（Roaring）", ['roaring_index']),
+    'ranked': ("排序检索", ['tf_idf_index']),
+    'quantized': ("排序检索（8 位量化）", ['impact_index']),
+}
+EVAL_DEFAULT_ENGINES = ['inverted', 'roaring', 'ranked', 'quantized']
+EVAL_MATRIX_MAX_BYTES = int(os.environ.get('EVAL_MATRIX_MAX_BYTES', 256 * 1024 ** 2))
+
+# 命名数据集：数据集名称到解压目录的目录文件；每个数据集的索引快照保存在解压目录旁边（如 data.index.pkl），
+# 进程中最近使用的索引常驻内存，总大小超过 INDEX_MEMORY_BUDGET 时淘汰最久未使用的，再次使用时从磁盘读回
+COLLECTIONS_FILE = os.environ.get('COLLECTIONS_FILE', 'collections.json')
+INDEX_FILE_SUFFIX = '.index.pkl'
+# 索引快照文件只保存紧凑的检索结构（稀疏倒排表、位置索引、k-gram 索引、分面等）：邮件内容读回时从数据集目录重新读取，
+# 稠密的文档关联矩阵和分片工作进程不保存，需要时再构建；文件开头的头部记录格式版本、读回后的估算内存，
+# 以及建索引时的分析设置（index_settings），当前设置不同时快照中的词项与查询分析不一致，需要重新构建
+INDEX_FILE_FORMAT = 2
+INDEX_FILE_EXCLUDED_PARTS = ['term_doc_matrix', 'sharded_index']
+INDEX_MEMORY_BUDGET = int(os.environ.get('INDEX_MEMORY_BUDGET', 2 * 1024 ** 3))
+
+# 后台构建索引：每分析多少封邮件汇报一次进度，以及切换到新索引前预先构建的检索结构
+# 构建时并行分词的工作进程数（小于 2 时不启用，命令行离线构建时可用 --workers 指定）
+INDEX_BUILD_REPORT_INTERVAL = 1000
+INDEX_BUILD_WORKERS = int(os.environ.get('INDEX_BUILD_WORKERS', 0))
+PREBUILT_INDEX_PARTS = [name for name in os.environ.get('PREBUILT_INDEX_PARTS', 'tf_idf_index,positional_index,wildcard_index,facet_index').split(',')
+                        if name and (name != 'positional_index' or ENABLE_POSITIONAL_INDEX)]
+
+# 导出检索结果 CSV 时每批写入的行数
+CSV_EXPORT_CHUNK_SIZE = 10000
+
 # 解压 ZIP 文件
 def unzip_dataset(zip_file_path, extract_to_dir):
     with zipfile.ZipFile(zip_file_path, 'r') as zip_ref:
         zip_ref.extractall(extract_to_dir)
 
-# 读取邮件内容
-def read_emails_from_directory(directory):
-    emails = []
-    email_paths = []
+# 去除 HTML 标签（含 script/style 内容）并还原字符实体
+def strip_html(text):
+    text = re.sub(r'<(script|style)\b.*?</\1\s*>', ' ', text, flags=re.IGNORECASE | re.DOTALL)
+    text = re.sub(r'<!--.*?-->|<[^>]+>', ' ', text, flags=re.DOTALL)
+    return html.unescape(text)
+
+# 按声明的字符集解码邮件正文部分，字符集无效时退回 UTF-8
+def decode_email_part(part):
+    if part.get_content_charset() is None:
+        # 未声明字符集的 8bit 正文（常见于中文邮件）按 UTF-8 解码，而不是按 ASCII 解码成替换字符
+        return (part.get_payload(decode=True) or b'').decode('utf-8', errors='replace')
+    try:
+        return part.get_content()
+    except (LookupError, UnicodeError, AssertionError):
+        payload = part.get_payload(decode=True) or b''
+        return payload.decode('utf-8', errors='replace')
+
+# 解析邮件：保留主要邮件头，只索引文本正文（HTML 去标签），跳过附件和二进制部分
+def parse_email_bytes(raw):
+    message = message_from_bytes(raw, policy=email_policy.default)
+    if not any(message.get(name) for name in EMAIL_HEADER_NAMES + ['Message-ID', 'MIME-Version', 'Content-Type']):
+        # 没有邮件头的普通文本文件
+        return raw.decode('utf-8', errors='ignore')
+
+    lines = [f"{name}: {message.get(name)}" for name in EMAIL_HEADER_NAMES if message.get(name)]
+    bodies = []
+    for part in message.walk():
+        if part.is_multipart() or part.get_content_maintype() != 'text' or part.is_attachment():
+            continue
+        text = decode_email_part(part)
+        bodies.append(strip_html(text) if part.get_content_subtype() == 'html' else text)
+    return "\n".join(lines) + "\n\n" + "\n\n".join(bodies)
+
+# 解码一封邮件的原始字节
+def decode_email_bytes(raw, mime_aware=MIME_AWARE_PARSING):
+    if mime_aware:
+        return parse_email_bytes(raw)
+    return raw.decode('utf-8', errors='ignore').replace('\r\n', '\n').replace('\r', '\n')
+
+# 判断文件是否为 mbox 格式（以 "From " 分隔行开头）
+def is_mbox_file(file_path):
+    with open(file_path, 'rb') as f:
+        return f.read(5) == b'From '
+
+# 取出 mbox 中从 start 开始的一封邮件：去掉 "From " 分隔行并还原正文中被转义的 ">From "，返回 (邮件原始字节, 下一封邮件的起始偏移)
+def mbox_message_at(mm, start):
+    end = mm.find(MBOX_SEPARATOR, start)
+    end = len(mm) if end < 0 else end + 1
+    line_end = mm.find(b'\n', start, end)
+    raw = mm[line_end + 1:end] if line_end >= 0 else b''
+    return re.sub(rb'(?m)^>(>*From )', rb'\1', raw), end
+
+# 逐封切分 mbox 文件，生成 (起始字节偏移, 邮件原始字节)；文件以内存映射方式读取，内存占用只与单封邮件的大小有关
+def iter_mbox_messages(file_path):
+    with open(file_path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            start = released = 0
+            while start < len(mm):
+                raw, end = mbox_message_at(mm, start)
+                yield start, raw
+                start = end
+                if hasattr(mmap, 'MADV_DONTNEED') and start - released >= MBOX_RELEASE_BYTES:
+                    release_end = start - start % mmap.PAGESIZE
+                    mm.madvise(mmap.MADV_DONTNEED, released, release_end - released)
+                    released = release_end
+
+# 逐封读取目录中的邮件，生成 (路径, 内容)，不一次性把整个邮件库读入内存
+# mbox 文件按邮件切分，路径记为 "文件路径#起始字节偏移"；Maildir 的 tmp 目录存放投递中的邮件，不读取
+# 在后台任务中读取时，进度和读取失败的文件记录到 job 中
+def iter_email_files(directory, mime_aware=MIME_AWARE_PARSING, job=None):
     for root, dirs, files in os.walk(directory):
+        if {'cur', 'new', 'tmp'} <= set(dirs):
+            dirs.remove('tmp')
         for file in files:
             file_path = os.path.join(root, file)
             if os.path.isfile(file_path):
+                if job is not None:
+                    report_index_build(job, files_read=job['files_read'] + 1)
                 try:
-                    with open(file_path, 'r', encoding='utf-8', errors='ignore') as f:
-                        emails.append(f.read())
-                        email_paths.append(file_path)
+                    if is_mbox_file(file_path):
+                        for offset, raw in iter_mbox_messages(file_path):
+                            yield f"{file_path}{MBOX_OFFSET_SEPARATOR}{offset}", decode_email_bytes(raw, mime_aware)
+                        continue
+                    with open(file_path, 'rb') as f:
+                        text = decode_email_bytes(f.read(), mime_aware)
                 except Exception as e:
-                    st.warning(f"无法读取文件 {file_path}: {e}")
+                    if job is None:
+                        st.warning(f"无法读取文件 {file_path}: {e}")
+                    else:
+                        job['errors'].append(f"无法读取文件 {file_path}: {e}")
+                    continue
+                yield file_path, text
+
+# 按邮件路径读取一封邮件（mbox 中的邮件按记录的字节偏移定位），用于外存索引的预览
+def read_email_at(email_path, mime_aware=MIME_AWARE_PARSING):
+    file_path, _, offset = email_path.rpartition(MBOX_OFFSET_SEPARATOR)
+    if os.path.isfile(email_path) or not offset.isdigit():
+        with open(email_path, 'rb') as f:
+            return decode_email_bytes(f.read(), mime_aware)
+    with open(file_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        return decode_email_bytes(mbox_message_at(mm, int(offset))[0], mime_aware)
+
+# 读取邮件内容
+def read_emails_from_directory(directory, mime_aware=MIME_AWARE_PARSING, job=None):
+    emails = []
+    email_paths = []
+    for file_path, text in iter_email_files(directory, mime_aware, job):
+        emails.append(text)
+        email_paths.append(file_path)
     return emails, email_paths
 
-# 拼写校正
-def spell_correction(tokens):
-    spell = SpellChecker()
-    return [spell.correction(word) for word in tokens]
+# 生成删除至多 max_distance 个字符后得到的所有字符串（对称删除拼写校正）
+def generate_deletes(word, max_distance):
+    deletes = {word}
+    frontier = {word}
+    for _ in range(max_distance):
+        frontier = {candidate[:i] + candidate[i + 1:] for candidate in frontier for i in range(len(candidate))}
+        deletes |= frontier
+    return deletes
+
+# 受限 Damerau-Levenshtein 编辑距离，超过 max_distance 时提前返回 max_distance + 1
+# 相同的前缀和后缀不影响编辑距离，先去掉；一个串中不出现在另一个串里的字符都至少需要一次编辑，据此先排除明显超限的情况；
+# 动态规划只计算对角线两侧 max_distance 以内的格子（其余格子必然超过上限）
+def edit_distance(source, target, max_distance):
+    limit = max_distance + 1
+    if abs(len(source) - len(target)) > max_distance:
+        return limit
+    start = len(os.path.commonprefix([source, target]))
+    source, target = source[start:], target[start:]
+    end = len(os.path.commonprefix([source[::-1], target[::-1]]))
+    source, target = source[:len(source) - end], target[:len(target) - end]
+    if not source or not target:
+        return min(len(source) + len(target), limit)
+    if sum(char not in target for char in source) > max_distance or sum(char not in source for char in target) > max_distance:
+        return limit
+
+    previous2 = None
+    previous = [min(j, limit) for j in range(len(target) + 1)]
+    for i in range(1, len(source) + 1):
+        current = [limit] * (len(target) + 1)
+        current[0] = min(i, limit)
+        row_min = current[0]
+        char = source[i - 1]
+        for j in range(max(1, i - max_distance), min(len(target), i + max_distance) + 1):
+            distance = previous[j - 1] if char == target[j - 1] else previous[j - 1] + 1
+            distance = min(distance, previous[j] + 1, current[j - 1] + 1)
+            if i > 1 and j > 1 and char == target[j - 2] and source[i - 2] == target[j - 1]:
+                distance = min(distance, previous2[j - 2] + 1)
+            current[j] = distance
+            row_min = min(row_min, distance)
+        if row_min > max_distance:
+            return limit
+        previous2, previous = previous, current
+    return min(previous[-1], limit)
+
+# 由语料自身的词项词典构建对称删除拼写索引：词项前缀的删除变体 -> 词项ID，并记录文档频率
+def build_spelling_index(index, max_distance=SPELL_MAX_EDIT_DISTANCE, prefix_length=SPELL_PREFIX_LENGTH):
+    deletes = defaultdict(list)
+    for term_id, term in enumerate(index['terms']):
+        for delete in generate_deletes(term[:prefix_length], max_distance):
+            deletes[delete].append(term_id)
+    return {
+        'terms': index['terms'],
+        'term_dictionary': index['term_dictionary'],
+        'doc_freqs': np.array([len(index['inverted_index'][term]) for term in index['terms']], dtype=np.int32),
+        'deletes': {delete: tuple(term_ids) for delete, term_ids in deletes.items()},
+        'max_distance': max_distance,
+        'prefix_length': prefix_length,
+    }
+
+# 为单个词项查找最可能的正确拼写：编辑距离最小，其次文档频率最高，再其次按字典序；词典中已有或找不到时返回 None
+# 按删除的字符数从少到多查找删除变体，已找到距离为 d 的词项后不再查找删除超过 d 个字符的变体；
+# 每个候选词项只检查一次，长度差超过当前最小距离的直接跳过，其余计算以当前最小距离为上限的编辑距离
+def suggest_term(spelling_index, word):
+    if word in spelling_index['term_dictionary']:
+        return None
+    terms, doc_freqs, deletes = spelling_index['terms'], spelling_index['doc_freqs'], spelling_index['deletes']
+    prefix = word[:spelling_index['prefix_length']]
+    best, best_key = None, (spelling_index['max_distance'] + 1,)
+    checked = set()
+    frontier = {prefix}
+    for num_deleted in range(spelling_index['max_distance'] + 1):
+        best_distance = min(best_key[0], spelling_index['max_distance'])
+        if num_deleted > best_distance:
+            break
+        if num_deleted:
+            frontier = {candidate[:i] + candidate[i + 1:] for candidate in frontier for i in range(len(candidate))}
+        for delete in frontier:
+            for term_id in deletes.get(delete, ()):
+                if term_id in checked:
+                    continue
+                checked.add(term_id)
+                term = terms[term_id]
+                if abs(len(term) - len(word)) > best_distance:
+                    continue
+                # 词项本身就是输入删除 num_deleted 个字符的结果时，编辑距离恰好为 num_deleted
+                if term == delete and prefix == word:
+                    distance = num_deleted
+                else:
+                    distance = edit_distance(word, term, best_distance)
+                key = (distance, -doc_freqs[term_id], term)
+                if key < best_key:
+                    best, best_key = term, key
+                    best_distance = distance
+    return best
+
+# 查询中可能需要校正的词（操作符 NEAR/k 和字段查询作为整体跳过）
+QUERY_WORD_PATTERN = re.compile(r'NEAR/\d+|(?:from|to|subject|date):\S+|[\w*?]+', re.IGNORECASE)
+
+# 生成“您是不是要找”的建议查询，保留操作符、停用词和通配符；无需校正时返回 None
+# 开启词干提取时词典中是词干，查询词也先提取词干再查找；只采用再次提取词干后不变的建议，保证按建议检索时命中该词项
+def suggest_query(query, spelling_index):
+    def correct(match):
+        word = match.group()
+        if is_wildcard(word) or word.upper() in ['AND', 'OR', 'NOT'] or NEAR_PATTERN.fullmatch(word) \
+                or FIELD_QUERY_PATTERN.fullmatch(word) or word.lower() in STOP_WORDS or has_cjk(word):
+            return word
+        token = normalize_token(word.lower())
+        suggestion = suggest_term(spelling_index, token)
+        return suggestion if suggestion and normalize_token(suggestion) == suggestion else word
+
+    suggestion = QUERY_WORD_PATTERN.sub(correct, query)
+    return suggestion if suggestion != query else None
+
+# Porter 词干提取各步骤的后缀替换表，按后缀长度从长到短匹配（只处理最长匹配的后缀）
+PORTER_STEP2_SUFFIXES = sorted([
+    ('ational', 'ate'), ('tional', 'tion'), ('enci', 'ence'), ('anci', 'ance'), ('izer', 'ize'), ('abli', 'able'),
+    ('alli', 'al'), ('entli', 'ent'), ('eli', 'e'), ('ousli', 'ous'), ('ization', 'ize'), ('ation', 'ate'),
+    ('ator', 'ate'), ('alism', 'al'), ('iveness', 'ive'), ('fulness', 'ful'), ('ousness', 'ous'), ('aliti', 'al'),
+    ('iviti', 'ive'), ('biliti', 'ble'),
+], key=lambda pair: -len(pair[0]))
+PORTER_STEP3_SUFFIXES = sorted([
+    ('icate', 'ic'), ('ative', ''), ('alize', 'al'), ('iciti', 'ic'), ('ical', 'ic'), ('ful', ''), ('ness', ''),
+], key=lambda pair: -len(pair[0]))
+PORTER_STEP4_SUFFIXES = sorted([
+    'al', 'ance', 'ence', 'er', 'ic', 'able', 'ible', 'ant', 'ement', 'ment', 'ent', 'ion', 'ou', 'ism', 'ate', 'iti',
+    'ous', 'ive', 'ize',
+], key=lambda suffix: -len(suffix))
+
+# 判断第 i 个字母是否为辅音（y 前面是辅音时视为元音）
+def porter_is_consonant(word, i):
+    if word[i] in 'aeiou':
+        return False
+    if word[i] == 'y':
+        return i == 0 or not porter_is_consonant(word, i - 1)
+    return True
+
+# 词干的度量 m：把词干写成 [C](VC){m}[V] 形式时 VC 的重复次数
+def porter_measure(stem):
+    forms = "".join('c' if porter_is_consonant(stem, i) else 'v' for i in range(len(stem)))
+    return forms.count('vc')
+
+# 词干中是否含有元音
+def porter_has_vowel(stem):
+    return any(not porter_is_consonant(stem, i) for i in range(len(stem)))
+
+# 是否以两个相同的辅音结尾
+def porter_ends_double_consonant(word):
+    return len(word) >= 2 and word[-1] == word[-2] and porter_is_consonant(word, len(word) - 1)
+
+# 是否以 辅音-元音-辅音 结尾，且最后一个辅音不是 w、x、y
+def porter_ends_cvc(word):
+    return len(word) >= 3 and porter_is_consonant(word, len(word) - 3) and not porter_is_consonant(word, len(word) - 2) \
+        and porter_is_consonant(word, len(word) - 1) and word[-1] not in 'wxy'
+
+# 按替换表处理最长匹配的后缀，词干度量大于 min_measure 时才替换
+def porter_replace_suffix(word, suffixes, min_measure):
+    for suffix, replacement in suffixes:
+        if word.endswith(suffix):
+            stem = word[:-len(suffix)]
+            return stem + replacement if porter_measure(stem) > min_measure else word
+    return word
+
+# Porter 词干提取（Porter, 1980），只处理纯英文字母的词
+def porter_stem(word):
+    if len(word) <= 2 or not (word.isascii() and word.isalpha()):
+        return word
+
+    # 第 1a 步：复数
+    if word.endswith('sses') or word.endswith('ies'):
+        word = word[:-2]
+    elif word.endswith('s') and not word.endswith('ss'):
+        word = word[:-1]
+
+    # 第 1b 步：-eed、-ed、-ing
+    if word.endswith('eed'):
+        if porter_measure(word[:-3]) > 0:
+            word = word[:-1]
+    else:
+        for suffix in ['ed', 'ing']:
+            if word.endswith(suffix) and porter_has_vowel(word[:-len(suffix)]):
+                word = word[:-len(suffix)]
+                if word.endswith('at') or word.endswith('bl') or word.endswith('iz'):
+                    word += 'e'
+                elif porter_ends_double_consonant(word) and word[-1] not in 'lsz':
+                    word = word[:-1]
+                elif porter_measure(word) == 1 and porter_ends_cvc(word):
+                    word += 'e'
+                break
+
+    # 第 1c 步：词干含元音时 y 改为 i
+    if word.endswith('y') and porter_has_vowel(word[:-1]):
+        word = word[:-1] + 'i'
+
+    # 第 2、3 步：派生后缀归并
+    word = porter_replace_suffix(word, PORTER_STEP2_SUFFIXES, 0)
+    word = porter_replace_suffix(word, PORTER_STEP3_SUFFIXES, 0)
+
+    # 第 4 步：去掉 m > 1 的词干后面的后缀（-ion 要求词干以 s 或 t 结尾）
+    for suffix in PORTER_STEP4_SUFFIXES:
+        if word.endswith(suffix):
+            stem = word[:-len(suffix)]
+            if porter_measure(stem) > 1 and (suffix != 'ion' or stem[-1:] in ['s', 't']):
+                word = stem
+            break
+
+    # 第 5 步：去掉词尾的 e，-ll 改为 -l
+    if word.endswith('e'):
+        stem = word[:-1]
+        measure = porter_measure(stem)
+        if measure > 1 or (measure == 1 and not porter_ends_cvc(stem)):
+            word = stem
+    if porter_measure(word) > 1 and word.endswith('ll'):
+        word = word[:-1]
+    return word
+
+# 带缓存的词干提取：词形分布符合 Zipf 定律，少量高频词形占了绝大多数词例，有界缓存即可覆盖
+@functools.lru_cache(maxsize=STEM_CACHE_SIZE)
+def stem_token(token):
+    return porter_stem(token)
+
+# 词项规范化：开启词干提取时返回词干
+def normalize_token(token):
+    return stem_token(token) if ENABLE_STEMMING else token
+
+# 判断文本是否需要按中日韩文字切分
+def has_cjk(text):
+    return CJK_ANALYZER == 'bigram' and CJK_RUN_PATTERN.search(text) is not None
 
 # 预处理文本
 def preprocess_text(text):
+    if has_cjk(text):
+        return [token for token, _, _ in tokenize_with_offsets(text)]
     text = re.sub(r'[^\w\s]', '', text.lower())
     tokens = text.split()
-    tokens = [token for token in tokens if token not in STOP_WORDS]
+    tokens = [normalize_token(token) for token in tokens if token not in STOP_WORDS and len(token) <= MAX_TOKEN_LENGTH]
     return tokens  
 
+# 普通词去掉标点后的词项，停用词和超长的词返回 None
+def word_token(word):
+    token = re.sub(r'[^\w\s]', '', word.lower())
+    if token and token not in STOP_WORDS and len(token) <= MAX_TOKEN_LENGTH:
+        return normalize_token(token)
+    return None
+
+# 连续的中日韩文字切成重叠的二元组 (词项, 起始偏移, 结束偏移)，单独一个字时保留为一元词项
+# 开启 CJK_UNIGRAMS 时一元词项和二元组按在原文中的位置交替排列，查询经过同样的切分后仍是相邻的短语
+def cjk_tokens(run, offset):
+    if len(run) == 1:
+        return [(run, offset, offset + 1)]
+    tokens = []
+    for i in range(len(run)):
+        if CJK_UNIGRAMS:
+            tokens.append((run[i], offset + i, offset + i + 1))
+        if i + 1 < len(run):
+            tokens.append((run[i:i + 2], offset + i, offset + i + 2))
+    return tokens
+
+# 分词并记录每个词项在原文中的字符偏移，规则与 preprocess_text 一致
+# 含中日韩文字的词中，连续的中日韩文字切成二元组，前后的其余部分各自按普通词处理
+def tokenize_with_offsets(text):
+    tokens = []
+    cjk_text = has_cjk(text)
+    for match in re.finditer(r'\S+', text):
+        word = match.group()
+        runs = list(CJK_RUN_PATTERN.finditer(word)) if cjk_text else []
+        cursor = 0
+        for run in runs:
+            token = word_token(word[cursor:run.start()])
+            if token:
+                tokens.append((token, match.start() + cursor, match.start() + run.start()))
+            tokens.extend(cjk_tokens(run.group(), match.start() + run.start()))
+            cursor = run.end()
+        token = word_token(word[cursor:])
+        if token:
+            tokens.append((token, match.start() + cursor, match.end()))
+    return tokens
+
+# 单次遍历所有邮件，生成词项词典、倒排索引以及按文档存储的词项偏移表
+# workers 大于 1 时在 fork 出的进程池中分词，结果按邮件顺序取回，与单进程分词完全一致
+def analyze_emails(emails, job=None, workers=INDEX_BUILD_WORKERS):
+    provisional_ids = {}
+    doc_term_ids, doc_starts, doc_ends = [], [], []
+    pool = multiprocessing.get_context('fork').Pool(workers) if workers > 1 and len(emails) > 1 else None
+    try:
+        if pool is not None:
+            token_lists = pool.imap(tokenize_with_offsets, emails, chunksize=max(1, min(256, len(emails) // (4 * workers))))
+        else:
+            token_lists = map(tokenize_with_offsets, emails)
+        for doc_id, tokens in enumerate(token_lists):
+            if job is not None and doc_id % INDEX_BUILD_REPORT_INTERVAL == 0:
+                report_index_build(job, docs_indexed=doc_id)
+            doc_term_ids.append([provisional_ids.setdefault(token, len(provisional_ids)) for token, _, _ in tokens])
+            doc_starts.append([start for _, start, _ in tokens])
+            doc_ends.append([end for _, _, end in tokens])
+    finally:
+        if pool is not None:
+            pool.terminate()
+
+    if job is not None:
+        report_index_build(job, docs_indexed=len(emails))
+
+    # 按字典序重新编号，使词项ID与 generate_term_dictionary 的结果一致
+    terms = sorted(provisional_ids)
+    remap = np.empty(len(terms), dtype=np.int32)
+    for term_id, term in enumerate(terms):
+        remap[provisional_ids[term]] = term_id
+
+    doc_lengths = np.array([len(ids) for ids in doc_term_ids], dtype=np.int64)
+    token_ptr = np.zeros(len(emails) + 1, dtype=np.int64)
+    np.cumsum(doc_lengths, out=token_ptr[1:])
+    token_terms = remap[np.fromiter((i for ids in doc_term_ids for i in ids), dtype=np.int32, count=token_ptr[-1])]
+    token_starts = np.fromiter((i for starts in doc_starts for i in starts), dtype=np.int32, count=token_ptr[-1])
+    token_ends = np.fromiter((i for ends in doc_ends for i in ends), dtype=np.int32, count=token_ptr[-1])
+
+    # 由 (词项, 文档) 对去重得到倒排索引
+    token_docs = np.repeat(np.arange(len(emails), dtype=np.int64), doc_lengths)
+    pairs = np.unique(token_terms.astype(np.int64) * max(len(emails), 1) + token_docs)
+    pair_terms, pair_docs = np.divmod(pairs, max(len(emails), 1))
+    bounds = np.searchsorted(pair_terms, np.arange(len(terms) + 1))
+    inverted_index = {term: frozenset(pair_docs[bounds[i]:bounds[i + 1]].tolist()) for i, term in enumerate(terms)}
+
+    return {
+        'term_dictionary': {term: idx for idx, term in enumerate(terms)},
+        'terms': terms,
+        'inverted_index': inverted_index,
+        'token_ptr': token_ptr,
+        'token_terms': token_terms,
+        'token_starts': token_starts,
+        'token_ends': token_ends,
+    }
+
+# 计算每封邮件的 MinHash 签名：以连续 shingle_size 个词项ID为一个 shingle，
+# 对每个 shingle 用 num_perm 个乘移位哈希函数取最小值（分块向量化计算）
+def compute_minhash_signatures(token_ptr, token_ids, num_perm=MINHASH_NUM_PERM, shingle_size=SHINGLE_SIZE, seed=1):
+    rng = np.random.default_rng(seed)
+    multipliers = rng.integers(1, 2 ** 63, num_perm, dtype=np.uint64) | np.uint64(1)
+    increments = rng.integers(0, 2 ** 63, num_perm, dtype=np.uint64)
+    num_docs = len(token_ptr) - 1
+    doc_lengths = np.diff(token_ptr)
+    token_docs = np.repeat(np.arange(num_docs), doc_lengths)
+    positions = np.arange(len(token_ids))
+    doc_ends = token_ptr[token_docs + 1]
+
+    # 同一文档内相邻词项组合成 shingle 的哈希值，不跨越文档边界
+    ids = token_ids.astype(np.uint64) + np.uint64(1)
+    shingle_hashes = np.zeros(len(ids), dtype=np.uint64)
+    for offset in range(shingle_size):
+        shifted = np.zeros(len(ids), dtype=np.uint64)
+        shifted[:len(ids) - offset] = ids[offset:]
+        shingle_hashes = shingle_hashes * np.uint64(0x9E3779B97F4A7C15) + np.where(positions + offset < doc_ends, shifted, 0)
+    # 词项数不足一个 shingle 的短文档以全部词项作为唯一的 shingle
+    valid = (positions + shingle_size <= doc_ends) | ((positions == token_ptr[token_docs]) & (doc_lengths[token_docs] < shingle_size))
+    shingle_hashes, shingle_docs = shingle_hashes[valid], token_docs[valid]
+
+    signatures = np.full((num_docs, num_perm), np.iinfo(np.uint32).max, dtype=np.uint32)
+    for start in range(0, len(shingle_hashes), MINHASH_CHUNK_SIZE):
+        chunk_docs = shingle_docs[start:start + MINHASH_CHUNK_SIZE]
+        hashed = ((shingle_hashes[start:start + MINHASH_CHUNK_SIZE, None] * multipliers + increments) >> np.uint64(32)).astype(np.uint32)
+        group_starts = np.flatnonzero(np.r_[True, chunk_docs[1:] != chunk_docs[:-1]])
+        docs = chunk_docs[group_starts]
+        signatures[docs] = np.minimum(signatures[docs], np.minimum.reduceat(hashed, group_starts, axis=0))
+    return signatures
+
+# 用 LSH 分段（banding）寻找近似重复：同一段签名落入同一桶的文档为候选，
+# 桶内每一对候选都以签名估计的 Jaccard 相似度验证，通过的对用并查集合并，分组与文档顺序无关；
+# 返回每封邮件所在重复组的代表（组内最小文档ID）
+def find_near_duplicates(signatures, bands=MINHASH_BANDS, threshold=DUPLICATE_THRESHOLD):
+    num_docs, num_perm = signatures.shape
+    rows = num_perm // bands
+    parent = list(range(num_docs))
+
+    def find(doc):
+        while parent[doc] != doc:
+            parent[doc] = parent[parent[doc]]
+            doc = parent[doc]
+        return doc
+
+    def union(a, b):
+        root_a, root_b = find(a), find(b)
+        if root_a != root_b:
+            parent[max(root_a, root_b)] = min(root_a, root_b)
+
+    # 空文档没有 shingle，不参与去重
+    candidates = np.flatnonzero(signatures[:, 0] != np.iinfo(np.uint32).max)
+    for band in range(bands):
+        band_signatures = np.ascontiguousarray(signatures[candidates, band * rows:(band + 1) * rows])
+        keys = band_signatures.view(np.dtype((np.void, band_signatures.itemsize * rows))).ravel()
+        _, buckets, counts = np.unique(keys, return_inverse=True, return_counts=True)
+        order = np.argsort(buckets, kind='stable')
+        bounds = np.r_[0, np.cumsum(counts)]
+        for bucket in np.flatnonzero(counts > 1):
+            members = candidates[order[bounds[bucket]:bounds[bucket + 1]]]
+            # 完整签名相同的成员直接合并，其余各不相同的签名两两比较
+            member_signatures = np.ascontiguousarray(signatures[members])
+            _, first, inverse = np.unique(member_signatures.view(np.dtype((np.void, member_signatures.itemsize * num_perm))).ravel(),
+                                          return_index=True, return_inverse=True)
+            for i, j in zip(range(len(members)), first[inverse.ravel()].tolist()):
+                union(members[i], members[j])
+            distinct = members[np.sort(first)]
+            for i in range(1, len(distinct)):
+                similar = np.mean(signatures[distinct[:i]] == signatures[distinct[i]], axis=1) >= threshold
+                for doc in distinct[:i][similar]:
+                    union(doc, distinct[i])
+
+    return np.array([find(doc) for doc in range(num_docs)], dtype=np.int32)
+
+# 折叠检索结果中的近似重复邮件：每组只保留排名最靠前的一封，并返回各保留结果代表的邮件数
+def collapse_duplicates(results, duplicate_of, scores=None):
+    results = np.asarray(results, dtype=np.int64)
+    groups = duplicate_of[results]
+    _, first, group_sizes = np.unique(groups, return_index=True, return_counts=True)
+    keep = np.sort(first)
+    sizes = dict(zip(groups[first].tolist(), group_sizes.tolist()))
+    kept_sizes = np.array([sizes[group] for group in groups[keep].tolist()], dtype=np.int32)
+    return results[keep], (np.asarray(scores)[keep] if scores is not None else None), kept_sizes
+
 # 生成词项词典
 def generate_term_dictionary(emails):
     term_freq = defaultdict(int)
@@ -99,100 +767,2514 @@ def create_inverted_index(emails, term_dictionary):
                 inverted_index[token].add(doc_index)
     return inverted_index
 
-# 解析布尔查询（文档关联矩阵）
-def parse_boolean_query_matrix(query, term_doc_matrix, terms):
-    query = query.upper().split()
+# 从邮件文本开头的邮件头中提取字段：发件人、收件人（含抄送）、主题和日期时间戳
+def extract_header_fields(text):
+    headers = Parser(policy=email_policy.default).parsestr(text, headersonly=True)
+    fields = {
+        'from': str(headers.get('From', '')),
+        'to': " ".join(str(headers.get(name, '')) for name in ['To', 'Cc']),
+        'subject': str(headers.get('Subject', '')),
+        'date': np.nan,
+    }
+    try:
+        fields['date'] = parsedate_to_datetime(str(headers.get('Date', ''))).timestamp()
+    except (TypeError, ValueError, IndexError):
+        pass
+    return fields
+
+# 字段值的词项：主题按正文规则分词；发件人/收件人取各单词以及完整邮箱地址
+def field_terms(field, value):
+    value = value.lower()
+    if field == 'subject':
+        return set(preprocess_text(value))
+    return set(re.findall(r'\w+', value)) | set(EMAIL_ADDRESS_PATTERN.findall(value))
+
+# 构建字段索引：发件人、收件人、主题各自的倒排列表，以及按时间排序的日期列
+def build_field_index(emails):
+    postings = {field: defaultdict(list) for field in ['from', 'to', 'subject']}
+    doc_dates = np.full(len(emails), np.nan)
+    for doc_id, text in enumerate(emails):
+        fields = extract_header_fields(text)
+        for field, field_postings in postings.items():
+            for term in field_terms(field, fields[field]):
+                field_postings[term].append(doc_id)
+        doc_dates[doc_id] = fields['date']
+
+    dated_docs = np.flatnonzero(~np.isnan(doc_dates))
+    date_docs = dated_docs[np.argsort(doc_dates[dated_docs], kind='stable')]
+    return {
+        'num_docs': len(emails),
+        'postings': {field: {term: np.array(docs, dtype=np.int32) for term, docs in field_postings.items()}
+                     for field, field_postings in postings.items()},
+        'doc_dates': doc_dates,
+        'date_docs': date_docs.astype(np.int32),
+        'date_values': doc_dates[date_docs],
+    }
+
+# 解析日期边界（YYYY、YYYY-MM 或 YYYY-MM-DD，按 UTC 计算）；upper 为真时返回该年/月/日结束的时间戳
+def parse_date_bound(text, upper=False):
+    for fmt, unit in [('%Y-%m-%d', 'day'), ('%Y-%m', 'month'), ('%Y', 'year')]:
+        try:
+            moment = datetime.strptime(text, fmt).replace(tzinfo=timezone.utc)
+        except ValueError:
+            continue
+        if upper:
+            if unit == 'day':
+                moment += timedelta(days=1)
+            elif unit == 'month':
+                moment = moment.replace(year=moment.year + moment.month // 12, month=moment.month % 12 + 1)
+            else:
+                moment = moment.replace(year=moment.year + 1)
+        return moment.timestamp()
+    raise ValueError(f"无法解析日期 {text}，请使用 YYYY-MM-DD 格式")
+
+# 解析日期范围 start..end（两端均包含，可省略一端），返回 [起始, 结束) 时间戳
+def parse_date_range(value):
+    start, _, end = value.partition('..') if '..' in value else (value, '', value)
+    return (parse_date_bound(start) if start else -np.inf,
+            parse_date_bound(end, upper=True) if end else np.inf)
+
+# 字段操作数匹配的文档位图：日期范围在有序时间戳上二分查找，其余字段对各词项的倒排列表按位与
+def field_operand_bitmap(operand, field_index):
+    if field_index is None:
+        raise ValueError("字段查询需要字段索引")
+    _, field, value = operand
+    bitmap = np.zeros(field_index['num_docs'], dtype=bool)
+    if field == 'date':
+        start, end = parse_date_range(value)
+        lo, hi = np.searchsorted(field_index['date_values'], [start, end], side='left')
+        bitmap[field_index['date_docs'][lo:hi]] = True
+        return bitmap
+
+    terms = field_terms(field, value)
+    postings = field_index['postings'][field]
+    if not terms:
+        return bitmap
+    bitmap[:] = True
+    for term in terms:
+        term_bitmap = np.zeros(field_index['num_docs'], dtype=bool)
+        term_bitmap[postings.get(term, np.zeros(0, dtype=np.int32))] = True
+        bitmap &= term_bitmap
+    return bitmap
+
+# 构建通配符查询使用的 k-gram 词项索引：以 $ 标记词首词尾，每个 k-gram 对应包含它的词项ID
+def build_wildcard_index(index, k=WILDCARD_KGRAM_SIZE):
+    kgram_terms = defaultdict(list)
+    for term_id, term in enumerate(index['terms']):
+        padded = f"${term}$"
+        for gram in {padded[i:i + k] for i in range(len(padded) - k + 1)}:
+            kgram_terms[gram].append(term_id)
+    return {
+        'terms': index['terms'],
+        'k': k,
+        'kgram_index': {gram: np.array(term_ids, dtype=np.int32) for gram, term_ids in kgram_terms.items()},
+    }
+
+# 判断查询词是否包含通配符 * 或 ?
+def is_wildcard(word):
+    return '*' in word or '?' in word
+
+# 将通配符查询词展开为词典中匹配的词项（按字典序）；匹配的词项超过 max_expansions 个时抛出 ValueError，
+# 要求输入更具体的模式，而不是截断后返回不完整的结果
+def expand_wildcard(wildcard_index, pattern, max_expansions=WILDCARD_MAX_EXPANSIONS):
+    terms = wildcard_index['terms']
+    pattern = re.sub(r'[^\w*?]', '', pattern.lower())
+
+    # 前缀查询：在有序词项列表上二分查找
+    if pattern.endswith('*') and not is_wildcard(pattern[:-1]):
+        prefix = pattern[:-1]
+        lo = bisect.bisect_left(terms, prefix)
+        hi = bisect.bisect_left(terms, prefix + '\U0010ffff')
+        if hi - lo > max_expansions:
+            raise ValueError(f"通配符 {pattern} 匹配的词项超过 {max_expansions} 个，请输入更具体的模式")
+        return terms[lo:hi]
+
+    # 后缀/中缀查询：先用 k-gram 索引求交得到候选词项，再用正则过滤误匹配
+    k = wildcard_index['k']
+    padded = f"${pattern}$"
+    grams = {fragment[i:i + k] for fragment in re.split(r'[*?]', padded) for i in range(len(fragment) - k + 1)}
+    postings = sorted((wildcard_index['kgram_index'].get(gram, np.zeros(0, dtype=np.int32)) for gram in grams), key=len)
+    candidates = postings[0] if postings else np.arange(len(terms))
+    for term_ids in postings[1:]:
+        candidates = np.intersect1d(candidates, term_ids, assume_unique=True)
+    matcher = re.compile(re.escape(pattern).replace('\\*', '.*').replace('\\?', '.'))
+    expansions = []
+    for term_id in candidates:
+        if matcher.fullmatch(terms[term_id]):
+            expansions.append(terms[term_id])
+            if len(expansions) > max_expansions:
+                raise ValueError(f"通配符 {pattern} 匹配的词项超过 {max_expansions} 个，请输入更具体的模式")
+    return expansions
+
+# 变长字节编码（varint）：每字节低 7 位存数据，最高位表示后面还有字节
+def encode_varints(values):
+    values = np.asarray(values, dtype=np.uint64)
+    num_bytes = np.ones(len(values), dtype=np.int64)
+    rest = values >> np.uint64(7)
+    while rest.any():
+        num_bytes += rest > 0
+        rest >>= np.uint64(7)
+    starts = np.zeros(len(values) + 1, dtype=np.int64)
+    np.cumsum(num_bytes, out=starts[1:])
+    data = np.empty(starts[-1], dtype=np.uint8)
+    for k in range(int(num_bytes.max()) if len(values) else 0):
+        mask = num_bytes > k
+        chunk = (values[mask] >> np.uint64(7 * k)) & np.uint64(0x7f)
+        chunk |= np.where(num_bytes[mask] > k + 1, 0x80, 0).astype(np.uint64)
+        data[starts[:-1][mask] + k] = chunk
+    return data, starts
+
+# 解码一段 varint 字节序列
+def decode_varints(data):
+    data = np.frombuffer(data, dtype=np.uint8)
+    if len(data) == 0:
+        return np.zeros(0, dtype=np.int64)
+    ends = np.flatnonzero(data < 0x80)
+    starts = np.concatenate(([0], ends[:-1] + 1))
+    shifts = np.arange(len(data)) - np.repeat(starts, ends - starts + 1)
+    payload = (data & 0x7f).astype(np.int64) << (7 * shifts)
+    return np.add.reduceat(payload, starts)
+
+# 由词项偏移表构建位置索引：每个 (词项, 文档) 的位置列表做差分后以 varint 压缩存储
+def build_positional_index(index):
+    token_ptr, token_terms = index['token_ptr'], index['token_terms']
+    num_docs = len(token_ptr) - 1
+    doc_lengths = np.diff(token_ptr)
+    token_docs = np.repeat(np.arange(num_docs, dtype=np.int64), doc_lengths)
+    token_positions = np.arange(len(token_terms), dtype=np.int64) - token_ptr[token_docs]
+
+    # 稳定排序后同一词项内按 (文档, 位置) 有序
+    order = np.argsort(token_terms, kind='stable')
+    sorted_terms, sorted_docs, sorted_positions = token_terms[order], token_docs[order], token_positions[order]
+    new_posting = np.ones(len(order), dtype=bool)
+    new_posting[1:] = (sorted_terms[1:] != sorted_terms[:-1]) | (sorted_docs[1:] != sorted_docs[:-1])
+    gaps = sorted_positions.copy()
+    gaps[1:][~new_posting[1:]] -= sorted_positions[:-1][~new_posting[1:]]
+
+    data, byte_starts = encode_varints(gaps)
+    posting_starts = np.flatnonzero(new_posting)
+    return {
+        'term_dictionary': index['term_dictionary'],
+        'term_ptr': np.searchsorted(sorted_terms[posting_starts], np.arange(len(index['terms']) + 1)),
+        'docs': sorted_docs[posting_starts].astype(np.int32),
+        'offsets': np.append(byte_starts[posting_starts], byte_starts[-1]),
+        'data': data.tobytes(),
+    }
+
+# 读取词项在各文档中的位置，返回 {文档ID: 位置数组}；candidate_docs 不为空时只解码这些文档
+def term_positions(positional_index, term, candidate_docs=None):
+    term_id = positional_index['term_dictionary'].get(term)
+    if term_id is None:
+        return {}
+    lo, hi = positional_index['term_ptr'][term_id], positional_index['term_ptr'][term_id + 1]
+    postings = np.arange(lo, hi)
+    if candidate_docs is not None:
+        postings = postings[np.isin(positional_index['docs'][lo:hi], list(candidate_docs))]
+    offsets, data = positional_index['offsets'], positional_index['data']
+    return {int(positional_index['docs'][i]): np.cumsum(decode_varints(data[offsets[i]:offsets[i + 1]]))
+            for i in postings}
+
+# 计算操作数（词项、短语、邻近）在各文档中的匹配位置，只使用位置索引，不扫描邮件原文
+def operand_positions(operand, positional_index, candidate_docs=None):
+    if operand[0] == 'term':
+        return term_positions(positional_index, operand[1], candidate_docs)
+
+    if operand[0] == 'any':
+        # 通配符展开后的多个词项：合并各词项的位置
+        matches = defaultdict(list)
+        for term in operand[1]:
+            for doc, positions in term_positions(positional_index, term, candidate_docs).items():
+                matches[doc].append(positions)
+        return {doc: np.sort(np.concatenate(positions)) for doc, positions in matches.items()}
+
+    if operand[0] == 'phrase':
+        # 从文档频率最低的词项开始求交，逐步缩小候选文档
+        term_ids = positional_index['term_dictionary']
+        term_ptr = positional_index['term_ptr']
+        order = sorted(range(len(operand[1])), key=lambda i: term_ptr[term_ids[operand[1][i]] + 1] - term_ptr[term_ids[operand[1][i]]]
+                       if operand[1][i] in term_ids else -1)
+        matches = None
+        for i in order:
+            positions = term_positions(positional_index, operand[1][i], matches.keys() if matches is not None else candidate_docs)
+            if matches is None:
+                matches = {doc: pos - i for doc, pos in positions.items()}
+            else:
+                matches = {doc: np.intersect1d(starts, positions[doc] - i) for doc, starts in matches.items() if doc in positions}
+            matches = {doc: starts for doc, starts in matches.items() if len(starts)}
+            if not matches:
+                return {}
+        return matches
+
+    # NEAR/k：左右操作数在同一文档中相距不超过 k 个词项
+    left = operand_positions(operand[1], positional_index, candidate_docs)
+    right = operand_positions(operand[2], positional_index, left.keys())
+    k = operand[3]
+    matches = {}
+    for doc in left.keys() & right.keys():
+        p, q = left[doc], np.sort(right[doc])
+        nearest = np.searchsorted(q, p - k)
+        found = nearest < len(q)
+        found[found] = q[nearest[found]] <= p[found] + k
+        if found.any():
+            matches[doc] = p[found]
+    return matches
+
+# 布尔查询中的短语 "..." 和普通词（含操作符 AND/OR/NOT/NEAR/k）
+QUERY_TOKEN_PATTERN = re.compile(r'"([^"]*)"|(\S+)')
+NEAR_PATTERN = re.compile(r'NEAR/(\d+)', re.IGNORECASE)
+FIELD_QUERY_PATTERN = re.compile(r'(from|to|subject|date):(\S+)', re.IGNORECASE)
+
+# 将布尔查询解析为操作符和操作数序列
+# 操作数为 ('term', 词项)、('phrase', 词项列表)、('near', 左操作数, 右操作数, k)、字段 ('field', 字段名, 值)，
+# 以及通配符 ('wildcard', 模式)；给出 wildcard_index 时通配符展开为 ('any', 词项列表)
+def parse_query_operands(query, wildcard_index=None):
+    items = []
+    for match in QUERY_TOKEN_PATTERN.finditer(query):
+        if match.group(1) is not None:
+            phrase_terms = preprocess_text(match.group(1))
+            items.append(('phrase', phrase_terms) if len(phrase_terms) > 1 else ('term', "".join(phrase_terms)))
+        elif match.group(2).upper() in ['AND', 'OR', 'NOT']:
+            items.append(match.group(2).upper())
+        elif FIELD_QUERY_PATTERN.fullmatch(match.group(2)):
+            field, value = FIELD_QUERY_PATTERN.fullmatch(match.group(2)).groups()
+            items.append(('field', field.lower(), value))
+        elif NEAR_PATTERN.fullmatch(match.group(2)):
+            items.append(('NEAR', int(NEAR_PATTERN.fullmatch(match.group(2)).group(1))))
+        elif is_wildcard(match.group(2)):
+            pattern = match.group(2).lower()
+            items.append(('any', expand_wildcard(wildcard_index, pattern)) if wildcard_index is not None else ('wildcard', pattern))
+        elif has_cjk(match.group(2)):
+            # 中文词切成二元组后作为短语查询：从最短的二元组倒排列表开始求交，再校验位置是否相邻
+            cjk_terms = preprocess_text(match.group(2))
+            items.append(('phrase', cjk_terms) if len(cjk_terms) > 1 else ('term', "".join(cjk_terms)))
+        else:
+            items.append(('term', normalize_token(match.group(2).lower())))
+
+    # 合并 NEAR/k 两侧的操作数
+    operands = []
+    i = 0
+    while i < len(items):
+        item = items[i]
+        if item[0] == 'NEAR' and operands and isinstance(operands[-1], tuple) \
+                and i + 1 < len(items) and isinstance(items[i + 1], tuple) and items[i + 1][0] != 'NEAR':
+            operands.append(('near', operands.pop(), items[i + 1], item[1]))
+            i += 2
+        else:
+            if item[0] != 'NEAR':
+                operands.append(item)
+            i += 1
+    return operands
+
+# 判断查询是否包含需要位置索引的短语或邻近操作数
+def query_needs_positions(query):
+    return any(isinstance(item, tuple) and item[0] in ['phrase', 'near'] for item in parse_query_operands(query))
+
+# 操作数的可读形式，用于查询执行计划
+def format_operand(operand):
+    if operand[0] == 'phrase':
+        return '"' + ' '.join(operand[1]) + '"'
+    if operand[0] == 'near':
+        return f"NEAR/{operand[3]}({format_operand(operand[1])}, {format_operand(operand[2])})"
+    if operand[0] == 'any':
+        shown = ' | '.join(operand[1][:5])
+        return f"{{{shown}{f' …共 {len(operand[1])} 个' if len(operand[1]) > 5 else ''}}}"
+    if operand[0] == 'field':
+        return f"{operand[1]}:{operand[2]}"
+    return operand[1]
+
+# 布尔查询的语法树：操作数按从左到右的顺序合并，相当于一棵左深树
+def format_query_tree(operands):
+    tree = None
+    current_op = 'AND'
+    for item in operands:
+        if item in ['AND', 'OR', 'NOT']:
+            current_op = item
+        elif tree is None:
+            tree = f"NOT({format_operand(item)})" if current_op == 'NOT' else format_operand(item)
+        else:
+            tree = f"{current_op}({tree}, {format_operand(item)})"
+    return tree or ''
+
+# 按从左到右的顺序合并各操作数的文档位图（AND/OR/NOT 对应按位与、或、与非）
+# 传入 profile 字典时记录查询语法树，以及每一步的倒排列表长度、中间结果大小和耗时
+def combine_boolean_results(operands, operand_bitmap, num_docs, not_from_all=True, profile=None):
     result_docs = None
     current_op = 'AND'
+    if profile is not None:
+        profile.update(tree=format_query_tree(operands), steps=[])
 
-    for term in query:
-        if term in ['AND', 'OR', 'NOT']:
-            current_op = term
+    for item in operands:
+        if item in ['AND', 'OR', 'NOT']:
+            current_op = item
         else:
-            term_index = term_dictionary.get(term.lower())
-            if term_index is not None:
-                term_docs = set(np.where(term_doc_matrix[term_index] == 1)[0])
-            else:
-                term_docs = set()
-            
+            started = time.perf_counter()
+            term_docs = operand_bitmap(item)
+
             if current_op == 'AND':
                 result_docs = result_docs & term_docs if result_docs is not None else term_docs
             elif current_op == 'OR':
                 result_docs = result_docs | term_docs if result_docs is not None else term_docs
             elif current_op == 'NOT':
-                result_docs = result_docs - term_docs if result_docs is not None else set(range(term_doc_matrix.shape[1])) - term_docs
+                if result_docs is None:
+                    result_docs = np.ones(num_docs, dtype=bool) if not_from_all else np.zeros(num_docs, dtype=bool)
+                result_docs = result_docs & ~term_docs
+            if profile is not None:
+                # 先停止计时，统计文档数不计入本步耗时
+                elapsed = time.perf_counter() - started
+                profile['steps'].append({
+                    'operator': current_op, 'operand': format_operand(item),
+                    'postings': int(np.count_nonzero(term_docs)), 'result': int(np.count_nonzero(result_docs)),
+                    'time_ms': elapsed * 1000,
+                })
+
+    return np.flatnonzero(result_docs).tolist() if result_docs is not None else []
+
+# 将文档ID集合转换为位图
+def postings_bitmap(docs, num_docs):
+    bitmap = np.zeros(num_docs, dtype=bool)
+    bitmap[np.fromiter(docs, dtype=np.int64, count=len(docs))] = True
+    return bitmap
+
+# 短语和邻近操作数匹配的文档位图
+def positional_operand_bitmap(operand, positional_index, num_docs):
+    if positional_index is None:
+        raise ValueError("短语和 NEAR/k 查询需要启用位置索引")
+    return postings_bitmap(operand_positions(operand, positional_index).keys(), num_docs)
+
+# 未展开的通配符操作数无法求值
+def check_wildcard_operand(operand):
+    if operand[0] == 'wildcard':
+        raise ValueError(f"通配符查询 {operand[1]} 需要词项 k-gram 索引")
 
-    return sorted(result_docs) if result_docs else []
+# 解析布尔查询（文档关联矩阵）
+def parse_boolean_query_matrix(query, term_doc_matrix, terms, positional_index=None, wildcard_index=None, field_index=None, profile=None):
+    num_docs = term_doc_matrix.shape[1]
+
+    # 词项列表按字典序排列，可二分查找行号
+    def term_row(term):
+        term_index = bisect.bisect_left(terms, term)
+        return term_index if term_index < len(terms) and terms[term_index] == term else None
+
+    def operand_bitmap(operand):
+        check_wildcard_operand(operand)
+        if operand[0] == 'field':
+            return field_operand_bitmap(operand, field_index)
+        if operand[0] == 'any':
+            # 通配符展开的各词项对应行按位或
+            rows = [term_row(term) for term in operand[1]]
+            rows = [row for row in rows if row is not None]
+            return term_doc_matrix[rows].any(axis=0) if rows else np.zeros(num_docs, dtype=bool)
+        if operand[0] != 'term':
+            return positional_operand_bitmap(operand, positional_index, num_docs)
+        term_index = term_row(operand[1])
+        if term_index is not None:
+            return term_doc_matrix[term_index] == 1
+        return np.zeros(num_docs, dtype=bool)
+
+    return combine_boolean_results(parse_query_operands(query, wildcard_index), operand_bitmap, num_docs, profile=profile)
 
 # 解析布尔查询（倒排索引）
-def parse_boolean_query_inverted(query, inverted_index):
-    query = query.upper().split()
-    result_docs = None
+def parse_boolean_query_inverted(query, inverted_index, num_docs, positional_index=None, wildcard_index=None, field_index=None, profile=None):
+    def operand_bitmap(operand):
+        check_wildcard_operand(operand)
+        if operand[0] == 'field':
+            return field_operand_bitmap(operand, field_index)
+        if operand[0] == 'any':
+            # 通配符展开的各词项倒排列表求并集
+            return postings_bitmap(set().union(*(inverted_index.get(term, set()) for term in operand[1])), num_docs)
+        if operand[0] != 'term':
+            return positional_operand_bitmap(operand, positional_index, num_docs)
+        return postings_bitmap(inverted_index.get(operand[1], set()), num_docs)
+
+    return combine_boolean_results(parse_query_operands(query, wildcard_index), operand_bitmap, num_docs, not_from_all=False, profile=profile)
+
+# 由块内有序的低 16 位取值构建容器，选择占用最小的表示：('array', 有序数组) / ('bitmap', 1024 个 64 位字) / ('run', 行程数组)
+def roaring_container(values):
+    values = np.asarray(values, dtype=np.uint16)
+    run_breaks = np.flatnonzero(np.diff(values.astype(np.int32)) != 1) + 1
+    run_starts = np.concatenate(([0], run_breaks)) if len(values) else run_breaks
+    run_ends = np.concatenate((run_breaks - 1, [len(values) - 1])) if len(values) else run_breaks
+    run_bytes = 4 * len(run_starts)
+    if run_bytes < min(2 * len(values), ROARING_BITMAP_BYTES):
+        return ('run', np.stack([values[run_starts], values[run_ends] - values[run_starts]], axis=1))
+    if len(values) <= ROARING_ARRAY_MAX:
+        return ('array', values)
+    bits = np.zeros(1 << ROARING_CHUNK_BITS, dtype=bool)
+    bits[values] = True
+    return ('bitmap', np.packbits(bits, bitorder='little').view(np.uint64))
+
+# 由位图的 64 位字构建容器：基数较大且行程不多于位图占用时直接保留位图，不展开为取值
+def roaring_container_from_words(words):
+    if np.bitwise_count(words).sum() > ROARING_ARRAY_MAX:
+        # 行程起点为本位为 1 且前一位为 0 的位置（字内低位在前，跨字时取前一个字的最高位）
+        previous = (words << np.uint64(1)) | np.concatenate(([np.uint64(0)], words[:-1] >> np.uint64(63)))
+        if 4 * np.bitwise_count(words & ~previous).sum() >= ROARING_BITMAP_BYTES:
+            return ('bitmap', words)
+    return roaring_container(np.flatnonzero(np.unpackbits(words.view(np.uint8), bitorder='little')))
+
+# 由 65536 个布尔值构建容器
+def roaring_container_from_bits(bits):
+    return roaring_container_from_words(np.packbits(bits, bitorder='little').view(np.uint64))
+
+# 容器转换为 65536 个布尔值
+def roaring_container_bits(container):
+    kind, data = container
+    if kind == 'bitmap':
+        return np.unpackbits(data.view(np.uint8), bitorder='little').view(bool)
+    bits = np.zeros(1 << ROARING_CHUNK_BITS, dtype=bool)
+    if kind == 'array':
+        bits[data] = True
+    else:
+        # 行程起点 +1、终点后一位 -1，前缀和大于 0 的位置在某个行程内
+        delta = np.zeros((1 << ROARING_CHUNK_BITS) + 1, dtype=np.int32)
+        np.add.at(delta, data[:, 0].astype(np.int64), 1)
+        np.add.at(delta, data[:, 0].astype(np.int64) + data[:, 1] + 1, -1)
+        bits = np.cumsum(delta[:-1]) > 0
+    return bits
+
+# 容器中的有序取值
+def roaring_container_values(container):
+    kind, data = container
+    if kind == 'array':
+        return data
+    if kind == 'bitmap':
+        return np.flatnonzero(roaring_container_bits(container)).astype(np.uint16)
+    lengths = data[:, 1].astype(np.int64) + 1
+    offsets = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    return (np.repeat(data[:, 0].astype(np.int64), lengths) + offsets).astype(np.uint16)
+
+# 判断一组块内取值是否在容器中
+def roaring_container_contains(container, values):
+    kind, data = container
+    values = values.astype(np.int64)
+    if kind == 'array':
+        positions = np.minimum(np.searchsorted(data, values), max(len(data) - 1, 0))
+        return data[positions] == values if len(data) else np.zeros(len(values), dtype=bool)
+    if kind == 'bitmap':
+        return ((data[values >> 6] >> (values & 63).astype(np.uint64)) & np.uint64(1)).astype(bool)
+    run = np.searchsorted(data[:, 0], values, side='right') - 1
+    starts = data[np.maximum(run, 0), 0].astype(np.int64)
+    return (run >= 0) & (values - starts <= data[np.maximum(run, 0), 1])
+
+# 容器之间的与、或、与非：数组容器逐个取值判断，位图和行程容器按位运算
+def roaring_container_and(a, b):
+    if a[0] != 'array' and b[0] == 'array':
+        a, b = b, a
+    if a[0] == 'array':
+        return roaring_container(a[1][roaring_container_contains(b, a[1])])
+    if a[0] == 'bitmap' and b[0] == 'bitmap':
+        return roaring_container_from_words(a[1] & b[1])
+    return roaring_container_from_bits(roaring_container_bits(a) & roaring_container_bits(b))
+
+def roaring_container_or(a, b):
+    if a[0] == 'array' and b[0] == 'array' and len(a[1]) + len(b[1]) <= ROARING_ARRAY_MAX:
+        return roaring_container(np.union1d(a[1], b[1]))
+    if a[0] == 'bitmap' and b[0] == 'bitmap':
+        return roaring_container_from_words(a[1] | b[1])
+    return roaring_container_from_bits(roaring_container_bits(a) | roaring_container_bits(b))
+
+def roaring_container_andnot(a, b):
+    if a[0] == 'array':
+        return roaring_container(a[1][~roaring_container_contains(b, a[1])])
+    if a[0] == 'bitmap' and b[0] == 'bitmap':
+        return roaring_container_from_words(a[1] & ~b[1])
+    return roaring_container_from_bits(roaring_container_bits(a) & ~roaring_container_bits(b))
+
+# 由有序文档ID构建 Roaring 位图：{'keys': 各块高位, 'containers': 各块容器}
+def roaring_from_docs(docs):
+    docs = np.asarray(docs, dtype=np.int64)
+    keys, starts = np.unique(docs >> ROARING_CHUNK_BITS, return_index=True)
+    bounds = np.append(starts, len(docs))
+    low_bits = docs & ((1 << ROARING_CHUNK_BITS) - 1)
+    return {'keys': keys, 'containers': [roaring_container(low_bits[lo:hi]) for lo, hi in zip(bounds[:-1], bounds[1:])]}
+
+# Roaring 位图转换为有序文档ID
+def roaring_to_docs(bitmap):
+    if not len(bitmap['keys']):
+        return np.zeros(0, dtype=np.int64)
+    return np.concatenate([(key << ROARING_CHUNK_BITS) + roaring_container_values(container).astype(np.int64)
+                           for key, container in zip(bitmap['keys'].tolist(), bitmap['containers'])])
+
+# Roaring 位图的基数：数组容器取长度、位图容器数 1 的位数、行程容器累加行程长度，不展开为文档ID
+def roaring_cardinality(bitmap):
+    total = 0
+    for kind, data in bitmap['containers']:
+        if kind == 'array':
+            total += len(data)
+        elif kind == 'bitmap':
+            total += int(np.bitwise_count(data).sum())
+        else:
+            total += int(data[:, 1].astype(np.int64).sum()) + len(data)
+    return total
+
+# 按块合并两个 Roaring 位图，丢弃结果为空的块
+def roaring_merge(a, b, container_op, keep_a_only=False, keep_b_only=False):
+    keys, containers = [], []
+    a_keys, b_keys = a['keys'].tolist(), b['keys'].tolist()
+    i = j = 0
+    while i < len(a_keys) or j < len(b_keys):
+        if j == len(b_keys) or (i < len(a_keys) and a_keys[i] < b_keys[j]):
+            key, container = a_keys[i], a['containers'][i] if keep_a_only else None
+            i += 1
+        elif i == len(a_keys) or b_keys[j] < a_keys[i]:
+            key, container = b_keys[j], b['containers'][j] if keep_b_only else None
+            j += 1
+        else:
+            key, container = a_keys[i], container_op(a['containers'][i], b['containers'][j])
+            i += 1
+            j += 1
+        if container is not None and len(container[1]):
+            keys.append(key)
+            containers.append(container)
+    return {'keys': np.array(keys, dtype=np.int64), 'containers': containers}
+
+def roaring_and(a, b):
+    return roaring_merge(a, b, roaring_container_and)
+
+def roaring_or(a, b):
+    return roaring_merge(a, b, roaring_container_or, keep_a_only=True, keep_b_only=True)
+
+def roaring_andnot(a, b):
+    return roaring_merge(a, b, roaring_container_andnot, keep_a_only=True)
+
+# 由词项偏移表构建 Roaring 倒排索引，并统计各类容器数量和占用字节数
+def build_roaring_index(index):
+    term_ptr, docs, _ = build_term_frequencies(index)
+    postings = {term: roaring_from_docs(docs[term_ptr[i]:term_ptr[i + 1]]) for i, term in enumerate(index['terms'])}
+    stats = {'array': 0, 'bitmap': 0, 'run': 0, 'bytes': 0}
+    for bitmap in postings.values():
+        stats['bytes'] += bitmap['keys'].nbytes
+        for kind, data in bitmap['containers']:
+            stats[kind] += 1
+            stats['bytes'] += data.nbytes
+    return {'postings': postings, 'stats': stats}
+
+# 解析布尔查询（Roaring 倒排索引），AND/OR/NOT 直接在容器上计算
+def parse_boolean_query_roaring(query, roaring_index, positional_index=None, wildcard_index=None, field_index=None, profile=None):
+    postings = roaring_index['postings']
+    empty = roaring_from_docs([])
+
+    def operand_postings(operand):
+        check_wildcard_operand(operand)
+        if operand[0] == 'field':
+            return roaring_from_docs(np.flatnonzero(field_operand_bitmap(operand, field_index)))
+        if operand[0] == 'any':
+            result = empty
+            for term in operand[1]:
+                result = roaring_or(result, postings.get(term, empty))
+            return result
+        if operand[0] != 'term':
+            if positional_index is None:
+                raise ValueError("短语和 NEAR/k 查询需要启用位置索引")
+            return roaring_from_docs(sorted(operand_positions(operand, positional_index).keys()))
+        return postings.get(operand[1], empty)
+
+    result = None
     current_op = 'AND'
-
-    for term in query:
-        if term in ['AND', 'OR', 'NOT']:
-            current_op = term
+    operands = parse_query_operands(query, wildcard_index)
+    if profile is not None:
+        profile.update(tree=format_query_tree(operands), steps=[])
+    for item in operands:
+        if item in ['AND', 'OR', 'NOT']:
+            current_op = item
         else:
-            term_docs = inverted_index.get(term.lower(), set())
-
+            started = time.perf_counter()
+            term_postings = operand_postings(item)
             if current_op == 'AND':
-                result_docs = result_docs & term_docs if result_docs is not None else term_docs
+                result = roaring_and(result, term_postings) if result is not None else term_postings
             elif current_op == 'OR':
-                result_docs = result_docs | term_docs if result_docs is not None else term_docs
+                result = roaring_or(result, term_postings) if result is not None else term_postings
             elif current_op == 'NOT':
-                result_docs = result_docs - term_docs if result_docs is not None else set()
-
-    return sorted(result_docs) if result_docs else []
-
-
-# 计算文档的 tf-idf 矩阵
-def calculate_tf_idf(emails, term_dictionary):
-    num_terms = len(term_dictionary)
-    num_docs = len(emails)
-    tf_matrix = np.zeros((num_terms, num_docs))
-    df_vector = np.zeros(num_terms)
-
-    # 计算词频 (tf) 和文档频率 (df)
-    for doc_index, email in enumerate(emails):
-        tokens = preprocess_text(email)
-        term_counts = defaultdict(int)
-        for token in tokens:
+                result = roaring_andnot(result if result is not None else empty, term_postings)
+            if profile is not None:
+                # 先停止计时，基数由容器头部统计，不计入本步耗时
+                elapsed = time.perf_counter() - started
+                profile['steps'].append({
+                    'operator': current_op, 'operand': format_operand(item),
+                    'postings': roaring_cardinality(term_postings), 'result': roaring_cardinality(result),
+                    'time_ms': elapsed * 1000,
+                })
+    return roaring_to_docs(result).tolist() if result is not None else []
+
+# 计算文档的 tf-idf 权重：按词项分组的稀疏倒排表（词项起止指针, 文档ID, tf-idf 权重）以及每封邮件的向量长度
+# 由词项偏移表统计词频，不重新分词，也不构建词项数 × 文档数的稠密矩阵
+def calculate_tf_idf(index):
+    term_ptr, docs, tfs = build_term_frequencies(index)
+    num_docs = len(index['token_ptr']) - 1
+    doc_freqs = np.diff(term_ptr)
+    weights = tfs * np.repeat(np.log(num_docs / (doc_freqs + 1)), doc_freqs)  # 避免分母为 0
+    doc_norms = np.sqrt(np.bincount(docs, weights=weights ** 2, minlength=num_docs))
+    return {
+        'term_ptr': term_ptr,
+        'docs': docs,
+        'weights': weights,
+        'doc_norms': doc_norms,
+        'num_docs': num_docs,
+        'bytes': term_ptr.nbytes + docs.nbytes + weights.nbytes + doc_norms.nbytes,
+    }
+
+# 排序检索的查询词权重 {词项: 权重}，只保留词典中存在的词项
+def build_query_weights(query, term_dictionary, wildcard_index=None):
+    query_weights = defaultdict(float)
+
+    for word in query.split():
+        if wildcard_index is not None and is_wildcard(word):
+            # 通配符展开的词项平分该查询词的权重
+            expansions = expand_wildcard(wildcard_index, word)
+            for term in expansions:
+                query_weights[term] += 1 / len(expansions)
+            continue
+        for token in preprocess_text(word):
             if token in term_dictionary:
-                term_counts[token] += 1
-        for term, count in term_counts.items():
-            term_index = term_dictionary[term]
-            tf_matrix[term_index, doc_index] = count
-            df_vector[term_index] += 1
-
-    # 计算 tf-idf
-    idf_vector = np.log(num_docs / (df_vector + 1))  # 避免分母为 0
-    tf_idf_matrix = tf_matrix * idf_vector[:, None]
-    return tf_idf_matrix
-
-# 基于 tf-idf 计算文档相似度并排序
-def ranked_retrieval(query, tf_idf_matrix, term_dictionary, emails):
-    query_tokens = preprocess_text(query)
-    query_vector = np.zeros(tf_idf_matrix.shape[0])
-
-    for token in query_tokens:
-        if token in term_dictionary:
-            query_vector[term_dictionary[token]] += 1
-
-    # 计算相似度 (余弦相似度)
-    doc_norms = np.linalg.norm(tf_idf_matrix, axis=0)
-    query_norm = np.linalg.norm(query_vector)
-    similarity_scores = np.dot(tf_idf_matrix.T, query_vector) / (doc_norms * query_norm + 1e-10)  # 避免除零
-
-    # 按相似度排序文档
-    ranked_doc_indices = np.argsort(-similarity_scores)  # 降序排列
-    return [(index, similarity_scores[index]) for index in ranked_doc_indices if similarity_scores[index] > 0]
-
-
+                query_weights[token] += 1
+    return dict(query_weights)
+
+# 基于 tf-idf 计算文档相似度（余弦相似度）并排序：按查询词逐个累加倒排表中的 tf-idf 权重，只为出现查询词的文档打分
+# 传入 profile 字典时记录查询词权重和倒排列表长度、各阶段耗时，以及累加的倒排项数（postings_scored）、
+# 获得打分的候选文档数（candidates，至少出现一个查询词）、得分大于 0 的文档数和返回的文档数
+def ranked_retrieval(query, tf_idf_index, term_dictionary, emails, wildcard_index=None, profile=None):
+    started = time.perf_counter()
+    query_weights = build_query_weights(query, term_dictionary, wildcard_index)
+    query_norm = np.linalg.norm(list(query_weights.values())) if query_weights else 0.0
+    weighted = time.perf_counter()
+
+    term_ptr, docs, weights = tf_idf_index['term_ptr'], tf_idf_index['docs'], tf_idf_index['weights']
+    scores = np.zeros(tf_idf_index['num_docs'])
+    touched = np.zeros(tf_idf_index['num_docs'], dtype=bool) if profile is not None else None
+    num_postings = 0
+    for term, weight in query_weights.items():
+        lo, hi = term_ptr[term_dictionary[term]], term_ptr[term_dictionary[term] + 1]
+        scores[docs[lo:hi]] += weight * weights[lo:hi]
+        num_postings += hi - lo
+        if touched is not None:
+            touched[docs[lo:hi]] = True
+    scores /= tf_idf_index['doc_norms'] * query_norm + 1e-10  # 避免除零
+    scored = time.perf_counter()
+
+    # 按相似度降序排列（相似度相同时文档ID小的在前），去掉零分文档
+    matched = np.flatnonzero(scores > 0)
+    order = matched[np.argsort(-scores[matched], kind='stable')]
+    results = list(zip(order.tolist(), scores[order].tolist()))
+    if profile is not None:
+        profile.update(
+            terms=[{'term': term, 'weight': weight,
+                    'postings': int(term_ptr[term_dictionary[term] + 1] - term_ptr[term_dictionary[term]])}
+                   for term, weight in query_weights.items()],
+            steps=[
+                {'operator': '构建查询向量', 'result': len(query_weights), 'time_ms': (weighted - started) * 1000},
+                {'operator': '按词项累加 tf-idf 权重并计算余弦相似度', 'result': int(num_postings), 'time_ms': (scored - weighted) * 1000},
+                {'operator': '排序并去掉零分文档', 'result': len(results), 'time_ms': (time.perf_counter() - scored) * 1000},
+            ],
+            postings_scored=int(num_postings), candidates=int(np.count_nonzero(touched)), matched=len(results), returned=len(results),
+        )
+    return results
+
+# 构建量化影响分数索引：倒排表只保存文档ID（int32）和 8 位影响分数，取值范围为 [-127, 127]
+# （idf = log(N / (df + 1)) 对几乎出现在所有文档中的词项为负数，所以使用有符号整数）
+def build_impact_index(index, scale=IMPACT_SCALE):
+    term_ptr, docs, tfs = build_term_frequencies(index)
+    num_docs = len(index['token_ptr']) - 1
+    doc_freqs = np.diff(term_ptr)
+    weights = tfs * np.repeat(np.log(num_docs / (doc_freqs + 1)), doc_freqs)
+    doc_norms = np.sqrt(np.bincount(docs, weights=weights ** 2, minlength=num_docs))
+    impacts = weights / (doc_norms[docs] + 1e-10)
+
+    if scale == 'global':
+        scales = np.full(len(doc_freqs), np.abs(impacts).max(initial=0) / 127)
+    else:
+        scales = np.zeros(len(doc_freqs))
+        np.maximum.at(scales, np.repeat(np.arange(len(doc_freqs)), doc_freqs), np.abs(impacts) / 127)
+    scales = np.maximum(scales, 1e-12)
+    quantized = np.round(impacts / np.repeat(scales, doc_freqs)).astype(np.int8)
+    return {
+        'term_ptr': term_ptr,
+        'docs': docs,
+        'impacts': quantized,
+        'scales': scales,
+        'scale': scale,
+        'num_docs': num_docs,
+        'bytes': term_ptr.nbytes + docs.nbytes + quantized.nbytes + scales.nbytes,
+    }
+
+# 基于量化影响分数的排序检索：查询词权重乘以词项缩放系数后量化为整数，按词项逐个累加整数得分
+# 返回的相似度由整数得分换算回余弦相似度的近似值；传入 profile 时记录的内容与 ranked_retrieval 相同
+def quantized_ranked_retrieval(query, impact_index, term_dictionary, wildcard_index=None, profile=None):
+    started = time.perf_counter()
+    query_weights = build_query_weights(query, term_dictionary, wildcard_index)
+    term_ids = np.array([term_dictionary[term] for term in query_weights], dtype=np.int64)
+    effective_weights = np.array(list(query_weights.values())) * impact_index['scales'][term_ids]
+    query_scale = max(effective_weights.max(initial=0), 1e-30) / (2 ** (IMPACT_QUERY_BITS - 1) - 1)
+    query_ints = np.round(effective_weights / query_scale).astype(np.int64)
+    weighted = time.perf_counter()
+
+    term_ptr, docs, impacts = impact_index['term_ptr'], impact_index['docs'], impact_index['impacts']
+    scores = np.zeros(impact_index['num_docs'], dtype=np.int64)
+    touched = np.zeros(impact_index['num_docs'], dtype=bool) if profile is not None else None
+    num_postings = 0
+    for term_id, query_int in zip(term_ids.tolist(), query_ints.tolist()):
+        lo, hi = term_ptr[term_id], term_ptr[term_id + 1]
+        scores[docs[lo:hi]] += query_int * impacts[lo:hi].astype(np.int64)
+        num_postings += hi - lo
+        if touched is not None:
+            touched[docs[lo:hi]] = True
+    scored = time.perf_counter()
+
+    matched = np.flatnonzero(scores > 0)
+    order = matched[np.argsort(-scores[matched], kind='stable')]
+    similarity = scores[order] * (query_scale / (np.linalg.norm(list(query_weights.values())) + 1e-10))
+    results = list(zip(order.tolist(), similarity.tolist()))
+    if profile is not None:
+        profile.update(
+            terms=[{'term': term, 'weight': weight, 'postings': int(term_ptr[term_id + 1] - term_ptr[term_id])}
+                   for (term, weight), term_id in zip(query_weights.items(), term_ids.tolist())],
+            steps=[
+                {'operator': '构建并量化查询向量', 'result': len(query_weights), 'time_ms': (weighted - started) * 1000},
+                {'operator': '按词项累加整数影响分数', 'result': int(num_postings), 'time_ms': (scored - weighted) * 1000},
+                {'operator': '排序并去掉非正分文档', 'result': len(results), 'time_ms': (time.perf_counter() - scored) * 1000},
+            ],
+            postings_scored=int(num_postings), candidates=int(np.count_nonzero(touched)), matched=len(results), returned=len(results),
+        )
+    return results
+
+# 构建相似邮件检索的 LSH 索引：每封邮件的稀疏 tf-idf 单位向量（按文档排列，用于精确重排），
+# 以及 num_tables 组随机超平面签名；每组签名的位数按文档数取值，使每个桶平均约 LSH_BUCKET_SIZE 封邮件
+def build_lsh_index(index, num_tables=LSH_NUM_TABLES, seed=7):
+    term_ptr, docs, tfs = build_term_frequencies(index)
+    num_docs = len(index['token_ptr']) - 1
+    doc_freqs = np.diff(term_ptr)
+    posting_terms = np.repeat(np.arange(len(doc_freqs), dtype=np.int32), doc_freqs)
+    weights = tfs * np.repeat(np.log(num_docs / (doc_freqs + 1)), doc_freqs)
+    doc_norms = np.sqrt(np.bincount(docs, weights=weights ** 2, minlength=num_docs))
+    weights /= doc_norms[docs] + 1e-10
+
+    # 签名的每一位是文档向量在一个随机超平面法向量上投影的符号
+    bits = int(np.clip(np.round(np.log2(max(num_docs, 1) / LSH_BUCKET_SIZE)), 1, LSH_MAX_BITS))
+    rng = np.random.default_rng(seed)
+    keys = np.zeros((num_tables, num_docs), dtype=np.uint16)
+    for table in range(num_tables):
+        planes = rng.standard_normal((len(doc_freqs), bits)).astype(np.float32)
+        for bit in range(bits):
+            projection = np.bincount(docs, weights=weights * planes[posting_terms, bit], minlength=num_docs)
+            keys[table] |= (projection > 0).astype(np.uint16) << np.uint16(bit)
+    key_order = np.argsort(keys, axis=1, kind='stable').astype(np.int32)
+
+    order = np.argsort(docs, kind='stable')
+    doc_ptr = np.zeros(num_docs + 1, dtype=np.int64)
+    np.cumsum(np.bincount(docs, minlength=num_docs), out=doc_ptr[1:])
+    return {
+        'doc_ptr': doc_ptr,
+        'doc_terms': posting_terms[order],
+        'doc_weights': weights[order].astype(np.float32),
+        'keys': keys,
+        'key_order': key_order,
+        'sorted_keys': np.take_along_axis(keys, key_order, axis=1),
+        'bits': bits,
+        'num_docs': num_docs,
+        'num_terms': len(doc_freqs),
+    }
+
+# 相似邮件检索：以文档自身的 tf-idf 向量为查询，在每组签名中查找相差不超过 probe_radius 位的桶（多探针）得到候选，
+# 再按余弦相似度精确重排；传入 profile 时记录候选数和各阶段耗时
+def more_like_this(lsh_index, doc_id, top_k=MLT_TOP_K, probe_radius=LSH_PROBE_RADIUS, profile=None):
+    started = time.perf_counter()
+    doc_ptr, doc_terms, doc_weights = lsh_index['doc_ptr'], lsh_index['doc_terms'], lsh_index['doc_weights']
+    query_vector = np.zeros(lsh_index['num_terms'], dtype=np.float32)
+    query_vector[doc_terms[doc_ptr[doc_id]:doc_ptr[doc_id + 1]]] = doc_weights[doc_ptr[doc_id]:doc_ptr[doc_id + 1]]
+
+    probes = np.array([sum(1 << bit for bit in flipped) for radius in range(probe_radius + 1)
+                       for flipped in itertools.combinations(range(lsh_index['bits']), radius)], dtype=np.uint16)
+    buckets = []
+    for table in range(len(lsh_index['keys'])):
+        probe_keys = lsh_index['keys'][table, doc_id] ^ probes
+        los = np.searchsorted(lsh_index['sorted_keys'][table], probe_keys, side='left')
+        his = np.searchsorted(lsh_index['sorted_keys'][table], probe_keys, side='right')
+        buckets.extend(lsh_index['key_order'][table, lo:hi] for lo, hi in zip(los.tolist(), his.tolist()))
+    candidates = np.unique(np.concatenate(buckets))
+    candidates = candidates[candidates != doc_id]
+    probed = time.perf_counter()
+
+    # 精确重排：逐个候选文档的稀疏向量与查询向量求内积
+    starts = doc_ptr[candidates]
+    lengths = doc_ptr[candidates + 1] - starts
+    positions = np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+    scores = np.bincount(np.repeat(np.arange(len(candidates)), lengths),
+                         weights=query_vector[doc_terms[positions]] * doc_weights[positions], minlength=len(candidates))
+    order = np.argsort(-scores, kind='stable')[:top_k]
+    order = order[scores[order] > 0]
+    results = [(int(candidates[i]), float(scores[i])) for i in order]
+    if profile is not None:
+        profile.update(
+            steps=[
+                {'operator': f"{len(lsh_index['keys'])} 组 {lsh_index['bits']} 位签名多探针查找候选（{len(probes)} 个桶/组）", 'result': len(candidates),
+                 'time_ms': (probed - started) * 1000},
+                {'operator': '按余弦相似度精确重排', 'result': len(results), 'time_ms': (time.perf_counter() - probed) * 1000},
+            ],
+            postings_scored=int(lengths.sum()), candidates=len(candidates), matched=int(np.count_nonzero(scores > 0)), returned=len(results),
+        )
+    return results
+
+# 由词项偏移表统计每个 (词项, 文档) 的词频，按词项分组：返回 (词项起止指针, 文档ID, 词频)
+def build_term_frequencies(index):
+    token_ptr, token_terms = index['token_ptr'], index['token_terms']
+    num_docs = len(token_ptr) - 1
+    token_docs = np.repeat(np.arange(num_docs, dtype=np.int64), np.diff(token_ptr))
+    pairs, tfs = np.unique(token_terms.astype(np.int64) * max(num_docs, 1) + token_docs, return_counts=True)
+    pair_terms, pair_docs = np.divmod(pairs, max(num_docs, 1))
+    term_ptr = np.searchsorted(pair_terms, np.arange(len(index['terms']) + 1))
+    return term_ptr, pair_docs.astype(np.int32), tfs.astype(np.float64)
+
+# 分片工作进程：持有连续文档ID范围内邮件的索引，循环处理协调进程发来的查询
+# 先收到本分片的邮件和起始文档ID，建好索引后上报本分片的文档频率，收到全局 idf 后计算 tf-idf 权重和文档向量长度
+# 协调进程退出（连接关闭）时随之结束
+def shard_worker(conn):
+    try:
+        emails, email_paths, doc_offset = conn.recv()
+        index = build_index(emails, email_paths, dedup_mode='off', workers=0)
+        num_docs = len(emails)
+        term_ptr, docs, tfs = build_term_frequencies(index)
+        conn.send((index['terms'], np.diff(term_ptr)))
+        idf = conn.recv()
+    except (EOFError, OSError):
+        return
+    weights = tfs * np.repeat(idf, np.diff(term_ptr))
+    doc_norms = np.sqrt(np.bincount(docs, weights=weights ** 2, minlength=num_docs))
+
+    while True:
+        try:
+            message = conn.recv()
+        except (EOFError, OSError):
+            break
+        try:
+            if message[0] == 'boolean':
+                _, query, explain = message
+                positional_index = get_index_part(index, 'positional_index') if query_needs_positions(query) else None
+                wildcard_index = get_index_part(index, 'wildcard_index') if is_wildcard(query) else None
+                profile = {} if explain else None
+                results = parse_boolean_query_inverted(query, index['inverted_index'], num_docs, positional_index,
+                                                       wildcard_index, index['field_index'], profile)
+                conn.send(('ok', (np.asarray(results, dtype=np.int64) + doc_offset, profile)))
+            elif message[0] == 'ranked':
+                _, query_weights, query_norm, top_k = message
+                scores = np.zeros(num_docs)
+                touched = np.zeros(num_docs, dtype=bool)
+                term_postings = {}
+                for term, weight in query_weights.items():
+                    term_id = index['term_dictionary'].get(term)
+                    if term_id is not None:
+                        lo, hi = term_ptr[term_id], term_ptr[term_id + 1]
+                        scores[docs[lo:hi]] += weight * weights[lo:hi]
+                        touched[docs[lo:hi]] = True
+                        term_postings[term] = int(hi - lo)
+                scores /= doc_norms * query_norm + 1e-10
+                # 本分片的 top-k
+                candidates = np.flatnonzero(scores > 0)
+                num_matched = len(candidates)
+                if len(candidates) > top_k:
+                    candidates = candidates[np.argpartition(-scores[candidates], top_k - 1)[:top_k]]
+                conn.send(('ok', (candidates + doc_offset, scores[candidates], num_matched, term_postings, int(np.count_nonzero(touched)))))
+            else:
+                break
+        except ValueError as e:
+            conn.send(('error', str(e)))
+        except Exception as e:
+            # 其他异常也回复协调进程，避免协调进程一直等待
+            conn.send(('error', f"分片工作进程出错（文档ID从 {doc_offset} 起）：{type(e).__name__}: {e}"))
+
+# 启动文档ID范围 [lo, hi) 的分片工作进程，并把这段邮件发给它
+# 工作进程是通过本文件的命令行（python shiyan03.py shard <fd>）启动的新解释器，不从多线程的 Streamlit 服务进程 fork，
+# 也不像 multiprocessing 的 spawn/forkserver 那样在子进程中重新执行整个页面脚本；双方通过 socketpair 上的 Connection 通信
+def start_shard(emails, email_paths, lo, hi):
+    parent_socket, child_socket = socket.socketpair()
+    with parent_socket, child_socket:
+        process = subprocess.Popen([sys.executable, os.path.abspath(__file__), 'shard', str(child_socket.fileno())],
+                                   stdin=subprocess.DEVNULL, pass_fds=[child_socket.fileno()])
+        conn = multiprocessing.connection.Connection(parent_socket.detach())
+    shard = {'process': process, 'conn': conn, 'doc_range': (int(lo), int(hi))}
+    try:
+        conn.send((emails[lo:hi], email_paths[lo:hi], int(lo)))
+    except OSError:
+        pass  # 工作进程已退出，由 receive_shard_stats 报告
+    return shard
+
+# 等待分片工作进程建好索引并上报词项和文档频率；工作进程启动失败、退出或超时时结束它并抛出 ValueError
+def receive_shard_stats(shard, timeout=SHARD_START_TIMEOUT):
+    try:
+        if not shard['conn'].poll(timeout):
+            raise TimeoutError
+        return shard['conn'].recv()
+    except (EOFError, OSError, TimeoutError):
+        stop_shard(shard)
+        lo, hi = shard['doc_range']
+        raise ValueError(f"文档ID {lo}..{hi - 1} 的分片工作进程启动失败（已退出或超过 {timeout:.0f} 秒没有就绪），"
+                         f"请关闭分片检索后重试") from None
+
+# 结束一个分片工作进程并关闭连接
+def stop_shard(shard):
+    try:
+        shard['process'].kill()
+        shard['process'].wait(timeout=5)
+    except (OSError, subprocess.TimeoutExpired):
+        pass
+    shard['conn'].close()
+
+# 按全局文档频率计算分片词项的 idf
+def shard_idf(terms, global_df, num_docs):
+    return np.log(num_docs / (np.array([global_df[term] for term in terms], dtype=np.float64) + 1))
+
+# 启动分片工作进程：按文档ID范围把邮件平均分成 num_shards 段，并汇总全局 idf 发给各分片
+# 每个分片有自己的锁，不同会话的查询可以在不同分片上交错执行；任何一个分片启动失败时结束所有分片并抛出 ValueError
+def start_shard_workers(emails, email_paths, num_shards):
+    bounds = np.linspace(0, len(emails), num_shards + 1).astype(int)
+    shards = []
+    try:
+        for lo, hi in zip(bounds[:-1], bounds[1:]):
+            shards.append(start_shard(emails, email_paths, lo, hi))
+        shard_stats = [receive_shard_stats(shard) for shard in shards]
+        global_df = defaultdict(int)
+        for terms, doc_freqs in shard_stats:
+            for term, doc_freq in zip(terms, doc_freqs.tolist()):
+                global_df[term] += doc_freq
+        for shard, (terms, _) in zip(shards, shard_stats):
+            shard['conn'].send(shard_idf(terms, global_df, len(emails)))
+    except (ValueError, OSError) as e:
+        for shard in shards:
+            stop_shard(shard)
+        raise ValueError(str(e)) from None
+    # 保留邮件和全局文档频率，用于重新启动退出或无响应的分片
+    return {'shards': shards, 'locks': [threading.Lock() for _ in shards], 'num_docs': len(emails),
+            'emails': emails, 'email_paths': email_paths, 'global_df': global_df}
+
+# 重新启动一个分片（调用方持有该分片的锁）：结束原工作进程，用同一文档范围和全局 idf 启动新的工作进程
+# 启动失败时保留已关闭的连接，下一次查询发送失败后会再次重新启动
+def restart_shard(sharded_index, shard_id):
+    shard = sharded_index['shards'][shard_id]
+    stop_shard(shard)
+    new_shard = start_shard(sharded_index['emails'], sharded_index['email_paths'], *shard['doc_range'])
+    terms, _ = receive_shard_stats(new_shard)
+    try:
+        new_shard['conn'].send(shard_idf(terms, sharded_index['global_df'], sharded_index['num_docs']))
+    except OSError:
+        stop_shard(new_shard)
+        return
+    sharded_index['shards'][shard_id] = new_shard
+
+# 停止分片工作进程
+def stop_shard_workers(sharded_index):
+    for shard_id, lock in enumerate(sharded_index['locks']):
+        with lock:
+            shard = sharded_index['shards'][shard_id]
+            try:
+                shard['conn'].send(('stop',))
+                shard['process'].wait(timeout=5)
+            except (OSError, subprocess.TimeoutExpired):
+                pass
+            stop_shard(shard)
+
+# 把同一请求发给所有分片并行执行，再按分片顺序收集结果
+# 按分片顺序获取各分片的锁后发出请求，每收到一个分片的回复就释放该分片的锁，其他会话的查询随即可以使用这个分片
+# 分片在 timeout 秒内没有回复或工作进程已退出时，重新启动这些分片，并报告查询失败
+def scatter_gather(sharded_index, message, timeout=SHARD_REPLY_TIMEOUT):
+    shards, locks = sharded_index['shards'], sharded_index['locks']
+    for lock in locks:
+        lock.acquire()
+    failed, replies = [], []
+    held = list(range(len(locks)))
+    try:
+        for shard_id in held:
+            try:
+                shards[shard_id]['conn'].send(message)
+            except OSError:
+                failed.append(shard_id)
+        deadline = time.monotonic() + timeout
+        while held:
+            shard_id = held[0]
+            if shard_id not in failed:
+                conn = shards[shard_id]['conn']
+                try:
+                    if not conn.poll(max(deadline - time.monotonic(), 0)):
+                        raise TimeoutError
+                    replies.append(conn.recv())
+                except (EOFError, OSError, TimeoutError):
+                    failed.append(shard_id)
+            if shard_id in failed:
+                try:
+                    restart_shard(sharded_index, shard_id)
+                except ValueError:
+                    pass
+            locks[held.pop(0)].release()
+    finally:
+        for shard_id in held:
+            locks[shard_id].release()
+    if failed:
+        raise ValueError(f"分片 {', '.join(map(str, failed))} 的工作进程已退出或超过 {timeout:.0f} 秒没有回复，已重新启动，请重试")
+    for status, payload in replies:
+        if status == 'error':
+            raise ValueError(payload)
+    return [payload for _, payload in replies]
+
+# 分片布尔检索：各分片结果按文档ID范围顺序拼接，执行计划中的每一步按分片分别记录
+def sharded_boolean_query(sharded_index, query, profile=None):
+    replies = scatter_gather(sharded_index, ('boolean', query, profile is not None))
+    if profile is not None:
+        profile.update(tree=replies[0][1]['tree'], steps=[dict(step, shard=shard_id) for shard_id, (_, shard_profile) in enumerate(replies)
+                                                          for step in shard_profile['steps']])
+    return np.concatenate([docs for docs, _ in replies]).tolist()
+
+# 分片排序检索：各分片用全局 idf 计算本分片 top-k，再合并为全局 top-k
+def sharded_ranked_retrieval(sharded_index, query, term_dictionary, wildcard_index=None, top_k=RANKED_TOP_K, profile=None):
+    started = time.perf_counter()
+    query_weights = build_query_weights(query, term_dictionary, wildcard_index)
+    query_norm = np.linalg.norm(list(query_weights.values())) if query_weights else 0.0
+    weighted = time.perf_counter()
+    replies = scatter_gather(sharded_index, ('ranked', query_weights, query_norm, top_k))
+    scored = time.perf_counter()
+    doc_ids = np.concatenate([reply[0] for reply in replies])
+    scores = np.concatenate([reply[1] for reply in replies])
+    order = np.argsort(-scores, kind='stable')[:top_k]
+    if profile is not None:
+        num_matched = sum(reply[2] for reply in replies)
+        profile.update(
+            terms=[{'term': term, 'weight': weight, 'postings': sum(reply[3].get(term, 0) for reply in replies)}
+                   for term, weight in query_weights.items()],
+            steps=[
+                {'operator': '构建查询向量', 'result': len(query_weights), 'time_ms': (weighted - started) * 1000},
+                {'operator': f'{len(replies)} 个分片打分并各取前 {top_k} 个', 'result': len(doc_ids), 'time_ms': (scored - weighted) * 1000},
+                {'operator': f'合并为全局前 {top_k} 个', 'result': len(order), 'time_ms': (time.perf_counter() - scored) * 1000},
+            ],
+            postings_scored=sum(sum(reply[3].values()) for reply in replies), candidates=sum(reply[4] for reply in replies),
+            matched=num_matched, returned=len(order),
+        )
+    return [(doc_ids[i], scores[i]) for i in order]
+
+# 单个非负整数的 varint 编码
+def encode_varint(value):
+    data = bytearray()
+    while value >= 0x80:
+        data.append(value & 0x7f | 0x80)
+        value >>= 7
+    data.append(value)
+    return bytes(data)
+
+# 将内存中的倒排表按词项排序后写成一个临时分段，文档ID差分按批做 varint 编码（每批约 SPIMI_FLUSH_BATCH 个倒排项，控制临时数组大小）
+# 每条记录为 (词项字节数, 倒排字节数, 文档数, 首个文档ID, 末个文档ID, 词项, 其余文档ID差分的 varint 编码)
+def write_spimi_run(postings, run_path, batch_size=SPIMI_FLUSH_BATCH):
+    terms = sorted(postings)
+    with open(run_path, 'wb') as f:
+        batch_start = 0
+        while batch_start < len(terms):
+            batch_end, batch_postings = batch_start, 0
+            while batch_end < len(terms) and (batch_end == batch_start or batch_postings + len(postings[terms[batch_end]]) <= batch_size):
+                batch_postings += len(postings[terms[batch_end]])
+                batch_end += 1
+            batch_terms = terms[batch_start:batch_end]
+
+            docs = array('i')
+            for term in batch_terms:
+                docs.extend(postings[term])
+            docs = np.frombuffer(docs, dtype=np.int32).astype(np.int64)
+            ptr = np.zeros(len(batch_terms) + 1, dtype=np.int64)
+            np.cumsum([len(postings[term]) for term in batch_terms], out=ptr[1:])
+            gaps = np.diff(docs, prepend=0)
+            gaps[ptr[:-1]] = 0  # 各词项的首个文档ID单独记录
+            data, byte_starts = encode_varints(gaps)
+            data = data.tobytes()
+            records = zip(batch_terms, np.diff(ptr).tolist(), docs[ptr[:-1]].tolist(), docs[ptr[1:] - 1].tolist(),
+                          byte_starts[ptr[:-1] + 1].tolist(), byte_starts[ptr[1:]].tolist())
+            for term, count, first_doc, last_doc, body_start, body_end in records:
+                term_bytes = term.encode('utf-8')
+                f.write(struct.pack('<HIIii', len(term_bytes), body_end - body_start, count, first_doc, last_doc))
+                f.write(term_bytes)
+                f.write(data[body_start:body_end])
+            batch_start = batch_end
+    return run_path
+
+# 顺序读取临时分段，生成 (词项, 文档数, 首个文档ID, 末个文档ID, 其余文档ID差分的 varint 编码)
+def read_spimi_run(run_path):
+    with open(run_path, 'rb') as f:
+        while True:
+            header = f.read(18)
+            if not header:
+                return
+            term_length, body_length, count, first_doc, last_doc = struct.unpack('<HIIii', header)
+            yield f.read(term_length).decode('utf-8'), count, first_doc, last_doc, f.read(body_length)
+
+# k 路归并各临时分段，写出最终的外存索引
+# postings.bin 依次存放各词项的 varint 倒排表（首个文档ID，其后为差分），lexicon.npz 存放词项词典、倒排表偏移和文档频率
+def merge_spimi_runs(run_paths, segment_dir):
+    terms, offsets, doc_freqs = [], [0], []
+    # 词项相同时 heapq.merge 按分段顺序输出，前面分段的文档ID更小，
+    # 拼接时只需把后一段的首个文档ID改写为与前一段末个文档ID的差分
+    merged = heapq.merge(*[read_spimi_run(run_path) for run_path in run_paths], key=lambda item: item[0])
+    with open(os.path.join(segment_dir, 'postings.bin'), 'wb') as f:
+        for term, group in itertools.groupby(merged, key=lambda item: item[0]):
+            data = bytearray()
+            doc_freq, last_doc = 0, 0
+            for _, count, first_doc, run_last_doc, body in group:
+                data += encode_varint(first_doc - last_doc)
+                data += body
+                doc_freq += count
+                last_doc = run_last_doc
+            f.write(data)
+            terms.append(term)
+            offsets.append(offsets[-1] + len(data))
+            doc_freqs.append(doc_freq)
+    np.savez(os.path.join(segment_dir, 'lexicon.npz'),
+             terms=np.frombuffer("\n".join(terms).encode('utf-8'), dtype=np.uint8),
+             offsets=np.array(offsets, dtype=np.int64),
+             doc_freqs=np.array(doc_freqs, dtype=np.int32),
+             num_runs=len(run_paths),
+             settings=json.dumps(index_settings()))
+
+# 外存索引构建（SPIMI）：逐封读取邮件，在内存中累积倒排表
+# 估算占用达到 memory_budget 时排序写出一个临时分段，最后把所有临时分段归并为一个外存索引
+# 新索引先写到 segment_dir 旁边的临时目录，完成后再替换 segment_dir：其他会话仍在内存映射的旧倒排表文件不会被截断改写，
+# 旧文件移走删除后映射依然有效，直到旧索引不再使用；在后台任务中构建时汇报进度，任务被取消时抛出 InterruptedError
+def build_spimi_segment(directory, segment_dir, memory_budget=SPIMI_MEMORY_BUDGET, mime_aware=MIME_AWARE_PARSING, job=None):
+    segment_dir = os.path.abspath(segment_dir)
+    parent_dir, segment_name = os.path.split(segment_dir)
+    build_dir = tempfile.mkdtemp(dir=parent_dir, prefix=segment_name + '.building-')
+    run_dir = os.path.join(build_dir, 'runs')
+    os.makedirs(run_dir)
+    run_paths = []
+    postings, memory_used, num_docs = {}, 0, 0
+    if job is not None:
+        total_files = sum(len(files) for _, _, files in os.walk(directory))
+        report_index_build(job, stage='读取邮件', stage_started=time.time(), total_files=total_files)
+    try:
+        with open(os.path.join(build_dir, 'doc_paths.txt'), 'w', encoding='utf-8') as path_file:
+            for file_path, text in iter_email_files(directory, mime_aware, job):
+                for term in set(preprocess_text(text)):
+                    docs = postings.get(term)
+                    if docs is None:
+                        docs = postings[term] = array('i')
+                        memory_used += SPIMI_TERM_OVERHEAD + len(term)
+                    docs.append(num_docs)
+                    memory_used += 4
+                path_file.write(file_path + "\n")
+                num_docs += 1
+                if memory_used >= memory_budget:
+                    run_paths.append(write_spimi_run(postings, os.path.join(run_dir, f"run{len(run_paths)}.bin")))
+                    postings, memory_used = {}, 0
+        if postings or not run_paths:
+            run_paths.append(write_spimi_run(postings, os.path.join(run_dir, f"run{len(run_paths)}.bin")))
+        if job is not None:
+            report_index_build(job, stage='归并临时分段', stage_started=time.time(), num_docs=num_docs)
+        merge_spimi_runs(run_paths, build_dir)
+        shutil.rmtree(run_dir)
+        # 非空目录不能直接被 os.replace 覆盖：先把旧索引目录改名移开，再把新目录换到原位置
+        old_dir = None
+        if os.path.exists(segment_dir):
+            old_dir = tempfile.mkdtemp(dir=parent_dir, prefix=segment_name + '.old-')
+            os.replace(segment_dir, old_dir)
+        os.replace(build_dir, segment_dir)
+        if old_dir is not None:
+            shutil.rmtree(old_dir, ignore_errors=True)
+    finally:
+        shutil.rmtree(build_dir, ignore_errors=True)
+    return open_segment(segment_dir)
+
+# 替换外存索引目录要改名两次，两次之间进程退出时原位置没有索引目录：把移开的旧索引目录改回原位置
+# 并删除退出时残留的其他旧目录和未完成的构建目录；调用方持有该数据集的锁
+def restore_segment_dir(segment_dir):
+    old_dirs = sorted(glob.glob(glob.escape(segment_dir) + '.old-*'), key=os.path.getmtime)
+    if old_dirs and not os.path.exists(segment_dir):
+        os.replace(old_dirs.pop(), segment_dir)
+    for leftover_dir in old_dirs + glob.glob(glob.escape(segment_dir) + '.building-*'):
+        shutil.rmtree(leftover_dir, ignore_errors=True)
+
+# 外存索引构建时的分析设置（没有记录时返回空字典）
+def segment_settings(segment_dir):
+    with np.load(os.path.join(segment_dir, 'lexicon.npz')) as lexicon:
+        return json.loads(str(lexicon['settings'])) if 'settings' in lexicon.files else {}
+
+# 打开外存索引：词项词典和文档路径读入内存，倒排表文件以内存映射方式按需读取
+def open_segment(segment_dir):
+    lexicon = np.load(os.path.join(segment_dir, 'lexicon.npz'))
+    terms_blob = lexicon['terms'].tobytes().decode('utf-8')
+    terms = terms_blob.split("\n") if terms_blob else []
+    with open(os.path.join(segment_dir, 'doc_paths.txt'), 'r', encoding='utf-8') as f:
+        email_paths = tuple(f.read().splitlines())
+    postings_path = os.path.join(segment_dir, 'postings.bin')
+    data = np.memmap(postings_path, dtype=np.uint8, mode='r') if os.path.getsize(postings_path) else np.zeros(0, dtype=np.uint8)
+    return {
+        'terms': terms,
+        'term_dictionary': {term: i for i, term in enumerate(terms)},
+        'offsets': lexicon['offsets'],
+        'doc_freqs': lexicon['doc_freqs'],
+        'num_runs': int(lexicon['num_runs']),
+        'data': data,
+        'email_paths': email_paths,
+        'num_docs': len(email_paths),
+        'lock': threading.Lock(),
+    }
+
+# 读取外存索引中词项的倒排表（文档ID数组）
+def segment_postings(segment, term):
+    term_id = segment['term_dictionary'].get(term)
+    if term_id is None:
+        return np.zeros(0, dtype=np.int64)
+    offsets = segment['offsets']
+    return np.cumsum(decode_varints(segment['data'][offsets[term_id]:offsets[term_id + 1]]))
+
+# 解析布尔查询（外存索引），只支持词项、通配符和 AND/OR/NOT
+def parse_boolean_query_segment(query, segment, wildcard_index=None, profile=None):
+    num_docs = segment['num_docs']
+
+    def operand_bitmap(operand):
+        check_wildcard_operand(operand)
+        if operand[0] == 'phrase' and len(operand[1]) > 1:
+            # 外存索引没有位置信息，无法校验多个词项是否相邻，不能按短语匹配
+            raise ValueError("外存索引没有位置信息，不支持多词短语（包括三个字以上的中文词）查询，请改用 AND 连接各词项")
+        if operand[0] not in ['term', 'any', 'phrase']:
+            raise ValueError("外存索引只支持词项、单个词项的短语和通配符查询")
+        bitmap = np.zeros(num_docs, dtype=bool)
+        for term in (operand[1] if operand[0] in ['any', 'phrase'] else [operand[1]]):
+            bitmap[segment_postings(segment, term)] = True
+        return bitmap
+
+    return combine_boolean_results(parse_query_operands(query, wildcard_index), operand_bitmap, num_docs, not_from_all=False, profile=profile)
+
+# 操作数中包含的所有词项
+def operand_terms(operand):
+    if operand[0] == 'term':
+        return [operand[1]]
+    if operand[0] in ['phrase', 'any']:
+        return list(operand[1])
+    if operand[0] == 'wildcard':
+        return []
+    if operand[0] == 'field':
+        return preprocess_text(operand[2]) if operand[1] != 'date' else []
+    return operand_terms(operand[1]) + operand_terms(operand[2])
+
+# 提取布尔查询中需要高亮的词项（NOT 之后的词项不高亮）
+def get_query_terms(query, wildcard_index=None):
+    query_terms = []
+    current_op = 'AND'
+    for item in parse_query_operands(query, wildcard_index):
+        if item in ['AND', 'OR', 'NOT']:
+            current_op = item
+        elif current_op != 'NOT':
+            query_terms.extend(operand_terms(item))
+    return query_terms
+
+# 转义摘要文本中的 HTML 字符，并把换行等连续空白压缩为一个空格
+def escape_snippet_text(text):
+    return re.sub(r'\s+', ' ', html.escape(text))
+
+# 根据索引中存储的词项偏移生成摘要：选出命中查询词最多的若干窗口并高亮，不重新扫描全文
+def generate_snippet(index, doc_id, query_terms, max_windows=SNIPPET_MAX_WINDOWS, window_size=SNIPPET_WINDOW_TOKENS):
+    email = index['emails'][doc_id]
+    lo, hi = index['token_ptr'][doc_id], index['token_ptr'][doc_id + 1]
+    term_ids = [index['term_dictionary'][term] for term in query_terms if term in index['term_dictionary']]
+    hits = np.flatnonzero(np.isin(index['token_terms'][lo:hi], term_ids))
+    if len(hits) == 0:
+        preview = email[:SNIPPET_FALLBACK_CHARS]
+        return escape_snippet_text(preview) + (" …" if len(email) > len(preview) else "")
+
+    # 以每个命中位置为窗口起点，统计窗口内的命中数，贪心选择互不重叠的最佳窗口
+    hit_counts = np.searchsorted(hits, hits + window_size) - np.arange(len(hits))
+    windows = []
+    for i in np.argsort(-hit_counts, kind='stable'):
+        start = hits[i]
+        if all(start >= end or start + window_size <= begin for begin, end in windows):
+            windows.append((start, start + window_size))
+            if len(windows) == max_windows:
+                break
+
+    starts, ends = index['token_starts'][lo:hi], index['token_ends'][lo:hi]
+    fragments = []
+    for begin, end in sorted(windows):
+        first = max(begin - SNIPPET_CONTEXT_TOKENS, 0)
+        last = min(end, hi - lo) - 1
+        window_hits = hits[(hits >= begin) & (hits < end)]
+        # 重叠的命中（如相邻的中文二元组）合并为一段高亮
+        spans = []
+        for pos in window_hits:
+            if spans and starts[pos] < spans[-1][1]:
+                spans[-1][1] = max(spans[-1][1], ends[pos])
+            else:
+                spans.append([starts[pos], ends[pos]])
+        pieces = []
+        cursor = starts[first]
+        for start, end in spans:
+            pieces.append(escape_snippet_text(email[cursor:start]))
+            pieces.append(f"<mark>{escape_snippet_text(email[start:end])}</mark>")
+            cursor = end
+        pieces.append(escape_snippet_text(email[cursor:ends[last]]))
+        fragments.append("".join(pieces))
+    return " … ".join(fragments)
+
+# 将文档ID数组转换为按位压缩的位图（每字节 8 个文档）
+def pack_bitmap(docs, num_docs):
+    bitmap = np.zeros(num_docs, dtype=bool)
+    bitmap[docs] = True
+    return np.packbits(bitmap)
+
+# 构建分面索引：顶层文件夹（相对于所有邮件的公共目录）、发件人域名和月份（UTC）
+# 每个分面取文档数最多的 max_values 个取值，每个取值对应一行压缩位图
+def build_facet_index(index, max_values=FACET_MAX_VALUES):
+    email_paths = index['email_paths']
+    field_index = index['field_index']
+    num_docs = len(email_paths)
+
+    value_docs = {name: defaultdict(list) for name in FACET_NAMES}
+    root = os.path.commonpath([os.path.dirname(path) for path in email_paths]) if email_paths else ''
+    for doc_id, path in enumerate(email_paths):
+        parts = os.path.relpath(path, root).split(os.sep)
+        value_docs['folder'][parts[0] if len(parts) > 1 else '(根目录)'].append(doc_id)
+    for term, docs in field_index['postings']['from'].items():
+        if '@' in term:
+            value_docs['sender_domain'][term.rsplit('@', 1)[1]].extend(docs.tolist())
+    months = field_index['date_values'].astype(np.int64).astype('datetime64[s]').astype('datetime64[M]').astype(str)
+    for month, doc_id in zip(months.tolist(), field_index['date_docs'].tolist()):
+        value_docs['month'][month].append(doc_id)
+
+    facets = {}
+    for name, docs_by_value in value_docs.items():
+        docs_by_value = {value: np.unique(docs) for value, docs in docs_by_value.items()}
+        values = sorted(docs_by_value, key=lambda value: (-len(docs_by_value[value]), value))[:max_values]
+        if name == 'month':
+            values.sort()
+        bitmaps = np.zeros((len(values), (num_docs + 7) // 8), dtype=np.uint8)
+        for i, value in enumerate(values):
+            bitmaps[i] = pack_bitmap(docs_by_value[value], num_docs)
+        facets[name] = {'values': values, 'bitmaps': bitmaps}
+    return {'num_docs': num_docs, 'facets': facets}
+
+# 计算分面统计并筛选检索结果：selections 为 {分面: [取值序号]}，同一分面内取并集，不同分面之间取交集
+# 每个分面的计数是结果位图（按其他分面的选择筛选后）与各取值位图按位与后的 1 的个数
+# 返回检索结果中保留项的布尔掩码（保持原有排序）和 {分面: 各取值计数}
+def facet_counts(facet_index, results, selections):
+    num_docs = facet_index['num_docs']
+    facets = facet_index['facets']
+    result_bits = pack_bitmap(results, num_docs)
+    selection_bits = {name: np.bitwise_or.reduce(facets[name]['bitmaps'][list(selected)], axis=0)
+                      for name, selected in selections.items() if selected}
+
+    counts = {}
+    for name, facet in facets.items():
+        bits = result_bits.copy()
+        for other, other_bits in selection_bits.items():
+            if other != name:
+                bits &= other_bits
+        counts[name] = np.bitwise_count(facet['bitmaps'] & bits).sum(axis=1)
+
+    for other_bits in selection_bits.values():
+        result_bits &= other_bits
+    keep = np.unpackbits(result_bits, count=num_docs).view(bool)[results]
+    return keep, counts
+
+# 取出某一页的检索结果（页码从 1 开始），只物化当前页
+def paginate(results, page, page_size):
+    start = (page - 1) * page_size
+    return results[start:start + page_size]
+
+# 将检索结果分批编码写入字节缓冲区并生成 CSV，不在内存中构造整张表
+# 返回 BytesIO（st.download_button 的延迟数据只接受 bytes、BytesIO 等类型，不接受临时文件对象）
+def export_results_csv(results, email_paths, scores=None, chunk_size=CSV_EXPORT_CHUNK_SIZE):
+    buffer = io.BytesIO()
+    writer = io.TextIOWrapper(buffer, encoding='utf-8-sig', newline='')
+    csv_writer = csv.writer(writer)
+    csv_writer.writerow(["文档ID", "相似度", "文档路径"] if scores is not None else ["文档ID", "文档路径"])
+    for start in range(0, len(results), chunk_size):
+        chunk = results[start:start + chunk_size]
+        if scores is not None:
+            chunk_scores = scores[start:start + chunk_size]
+            csv_writer.writerows((doc_id, f"{score:.6f}", email_paths[doc_id]) for doc_id, score in zip(chunk, chunk_scores))
+        else:
+            csv_writer.writerows((doc_id, email_paths[doc_id]) for doc_id in chunk)
+    writer.flush()
+    writer.detach()
+    buffer.seek(0)
+    return buffer
+
+# 在有序词项词典中二分查找以 prefix 开头的词项ID区间 [lo, hi)
+def term_prefix_range(terms, prefix):
+    prefix = prefix.strip().lower()
+    if not prefix:
+        return 0, len(terms)
+    return bisect.bisect_left(terms, prefix), bisect.bisect_left(terms, prefix + '\U0010ffff')
+
+# 词项浏览：取以 prefix 开头的词项中某一页的词项ID，按字典序或文档频率从高到低排列
+def browse_terms(index, prefix, page, page_size, by_doc_freq=False):
+    lo, hi = term_prefix_range(index['terms'], prefix)
+    if by_doc_freq:
+        doc_freq_order = get_index_part(index, 'doc_freq_order')
+        term_ids = doc_freq_order[(doc_freq_order >= lo) & (doc_freq_order < hi)] if hi - lo < len(doc_freq_order) else doc_freq_order
+        return paginate(term_ids, page, page_size)
+    start = lo + (page - 1) * page_size
+    return np.arange(start, min(start + page_size, hi))
+
+# 将倒排索引分批编码写入字节缓冲区并生成 CSV（每行一个词项及其文档ID列表），与 export_results_csv 一样返回 BytesIO
+def export_inverted_index_csv(index, chunk_size=CSV_EXPORT_CHUNK_SIZE):
+    buffer = io.BytesIO()
+    writer = io.TextIOWrapper(buffer, encoding='utf-8-sig', newline='')
+    csv_writer = csv.writer(writer)
+    csv_writer.writerow(["Term", "Document IDs"])
+    terms, inverted_index = index['terms'], index['inverted_index']
+    for start in range(0, len(terms), chunk_size):
+        csv_writer.writerows((term, ",".join(map(str, sorted(inverted_index[term]))))
+                             for term in terms[start:start + chunk_size])
+    writer.flush()
+    writer.detach()
+    buffer.seek(0)
+    return buffer
+
+# 将索引整理为三张列式表：
+# terms（词项、文档频率、idf、倒排表起点）、postings（按词项分组的文档ID、词频、tf-idf 权重）、documents（文档路径、词数、日期等）
+def build_index_tables(index):
+    term_ptr, docs, tfs = build_term_frequencies(index)
+    num_docs = len(index['email_paths'])
+    doc_freqs = np.diff(term_ptr)
+    idf = np.log(num_docs / (doc_freqs + 1))  # 与 calculate_tf_idf 一致
+    doc_dates = index['field_index']['doc_dates']
+    missing_dates = np.isnan(doc_dates)
+    documents = {
+        'doc_id': np.arange(num_docs, dtype=np.int32),
+        'path': pa.array(list(index['email_paths']), pa.string()),
+        'num_tokens': np.diff(index['token_ptr']).astype(np.int32),
+        'date': pa.array(np.where(missing_dates, 0, doc_dates).astype(np.int64), pa.timestamp('s', tz='UTC'), mask=missing_dates),
+    }
+    if 'duplicate_of' in index:
+        documents['duplicate_of'] = index['duplicate_of'].astype(np.int32)
+    return {
+        'terms': pa.table({
+            'term': pa.array(index['terms'], pa.string()),
+            'doc_freq': doc_freqs.astype(np.int32),
+            'idf': idf,
+            'postings_start': term_ptr[:-1].astype(np.int64),
+        }),
+        'postings': pa.table({
+            'doc_id': docs,
+            'tf': tfs.astype(np.int32),
+            'tf_idf': tfs * np.repeat(idf, doc_freqs),
+        }),
+        'documents': pa.table(documents),
+    }
+
+# 导出索引表：file_format 为 'arrow'（未压缩的 Arrow IPC 文件，可内存映射零拷贝读取）或 'parquet'
+def export_index_tables(index, directory, file_format='arrow'):
+    os.makedirs(directory, exist_ok=True)
+    paths = []
+    for name, table in build_index_tables(index).items():
+        path = os.path.join(directory, f"{name}.{file_format}")
+        if file_format == 'parquet':
+            pq.write_table(table, path)
+        else:
+            with pa.OSFile(path, 'wb') as sink, pa.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+        paths.append(path)
+    return paths
+
+# 将索引表打包为 zip 文件，在点击下载时才生成；返回 BytesIO，供 st.download_button 的延迟数据使用
+def export_index_archive(index, file_format='arrow'):
+    buffer = io.BytesIO()
+    with tempfile.TemporaryDirectory() as directory, zipfile.ZipFile(buffer, 'w') as archive:
+        for path in export_index_tables(index, directory, file_format):
+            archive.write(path, os.path.basename(path))
+    buffer.seek(0)
+    return buffer
+
+# 取出列的 numpy 视图（数值列单块且无空值时不复制）
+def arrow_column_numpy(table, name):
+    column = table.column(name)
+    if column.num_chunks == 1:
+        return column.chunk(0).to_numpy(zero_copy_only=column.null_count == 0 and pa.types.is_primitive(column.type))
+    return column.to_numpy()
+
+# 读取导出的索引表：优先以内存映射方式打开 Arrow IPC 文件（零拷贝），否则读取 Parquet 文件
+# 返回各表以及词项词典、倒排表偏移、文档ID、词频和 tf-idf 权重的 numpy 视图
+def load_index_tables(directory):
+    tables = {}
+    for name in ['terms', 'postings', 'documents']:
+        arrow_path = os.path.join(directory, f"{name}.arrow")
+        if os.path.exists(arrow_path):
+            tables[name] = pa.ipc.open_file(pa.memory_map(arrow_path, 'r')).read_all()
+        else:
+            tables[name] = pq.read_table(os.path.join(directory, f"{name}.parquet"), memory_map=True)
+    terms = tables['terms'].column('term').to_pylist()
+    return {
+        'tables': tables,
+        'terms': terms,
+        'term_dictionary': {term: i for i, term in enumerate(terms)},
+        'term_ptr': np.append(arrow_column_numpy(tables['terms'], 'postings_start'), tables['postings'].num_rows),
+        'docs': arrow_column_numpy(tables['postings'], 'doc_id'),
+        'tfs': arrow_column_numpy(tables['postings'], 'tf'),
+        'weights': arrow_column_numpy(tables['postings'], 'tf_idf'),
+        'email_paths': tables['documents'].column('path').to_pylist(),
+    }
+
+# 读取 TREC 格式的相关性判断（qrels）：每行 "查询ID 迭代号 文档编号 相关度"，返回 {查询ID: {文档编号: 相关度}}
+def load_qrels(text):
+    qrels = defaultdict(dict)
+    for line in text.splitlines():
+        fields = line.split()
+        if len(fields) == 4:
+            qrels[fields[0]][fields[2]] = int(fields[3])
+    return dict(qrels)
+
+# 读取查询文件：每行 "查询ID<Tab>查询内容"，返回 {查询ID: 查询内容}
+def load_queries(text):
+    queries = {}
+    for line in text.splitlines():
+        fields = line.strip().split(None, 1)
+        if len(fields) == 2:
+            queries[fields[0]] = fields[1]
+    return queries
+
+# 计算一次检索的评价指标：retrieved 为按排名排列的文档ID，grades 为各文档ID的相关度，
+# relevant_grades 为该查询所有相关文档（含不在数据集中的文档）的相关度
+def evaluate_ranking(retrieved, grades, relevant_grades, k=EVAL_CUTOFF):
+    retrieved_grades = grades[np.asarray(retrieved, dtype=np.int64)]
+    relevant = retrieved_grades > 0
+    hits = np.cumsum(relevant)
+    num_retrieved, num_relevant = len(retrieved_grades), len(relevant_grades)
+    num_hits = hits[-1] if num_retrieved else 0
+
+    precision = num_hits / num_retrieved if num_retrieved else 0.0
+    recall = num_hits / num_relevant
+    discounts = 1 / np.log2(np.arange(2, k + 2))
+    ideal_grades = np.sort(relevant_grades)[::-1][:k]
+    ideal_dcg = ((2.0 ** ideal_grades - 1) * discounts[:len(ideal_grades)]).sum()
+    dcg = ((2.0 ** retrieved_grades[:k] - 1) * discounts[:min(k, num_retrieved)]).sum()
+    return {
+        'P@k': hits[min(k, num_retrieved) - 1] / k if num_retrieved else 0.0,
+        'R': recall,
+        'F1': 2 * precision * recall / (precision + recall) if precision + recall > 0 else 0.0,
+        'AP': (hits[relevant] / (np.flatnonzero(relevant) + 1)).sum() / num_relevant,
+        'nDCG@k': dcg / ideal_dcg,
+    }
+
+# 文档关联矩阵的估算大小（字节）
+def term_doc_matrix_bytes(index):
+    return len(index['terms']) * len(index['emails']) * np.dtype(int).itemsize
+
+# 批量评价：用 qrels 中有相关文档的每个查询分别运行 engines 中的检索方式（EVAL_ENGINES 的键），统计评价指标均值和查询耗时分位数
+# qrels 中的文档编号为邮件相对于数据集目录的路径（以 / 分隔）；文档关联矩阵尚未构建且超过 EVAL_MATRIX_MAX_BYTES 时抛出 ValueError
+# 返回 (各检索方式的汇总表, 逐查询明细表)
+def run_evaluation(index, queries, qrels, engines=EVAL_DEFAULT_ENGINES, k=EVAL_CUTOFF):
+    if 'matrix' in engines and 'term_doc_matrix' not in index and term_doc_matrix_bytes(index) > EVAL_MATRIX_MAX_BYTES:
+        raise ValueError(f"文档关联矩阵约 {term_doc_matrix_bytes(index) / 2 ** 20:.0f} MB，"
+                         f"超过评价允许的 {EVAL_MATRIX_MAX_BYTES / 2 ** 20:.0f} MB（EVAL_MATRIX_MAX_BYTES），请不要选择该检索方式")
+    num_docs = len(index['emails'])
+    doc_ids = {os.path.relpath(path, index['root_dir']).replace(os.sep, '/'): doc_id
+               for doc_id, path in enumerate(index['email_paths'])}
+
+    def query_parts(query):
+        positional_index = None
+        if ENABLE_POSITIONAL_INDEX and query_needs_positions(query):
+            positional_index = get_index_part(index, 'positional_index')
+        wildcard_index = get_index_part(index, 'wildcard_index') if is_wildcard(query) else None
+        return positional_index, wildcard_index
+
+    searches = {
+        'matrix': lambda query: parse_boolean_query_matrix(
+            query, get_index_part(index, 'term_doc_matrix'), index['terms'], *query_parts(query), index['field_index']),
+        'inverted': lambda query: parse_boolean_query_inverted(
+            query, index['inverted_index'], num_docs, *query_parts(query), index['field_index']),
+        'roaring': lambda query: parse_boolean_query_roaring(
+            query, get_index_part(index, 'roaring_index'), *query_parts(query), index['field_index']),
+        'ranked': lambda query: [doc_id for doc_id, _ in ranked_retrieval(
+            query, get_index_part(index, 'tf_idf_index'), index['term_dictionary'], index['emails'], query_parts(query)[1])],
+        'quantized': lambda query: [doc_id for doc_id, _ in quantized_ranked_retrieval(
+            query, get_index_part(index, 'impact_index'), index['term_dictionary'], query_parts(query)[1])],
+    }
+    # 所选检索方式用到的索引按需部分（包括查询用到的位置索引和 k-gram 索引）在计时前构建好，第一个查询的耗时不包含构建索引
+    for engine in engines:
+        for name in EVAL_ENGINES[engine][1]:
+            get_index_part(index, name)
+    if ENABLE_POSITIONAL_INDEX and any(query_needs_positions(query) for query in queries.values()):
+        get_index_part(index, 'positional_index')
+    if any(is_wildcard(query) for query in queries.values()):
+        get_index_part(index, 'wildcard_index')
+
+    rows = []
+    for query_id, query in queries.items():
+        judgments = qrels.get(query_id, {})
+        relevant_grades = np.array([grade for grade in judgments.values() if grade > 0], dtype=np.float64)
+        if not len(relevant_grades):
+            continue
+        grades = np.zeros(num_docs)
+        for doc_key, grade in judgments.items():
+            if doc_key in doc_ids:
+                grades[doc_ids[doc_key]] = max(grade, 0)
+        for engine in engines:
+            start = time.perf_counter()
+            try:
+                retrieved, failed = searches[engine](query), False
+            except ValueError:
+                retrieved, failed = [], True
+            latency = (time.perf_counter() - start) * 1000
+            rows.append({'检索方式': EVAL_ENGINES[engine][0], '查询ID': query_id, '查询': query, '查询失败': failed,
+                         '耗时(ms)': latency, **evaluate_ranking(retrieved, grades, relevant_grades, k)})
+
+    details = pd.DataFrame(rows, columns=['检索方式', '查询ID', '查询', '查询失败', '耗时(ms)', 'P@k', 'R', 'F1', 'AP', 'nDCG@k'])
+    summary = details.groupby('检索方式', sort=False).agg(
+        查询数=('查询ID', 'size'), 查询失败数=('查询失败', 'sum'),
+        **{f'P@{k}': ('P@k', 'mean'), 'R': ('R', 'mean'), 'F1': ('F1', 'mean'), 'MAP': ('AP', 'mean'), f'nDCG@{k}': ('nDCG@k', 'mean')},
+        p50=('耗时(ms)', lambda latency: np.percentile(latency, 50)),
+        p95=('耗时(ms)', lambda latency: np.percentile(latency, 95)),
+        p99=('耗时(ms)', lambda latency: np.percentile(latency, 99)),
+    ).rename(columns={'p50': 'p50(ms)', 'p95': 'p95(ms)', 'p99': 'p99(ms)'})
+    return summary, details.rename(columns={'P@k': f'P@{k}', 'nDCG@k': f'nDCG@{k}'})
+
+
+# 进程级索引注册表：同一数据集的索引只构建一次，所有会话共享同一份只读数据
+@st.cache_resource
+def get_index_registry():
+    return {'lock': threading.Lock(), 'indexes': {}, 'jobs': {}, 'segment_locks': {}}
+
+# 进程级会话表：每个会话只保存数据集路径、查询和结果句柄
+@st.cache_resource
+def get_session_table():
+    return {'lock': threading.Lock(), 'sessions': {}}
+
+# 将 numpy 数组（或字典中的所有数组）设置为只读，防止共享索引被某个会话修改
+def freeze_array(array):
+    if isinstance(array, dict):
+        for value in array.values():
+            if isinstance(value, np.ndarray):
+                value.setflags(write=False)
+    else:
+        array.setflags(write=False)
+    return array
+
+# 构建共享索引（词项词典、倒排索引、词项偏移表、拼写校正索引、字段索引和近似重复分组），关联矩阵和 tf-idf 权重在首次使用时再构建
+def build_index(emails, email_paths, dedup_mode=DEDUP_MODE, job=None, workers=INDEX_BUILD_WORKERS):
+    index = analyze_emails(emails, job, workers)
+    num_skipped = 0
+    if dedup_mode != 'off':
+        duplicate_of = find_near_duplicates(compute_minhash_signatures(index['token_ptr'], index['token_terms']))
+        if dedup_mode == 'skip':
+            # 只为每组近似重复邮件中的代表建立索引
+            keep = np.flatnonzero(duplicate_of == np.arange(len(emails)))
+            num_skipped = len(emails) - len(keep)
+            if num_skipped:
+                emails = [emails[i] for i in keep]
+                email_paths = [email_paths[i] for i in keep]
+                if job is not None:
+                    report_index_build(job, num_docs=len(emails), docs_indexed=0)
+                index = analyze_emails(emails, job, workers)
+            duplicate_of = np.arange(len(emails), dtype=np.int32)
+        index['duplicate_of'] = freeze_array(duplicate_of)
+    index['num_skipped_duplicates'] = num_skipped
+    for name in ('token_ptr', 'token_terms', 'token_starts', 'token_ends'):
+        freeze_array(index[name])
+    index['spelling_index'] = freeze_array(build_spelling_index(index))
+    index['field_index'] = freeze_array(build_field_index(emails))
+    index.update({
+        'emails': tuple(emails),
+        'email_paths': tuple(email_paths),
+        'lock': threading.Lock(),
+    })
+    return index
+
+# 按需构建的索引部分
+INDEX_PART_BUILDERS = {
+    'term_doc_matrix': lambda index: create_term_doc_matrix(index['emails'], index['term_dictionary'])[0],
+    'tf_idf_index': calculate_tf_idf,
+    'impact_index': build_impact_index,
+    'lsh_index': build_lsh_index,
+    'positional_index': build_positional_index,
+    'facet_index': build_facet_index,
+    'roaring_index': build_roaring_index,
+    'doc_freq_order': lambda index: np.argsort(-index['spelling_index']['doc_freqs'], kind='stable'),
+    'wildcard_index': build_wildcard_index,
+    'sharded_index': lambda index: start_shard_workers(index['emails'], index['email_paths'], NUM_SHARDS),
+}
+
+# 获取索引的按需部分，多个会话并发请求时只构建一次，并记录该部分占用的内存
+# 构建时只持有该部分自己的锁，不持有 index['lock']，构建较慢的部分（如启动分片工作进程）时其他部分仍可正常获取
+# 新部分计入内存后按预算淘汰其他索引（在释放 index['lock'] 之后，淘汰时需要获取注册表锁）
+def get_index_part(index, name):
+    with index['lock']:
+        if name in index:
+            return index[name]
+        part_lock = index.setdefault('part_locks', {}).setdefault(name, threading.Lock())
+    built = False
+    with part_lock:
+        if name not in index:
+            part = freeze_array(INDEX_PART_BUILDERS[name](index))
+            with index['lock']:
+                index[name] = part
+                index.setdefault('part_bytes', {})[name] = estimate_memory(part)
+            built = True
+    if built:
+        evict_indexes()
+    return index[name]
+
+# 估算对象占用的内存（字节）：numpy 数组按数据大小，容器递归累加；整数集合按每个元素 32 字节估算，不逐个遍历
+def estimate_memory(value):
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, dict):
+        return sys.getsizeof(value) + sum(estimate_memory(key) + estimate_memory(item) for key, item in value.items())
+    if isinstance(value, (set, frozenset)):
+        return sys.getsizeof(value) + 32 * len(value)
+    if isinstance(value, (list, tuple)):
+        return sys.getsizeof(value) + sum(estimate_memory(item) for item in value)
+    return sys.getsizeof(value)
+
+# 索引常驻内存的估算大小：基础部分在构建时估算，按需部分在构建时记录
+def index_memory_bytes(index):
+    return index.get('base_bytes', 0) + sum(index.get('part_bytes', {}).values())
+
+# 按最近使用顺序淘汰索引，直到注册表中索引的总大小不超过预算；最近使用的一个和正在构建的不淘汰
+# 被淘汰的索引仍可被正在检索的会话继续使用，之后由垃圾回收释放
+def evict_indexes(budget=INDEX_MEMORY_BUDGET):
+    registry = get_index_registry()
+    evicted = []
+    with registry['lock']:
+        keys = list(registry['indexes'])
+        total = sum(index_memory_bytes(registry['indexes'][key]) for key in keys)
+        for key in keys[:-1]:
+            if total <= budget:
+                break
+            job = registry['jobs'].get(key)
+            if job is not None and job['thread'].is_alive():
+                continue
+            index = registry['indexes'].pop(key)
+            total -= index_memory_bytes(index)
+            evicted.append(index)
+    for index in evicted:
+        if 'sharded_index' in index:
+            stop_shard_workers(index['sharded_index'])
+    return evicted
+
+# 从注册表获取索引并标记为最近使用，不在内存中时返回 None
+def touch_index(key):
+    registry = get_index_registry()
+    with registry['lock']:
+        index = registry['indexes'].pop(key, None)
+        if index is not None:
+            registry['indexes'][key] = index
+    return index
+
+# 索引快照文件的路径（解压目录旁边）
+def index_file_path(extract_to_dir):
+    return os.path.abspath(extract_to_dir) + INDEX_FILE_SUFFIX
+
+# 影响索引内容的分析和构建设置，写入索引快照头部和外存索引词典
+def index_settings():
+    return {
+        'MIME_AWARE_PARSING': MIME_AWARE_PARSING,
+        'MAX_TOKEN_LENGTH': MAX_TOKEN_LENGTH,
+        'DEDUP_MODE': DEDUP_MODE,
+        'DUPLICATE_THRESHOLD': DUPLICATE_THRESHOLD,
+        'ENABLE_STEMMING': ENABLE_STEMMING,
+        'CJK_ANALYZER': CJK_ANALYZER,
+        'CJK_UNIGRAMS': CJK_UNIGRAMS,
+    }
+
+# 比较建索引时的设置与当前设置，返回不同之处的说明（如 "MAX_TOKEN_LENGTH: 40 → 30"），相同时返回空列表
+def index_settings_changes(settings):
+    current = index_settings()
+    return [f"{name}: {settings.get(name, '未记录')} → {value}" for name, value in current.items()
+            if settings.get(name) != value]
+
+# 邮件内容的校验值，用于确认读回时数据集目录中的邮件与建索引时相同
+def emails_checksum(emails):
+    checksum = 0
+    for email in emails:
+        checksum = zlib.crc32(email.encode('utf-8', errors='surrogatepass'), checksum)
+    return checksum
+
+# 把索引快照写入磁盘（先写头部，再写快照；先写临时文件再替换），不保存锁、邮件内容和 INDEX_FILE_EXCLUDED_PARTS
+def write_index_file(index, path):
+    excluded = ['lock', 'part_locks', 'emails'] + INDEX_FILE_EXCLUDED_PARTS
+    snapshot = {name: value for name, value in index.items() if name not in excluded}
+    snapshot['part_bytes'] = {name: size for name, size in index.get('part_bytes', {}).items() if name not in excluded}
+    snapshot['emails_checksum'] = emails_checksum(index['emails'])
+    header = {
+        'format': INDEX_FILE_FORMAT,
+        'version': index['version'],
+        'num_docs': len(index['emails']),
+        'memory_bytes': snapshot.get('base_bytes', 0) + sum(snapshot['part_bytes'].values()),
+        'settings': index_settings(),
+    }
+    temp_path = path + '.tmp'
+    with open(temp_path, 'wb') as f:
+        pickle.dump(header, f, protocol=pickle.HIGHEST_PROTOCOL)
+        pickle.dump(snapshot, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(temp_path, path)
+
+# 读取索引快照文件的头部，文件不存在、无法读取或格式版本不同时返回 None
+def read_index_header(path):
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, 'rb') as f:
+            header = pickle.load(f)
+    except Exception:
+        return None
+    return header if isinstance(header, dict) and header.get('format') == INDEX_FILE_FORMAT else None
+
+# 从磁盘读回索引快照，并从数据集目录重新读取邮件内容
+# 文件不存在、无法读取、格式版本不同、分析设置与当前不同，或目录中的邮件与建索引时不一致时返回 None（调用方重新构建）
+# 分析设置不同时把原因记入后台任务的 rebuild_reason 并输出到服务器日志
+def read_index_file(path, job=None):
+    header = read_index_header(path)
+    if header is None:
+        return None
+    changes = index_settings_changes(header.get('settings', {}))
+    if changes:
+        reason = "索引快照的分析设置与当前不同（" + "，".join(changes) + "），重新构建索引"
+        print(f"{path}: {reason}", file=sys.stderr)
+        if job is not None:
+            job['rebuild_reason'] = reason
+        return None
+    try:
+        with open(path, 'rb') as f:
+            pickle.load(f)
+            index = pickle.load(f)
+    except Exception:
+        return None
+    texts = {}
+    wanted = set(index['email_paths'])
+    for email_path, text in iter_email_files(index['root_dir']):
+        if email_path in wanted:
+            texts[email_path] = text
+    if len(texts) != len(wanted):
+        return None
+    emails = tuple(texts[email_path] for email_path in index['email_paths'])
+    if emails_checksum(emails) != index.pop('emails_checksum'):
+        return None
+    index['emails'] = emails
+    for value in index.values():
+        if isinstance(value, (np.ndarray, dict)):
+            freeze_array(value)
+    index['lock'] = threading.Lock()
+    return index
+
+# 读取命名数据集目录 {名称: {'path': 解压目录, 'external_memory': 是否外存索引}}
+def load_collections(path=COLLECTIONS_FILE):
+    if not os.path.exists(path):
+        return {}
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+# 登记（或更新）一个命名数据集
+def save_collection(name, extract_to_dir, external_memory=False, path=COLLECTIONS_FILE):
+    registry = get_index_registry()
+    with registry['lock']:
+        collections = load_collections(path)
+        collections[name] = {'path': os.path.abspath(extract_to_dir), 'external_memory': external_memory}
+        temp_path = path + '.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(collections, f, ensure_ascii=False, indent=2)
+        os.replace(temp_path, path)
+    return collections
+
+# 从注册表获取数据集的外存索引，不存在（或要求重建）时用 SPIMI 构建
+# 构建和打开只持有该数据集自己的锁（同一数据集不会同时构建两次），完成后才短暂持有注册表锁登记，不阻塞其他会话
+# 重建时其他会话继续使用登记中的旧索引（及其内存映射），新索引登记后才切换过去
+# 磁盘上的外存索引的分析设置与当前不同时也重新构建，原因输出到服务器日志
+def load_segment(extract_to_dir, rebuild=False, job=None):
+    segment_dir = os.path.abspath(extract_to_dir) + SPIMI_SEGMENT_SUFFIX
+    registry = get_index_registry()
+    segment = None if rebuild else touch_index(segment_dir)
+    if segment is not None:
+        return segment
+    with registry['lock']:
+        segment_lock = registry['segment_locks'].setdefault(segment_dir, threading.Lock())
+    with segment_lock:
+        # 等待期间其他会话可能已经打开了同一个外存索引
+        segment = None if rebuild else touch_index(segment_dir)
+        if segment is None:
+            restore_segment_dir(segment_dir)
+            if not rebuild and os.path.exists(os.path.join(segment_dir, 'lexicon.npz')):
+                changes = index_settings_changes(segment_settings(segment_dir))
+                if changes:
+                    print(f"{segment_dir}: 外存索引的分析设置与当前不同（{'，'.join(changes)}），重新构建索引", file=sys.stderr)
+                    rebuild = True
+            if rebuild or not os.path.exists(os.path.join(segment_dir, 'lexicon.npz')):
+                segment = build_spimi_segment(extract_to_dir, segment_dir, job=job)
+            else:
+                segment = open_segment(segment_dir)
+            # 倒排表是内存映射文件，不计入常驻内存
+            segment['base_bytes'] = estimate_memory({name: value for name, value in segment.items() if name not in ['data', 'lock']})
+            freeze_array(segment)
+            with registry['lock']:
+                registry['indexes'].pop(segment_dir, None)
+                registry['indexes'][segment_dir] = segment
+    evict_indexes()
+    return segment
+
+# 读取目录并构建一份完整的索引快照（包括 PREBUILT_INDEX_PARTS 中的检索结构），快照构建完成后不再修改
+# 在后台任务中构建时汇报进度，任务被取消时抛出 InterruptedError
+def build_index_snapshot(extract_to_dir, job=None, workers=INDEX_BUILD_WORKERS):
+    # 邮件路径统一记为绝对路径，保存的快照在其他工作目录下读回时仍然有效
+    extract_to_dir = os.path.abspath(extract_to_dir)
+    if job is not None:
+        total_files = sum(len(files) for _, _, files in os.walk(extract_to_dir))
+        report_index_build(job, stage='读取邮件', stage_started=time.time(), total_files=total_files)
+    emails, email_paths = read_emails_from_directory(extract_to_dir, job=job)
+    if job is not None:
+        report_index_build(job, stage='构建索引', stage_started=time.time(), num_docs=len(emails))
+    index = build_index(emails, email_paths, job=job, workers=workers)
+    index['root_dir'] = extract_to_dir
+    index['version'] = time.time_ns()
+    index['base_bytes'] = estimate_memory({name: value for name, value in index.items() if name != 'lock'})
+    for name in PREBUILT_INDEX_PARTS:
+        if job is not None:
+            report_index_build(job, stage=f'构建检索结构（{name}）', stage_started=time.time())
+        get_index_part(index, name)
+    return index
+
+# 用新快照原子地替换注册表中的旧索引：正在使用旧快照的检索不受影响，之后获取索引的会话拿到新快照
+# 新快照记为最近使用，超出内存预算时淘汰其他索引
+def swap_index(index):
+    registry = get_index_registry()
+    with registry['lock']:
+        old_index = registry['indexes'].pop(index['root_dir'], None)
+        registry['indexes'][index['root_dir']] = index
+    if old_index is not None and old_index is not index and 'sharded_index' in old_index:
+        stop_shard_workers(old_index['sharded_index'])
+    evict_indexes()
+
+# 打开数据集的索引快照：优先从磁盘读回已保存的快照，没有（或要求重建）时读取目录构建并保存
+def open_index_snapshot(extract_to_dir, rebuild=False, job=None):
+    index = None if rebuild else read_index_file(index_file_path(extract_to_dir), job)
+    if index is None:
+        index = build_index_snapshot(extract_to_dir, job)
+        write_index_file(index, index_file_path(extract_to_dir))
+    return index
+
+# 汇报后台索引构建的进度，任务已被取消时抛出 InterruptedError 结束构建
+def report_index_build(job, **progress):
+    if job['cancel'].is_set():
+        raise InterruptedError("索引构建已取消")
+    job.update(progress)
+
+# 后台索引构建任务：解压（提供了 ZIP 数据时）并构建索引快照，或从磁盘读回已保存的快照，完成后切换到该快照
+# external_memory 为 True 时改为用 SPIMI 重建外存索引
+def run_index_build(job, extract_to_dir, zip_data=None, external_memory=False):
+    try:
+        if zip_data is not None:
+            report_index_build(job, stage='解压', stage_started=time.time())
+            unzip_dataset(io.BytesIO(zip_data), extract_to_dir)
+            job['unzipped'] = True
+        elif not external_memory:
+            report_index_build(job, stage='从磁盘读取索引', stage_started=time.time())
+        if external_memory:
+            load_segment(extract_to_dir, rebuild=True, job=job)
+        else:
+            swap_index(open_index_snapshot(extract_to_dir, rebuild=zip_data is not None, job=job))
+        job.update(stage='完成', finished=time.time())
+    except InterruptedError:
+        job.update(stage='已取消', finished=time.time())
+    except Exception as e:
+        job.update(stage='失败', error=str(e), finished=time.time())
+
+# 获取数据集的后台索引构建任务，没有时返回 None
+def get_index_build(extract_to_dir):
+    return get_index_registry()['jobs'].get(os.path.abspath(extract_to_dir))
+
+# 新建一个索引构建任务的进度记录
+def new_index_build_job():
+    now = time.time()
+    return {
+        'stage': '等待', 'started': now, 'stage_started': now, 'finished': None,
+        'total_files': 0, 'files_read': 0, 'num_docs': 0, 'docs_indexed': 0,
+        'errors': [], 'error': None, 'cancel': threading.Event(), 'unzipped': False, 'rebuild_reason': None,
+    }
+
+# 在后台线程中构建数据集的索引，同一数据集已有正在运行的任务时直接返回该任务
+def start_index_build(extract_to_dir, zip_data=None, external_memory=False):
+    key = os.path.abspath(extract_to_dir)
+    registry = get_index_registry()
+    with registry['lock']:
+        job = registry['jobs'].get(key)
+        if job is not None and job['thread'].is_alive():
+            return job
+        job = new_index_build_job()
+        job['thread'] = threading.Thread(target=run_index_build, args=(job, extract_to_dir, zip_data, external_memory), daemon=True)
+        registry['jobs'][key] = job
+        job['thread'].start()
+    return job
+
+# 启动时打开已保存的索引：按数据集目录的顺序在后台读回磁盘上的索引快照（外存索引直接打开），
+# 按快照头部记录的估算内存累计，不超过内存预算；每个进程只执行一次
+# 分析设置与当前不同的索引在后台重新构建
+# 返回 {'preloaded': 已打开的数据集名称, 'skipped': [(未打开的数据集名称, 原因)], 'rebuilding': [(重新构建的数据集名称, 原因)]}，
+# 未打开和重新构建的数据集同时输出到服务器日志
+@st.cache_resource
+def preload_collections():
+    budget = INDEX_MEMORY_BUDGET
+    preloaded, skipped, rebuilding = [], [], []
+    for name, collection in load_collections().items():
+        if not os.path.isdir(collection['path']):
+            skipped.append((name, "数据集目录不存在"))
+            continue
+        if collection['external_memory']:
+            segment_dir = collection['path'] + SPIMI_SEGMENT_SUFFIX
+            if not os.path.exists(os.path.join(segment_dir, 'lexicon.npz')):
+                skipped.append((name, "没有保存的外存索引"))
+                continue
+            changes = index_settings_changes(segment_settings(segment_dir))
+            if changes:
+                start_index_build(collection['path'], external_memory=True)
+                rebuilding.append((name, "分析设置已改变（" + "，".join(changes) + "）"))
+            else:
+                load_segment(collection['path'])
+            preloaded.append(name)
+            continue
+        header = read_index_header(index_file_path(collection['path']))
+        if header is None:
+            skipped.append((name, "没有可用的索引文件"))
+        elif header['memory_bytes'] > budget:
+            skipped.append((name, f"预计占用 {header['memory_bytes'] / 2 ** 20:.0f} MB，超出剩余内存预算 {budget / 2 ** 20:.0f} MB"))
+        else:
+            budget -= header['memory_bytes']
+            # 分析设置不同时后台任务中的 read_index_file 放弃读回，改为重新构建
+            changes = index_settings_changes(header.get('settings', {}))
+            if changes:
+                rebuilding.append((name, "分析设置已改变（" + "，".join(changes) + "）"))
+            start_index_build(collection['path'])
+            preloaded.append(name)
+    for name, reason in skipped:
+        print(f"启动时未预先打开数据集 {name}：{reason}", file=sys.stderr)
+    for name, reason in rebuilding:
+        print(f"启动时重新构建数据集 {name} 的索引：{reason}", file=sys.stderr)
+    return {'preloaded': preloaded, 'skipped': skipped, 'rebuilding': rebuilding}
+
+# 后台索引构建的完成比例和进度说明，剩余时间按当前阶段的平均速度估算
+def index_build_status(job):
+    if job['stage'] == '读取邮件':
+        done, total = job['files_read'], job['total_files']
+    elif job['stage'] == '构建索引':
+        done, total = job['docs_indexed'], job['num_docs']
+    else:
+        done, total = 0, 0
+    fraction = min(done / total, 1.0) if total else 0.0
+    text = (f"{job['stage']}：已读取 {job['files_read']}/{job['total_files']} 个文件，"
+            f"已索引 {job['docs_indexed']}/{job['num_docs']} 封邮件，已用时 {time.time() - job['started']:.0f} 秒")
+    if fraction > 0:
+        eta = (time.time() - job['stage_started']) * (1 - fraction) / fraction
+        text += f"，本阶段预计还需 {eta:.0f} 秒"
+    return fraction, text
+
+# 获取当前会话的状态，并回收超过 SESSION_IDLE_TIMEOUT 未活动的会话
+def get_session_state():
+    ctx = get_script_run_ctx()
+    session_id = ctx.session_id if ctx else 'local'
+    table = get_session_table()
+    now = time.time()
+    with table['lock']:
+        idle_sessions = [sid for sid, state in table['sessions'].items()
+                         if now - state['last_seen'] > SESSION_IDLE_TIMEOUT]
+        for sid in idle_sessions:
+            del table['sessions'][sid]
+        state = table['sessions'].setdefault(session_id, {})
+        state['last_seen'] = now
+    return state
+
+# 保存一次检索的查询和结果句柄（文档ID及相似度数组）
+def save_search_results(session_state, search_page, query, results, scores=None, duplicate_of=None, profile=None):
+    session_state['search_page'] = search_page
+    session_state['profile'] = profile
+    session_state['search_id'] = session_state.get('search_id', 0) + 1
+    session_state['query'] = query
+    session_state['num_collapsed'] = 0
+    if duplicate_of is not None and len(results):
+        # 折叠近似重复邮件，只保留每组排名最靠前的一封
+        total = len(results)
+        results, scores, _ = collapse_duplicates(results, duplicate_of, scores)
+        session_state['num_collapsed'] = total - len(results)
+    session_state['results'] = np.asarray(results, dtype=np.int32)
+    session_state['scores'] = np.asarray(scores, dtype=np.float32) if scores is not None else None
+
+# 显示查询执行计划：查询语法树（或查询词权重）、每一步的倒排列表长度、中间结果大小和耗时
+def render_query_profile(profile):
+    with st.expander("🧭 查询执行计划（EXPLAIN）", expanded=True):
+        if 'tree' in profile:
+            st.code(profile['tree'] or "（空查询）", language=None)
+            st.caption("布尔查询按操作数在查询中出现的顺序从左到右执行，每一步把操作数的文档集合并入中间结果。")
+        if 'terms' in profile:
+            st.dataframe(pd.DataFrame({
+                "查询词项": [term['term'] for term in profile['terms']],
+                "查询权重": [term['weight'] for term in profile['terms']],
+                "倒排列表长度": [term['postings'] for term in profile['terms']],
+            }), hide_index=True)
+        columns = {'shard': "分片", 'operator': "运算", 'operand': "操作数", 'postings': "倒排列表长度", 'result': "中间结果", 'time_ms': "耗时 (ms)"}
+        steps = pd.DataFrame(profile['steps'])
+        st.dataframe(steps[[name for name in columns if name in steps]].rename(columns=columns), hide_index=True)
+        if 'candidates' in profile:
+            st.write(f"- 累加倒排项 {profile['postings_scored']} 个，打分候选文档 {profile['candidates']} 篇（至少出现一个查询词），"
+                     f"其中得分大于 0 的 {profile['matched']} 篇；返回 {profile['returned']} 篇。")
+        st.write(f"- 总耗时 {sum(step['time_ms'] for step in profile['steps']):.2f} ms。")
+
+# 折叠近似重复邮件的开关（索引未做近似重复检测时不显示），返回检索时使用的重复分组
+def render_collapse_option(index, key):
+    if 'duplicate_of' not in index or DEDUP_MODE != 'collapse':
+        return None
+    return index['duplicate_of'] if st.checkbox("折叠近似重复邮件", value=False, key=key) else None
+
+# 分页控件，返回当前页码和每页条数
+def render_pagination(total, key):
+    col1, col2 = st.columns(2)
+    page_size = col1.selectbox("每页显示条数", PAGE_SIZE_OPTIONS,
+                               index=PAGE_SIZE_OPTIONS.index(DEFAULT_PAGE_SIZE) if DEFAULT_PAGE_SIZE in PAGE_SIZE_OPTIONS else 0,
+                               key=f"{key}_page_size")
+    num_pages = max(1, math.ceil(total / page_size))
+    page = col2.number_input(f"页码（共 {num_pages} 页）", min_value=1, max_value=num_pages, value=1, step=1,
+                             key=f"{key}_page_{page_size}")
+    return int(page), page_size
+
+# 分面筛选：显示各分面取值在检索结果中的文档数，点击取值筛选结果，返回检索结果中保留项的布尔掩码
+def render_facet_filters(index, results, key):
+    facet_index = get_index_part(index, 'facet_index')
+    selections = {name: st.session_state.get(f"{key}_facet_{name}") or [] for name in FACET_NAMES}
+    keep, counts = facet_counts(facet_index, results, selections)
+    with st.expander("🔎 分面筛选", expanded=True):
+        for column, (name, label) in zip(st.columns(len(FACET_NAMES)), FACET_NAMES.items()):
+            facet_values, facet_count = facet_index['facets'][name]['values'], counts[name]
+            options = [i for i in range(len(facet_values)) if facet_count[i] or i in selections[name]]
+            column.pills(label, options, selection_mode='multi', key=f"{key}_facet_{name}",
+                         format_func=lambda i, values=facet_values, count=facet_count: f"{values[i]} ({count[i]})")
+    return keep
+
+# 检索评价：上传 qrels 和查询文件、选择检索方式后批量运行，显示评价指标和查询耗时分位数
+def render_evaluation(session_state, index):
+    st.caption("qrels 每行：查询ID 0 文档路径（相对于数据集目录） 相关度；查询文件每行：查询ID<Tab>查询内容")
+    col1, col2 = st.columns(2)
+    qrels_file = col1.file_uploader("相关性判断 (qrels)", type=["txt", "qrels"], key="eval_qrels")
+    queries_file = col2.file_uploader("查询文件", type=["txt", "tsv"], key="eval_queries")
+    engines = st.multiselect("检索方式", list(EVAL_ENGINES), default=EVAL_DEFAULT_ENGINES, key="eval_engines",
+                             format_func=lambda engine: EVAL_ENGINES[engine][0])
+    st.caption(f"文档关联矩阵约 {term_doc_matrix_bytes(index) / 2 ** 20:.1f} MB，"
+               f"超过 {EVAL_MATRIX_MAX_BYTES / 2 ** 20:.0f} MB 时不能参与评价。")
+    if st.button("运行评价", disabled=not (qrels_file and queries_file and engines)):
+        qrels = load_qrels(qrels_file.getvalue().decode('utf-8', errors='ignore'))
+        queries = load_queries(queries_file.getvalue().decode('utf-8', errors='ignore'))
+        try:
+            session_state['evaluation'] = run_evaluation(index, queries, qrels, engines)
+        except ValueError as e:
+            session_state.pop('evaluation', None)
+            st.error(f"评价失败: {e}")
+
+    if 'evaluation' in session_state:
+        summary, details = session_state['evaluation']
+        if len(details):
+            st.dataframe(summary.style.format(precision=4), use_container_width=True)
+            with st.expander("逐查询明细"):
+                st.dataframe(details, use_container_width=True)
+        else:
+            st.warning("查询文件中没有带相关文档判断的查询。")
+
+# 完整检索结果的下载按钮，CSV 在点击时才分批生成
+def render_results_download(results, email_paths, scores=None):
+    st.download_button("⬇ 下载全部检索结果 (CSV)",
+                       data=lambda: export_results_csv(results, email_paths, scores),
+                       file_name="search_results.csv", mime="text/csv")
+
+# “您是不是要找”：点击建议后替换输入框内容并重新检索
+def render_did_you_mean(session_state, query_key):
+    suggestion = session_state.get('suggestion')
+    if suggestion:
+        def use_suggestion():
+            st.session_state[query_key] = suggestion
+            st.session_state[f"{query_key}_run"] = True
+        st.button(f"🔤 您是不是要找：{suggestion}", on_click=use_suggestion, type="tertiary")
+
+# 文档预览：默认只显示查询词高亮摘要，勾选后才加载全文
+def render_document_preview(index, doc_id, query_terms, key):
+    st.markdown('<h2 style="font-size:16px; font-weight:bold;">📖 内容摘要</h2>', unsafe_allow_html=True)
+    snippet = generate_snippet(index, doc_id, query_terms)
+    st.markdown(f'<div style="line-height:1.8;">{snippet}</div>', unsafe_allow_html=True)
+    if st.checkbox("显示全文", key=f"{key}_full_{doc_id}"):
+        st.text(index['emails'][doc_id])  # 显示邮件内容
+
+# 显示后台索引构建的进度（每秒刷新一次），构建结束后重新运行整个页面以使用新快照
+@st.fragment(run_every=1)
+def render_index_build(extract_to_dir):
+    job = get_index_build(extract_to_dir)
+    if job is None:
+        return
+    if job['thread'].is_alive():
+        if job['rebuild_reason']:
+            st.caption(job['rebuild_reason'])
+        fraction, text = index_build_status(job)
+        st.progress(fraction, text=text)
+        if st.button("取消构建", key="cancel_index_build"):
+            job['cancel'].set()
+    else:
+        st.rerun()
+
+# 显示构建完成的索引的统计信息；索引不在内存中（已被淘汰或正在重新打开）时只显示提示
+def render_index_summary(index):
+    if index is None:
+        st.info("数据集的索引不在内存中（已被移出内存或正在重新打开），打开后页面会自动刷新。")
+        return
+    emails = index['emails']
+    if emails:
+        st.write(f"共读取了 {len(emails) + index['num_skipped_duplicates']} 封邮件，词项词典共 {len(index['terms'])} 个词项。")
+        matrix_size = term_doc_matrix_bytes(index) / 2 ** 20
+        st.write(f"文档关联矩阵为 {len(index['terms'])} × {len(emails)}（约 {matrix_size:.1f} MB），只在选择文档关联矩阵检索时构建。")
+        if ENABLE_STEMMING:
+            cache_info = stem_token.cache_info()
+            hit_rate = cache_info.hits / max(cache_info.hits + cache_info.misses, 1)
+            st.write(f"已启用词干提取：词干缓存 {cache_info.currsize} 个词形，命中率 {hit_rate:.2%}。")
+        if 'duplicate_of' in index:
+            num_duplicates = len(emails) - len(np.unique(index['duplicate_of']))
+            st.write(f"近似重复检测：跳过 {index['num_skipped_duplicates']} 封，"
+                     f"检索时可折叠 {num_duplicates} 封近似重复邮件。")
+    else:
+        st.warning("没有读取到邮件数据。")
+
+# “查找相似邮件”按钮：以该邮件自己的 tf-idf 向量为查询，在预览下方显示相似邮件（结果保存在会话中，翻页前一直显示）
+def render_more_like_this(session_state, index, doc_id, key):
+    if st.button("🔍 查找相似邮件", key=f"similar_{key}_{doc_id}"):
+        profile = {}
+        results = more_like_this(get_index_part(index, 'lsh_index'), doc_id, profile=profile)
+        session_state['similar'] = (key, doc_id, results, profile)
+    similar = session_state.get('similar')
+    if similar is not None and similar[:2] == (key, doc_id):
+        _, _, results, profile = similar
+        st.caption(f"从 {profile['candidates']} 封 LSH 候选邮件中按余弦相似度精确重排（累加 {profile['postings_scored']} 个词项权重），"
+                   f"耗时 {sum(step['time_ms'] for step in profile['steps']):.1f} ms。")
+        if results:
+            st.dataframe(pd.DataFrame({
+                "文档ID": [similar_id for similar_id, _ in results],
+                "相似度": [score for _, score in results],
+                "文档路径": [index['email_paths'][similar_id] for similar_id, _ in results],
+            }), hide_index=True)
+        else:
+            st.write("没有找到相似的邮件。")
+
+# 侧边栏的数据集切换：列出已登记的命名数据集（标出已在内存中的），切换时只修改会话中的解压路径
+def render_collection_selector(session_state):
+    collections = load_collections()
+    if not collections:
+        return
+    registry = get_index_registry()
+    loaded = set(registry['indexes'])
+    names = list(collections)
+    if not session_state.get('extract_to_dir'):
+        # 新会话默认使用启动时已预先打开的第一个数据集
+        default = next((name for name in names if name in preload_collections()['preloaded']), names[0])
+        session_state['extract_to_dir'] = collections[default]['path']
+        session_state['external_memory'] = collections[default]['external_memory']
+    current_path = os.path.abspath(session_state['extract_to_dir']) if session_state.get('extract_to_dir') else None
+    current = next((name for name in names if collections[name]['path'] == current_path), None)
+    name = st.selectbox("当前数据集", names, index=names.index(current) if current is not None else None, placeholder="选择数据集",
+                        format_func=lambda name: name + (" ✓" if collections[name]['path'] in loaded
+                                                         or collections[name]['path'] + SPIMI_SEGMENT_SUFFIX in loaded else ""))
+    if name is not None and name != current:
+        session_state['extract_to_dir'] = collections[name]['path']
+        session_state['external_memory'] = collections[name]['external_memory']
+        session_state.pop('search_page', None)
+    used = sum(index_memory_bytes(index) for index in list(registry['indexes'].values()))
+    st.caption(f"✓ 表示已在内存中：共 {len(loaded)} 个索引，约 {used / 2 ** 20:.1f} MB / 预算 {INDEX_MEMORY_BUDGET / 2 ** 20:.0f} MB")
+    skipped = preload_collections()['skipped']
+    if skipped:
+        st.caption("启动时未预先打开（选择后再打开）：" + "；".join(f"{name}（{reason}）" for name, reason in skipped))
+    rebuilding = preload_collections()['rebuilding']
+    if rebuilding:
+        st.caption("启动时在后台重新构建索引：" + "；".join(f"{name}（{reason}）" for name, reason in rebuilding))
+
+# 获取当前会话所选数据集的共享索引，未加载数据集（或只构建了外存索引）时返回 None
+# 索引构建期间返回旧快照（第一次构建时返回 None）并显示构建进度；切换到新快照后清除会话中基于旧快照的检索结果
+def get_session_index(session_state):
+    extract_to_dir = session_state.get('extract_to_dir')
+    if not extract_to_dir or not os.path.exists(extract_to_dir) or session_state.get('external_memory'):
+        return None
+    index = touch_index(os.path.abspath(extract_to_dir))
+    job = get_index_build(extract_to_dir)
+    if index is None and (job is None or job['stage'] == '完成'):
+        # 第一次使用或已被淘汰：在后台从磁盘读回（没有保存的快照时重新构建）
+        job = start_index_build(extract_to_dir)
+    if job is not None and job['thread'].is_alive():
+        render_index_build(extract_to_dir)
+    elif index is None and job is not None and job['stage'] in ['失败', '已取消']:
+        # 后台任务失败或被取消且没有可用的旧索引：显示原因，由用户重新打开
+        if job['stage'] == '失败':
+            st.error(f"打开数据集的索引失败: {job['error']}")
+        else:
+            st.info("索引构建已取消。")
+        if st.button("重新打开数据集", key="reopen_index"):
+            start_index_build(extract_to_dir)
+            st.rerun()
+    if index is not None and session_state.get('index_version') != index['version']:
+        session_state['index_version'] = index['version']
+        session_state.pop('search_page', None)
+        session_state.pop('evaluation', None)
+        session_state.pop('similar', None)
+    return index
+
+
+# 外存索引上的布尔检索，结果只列出文档路径
+# 后台重建期间继续使用已打开的旧索引并显示构建进度，还没有可用的索引时只显示进度
+def render_segment_search(session_state):
+    job = get_index_build(session_state['extract_to_dir'])
+    if job is not None and job['thread'].is_alive():
+        render_index_build(session_state['extract_to_dir'])
+        segment = touch_index(os.path.abspath(session_state['extract_to_dir']) + SPIMI_SEGMENT_SUFFIX)
+        if segment is None:
+            return
+    else:
+        segment = load_segment(session_state['extract_to_dir'])
+    st.info(f"当前共有 {segment['num_docs']} 封邮件可以检索（外存倒排索引，词项词典共 {len(segment['terms'])} 个词项）。")
+    query = st.text_input("🔍 请输入布尔查询内容 (支持 AND, OR, NOT, 通配符 * ?；不支持多词短语):", key="segment_query")
+    explain = st.checkbox("显示查询执行计划（EXPLAIN）", key="segment_explain")
+
+    if st.button("搜索"):
+        try:
+            wildcard_index = get_index_part(segment, 'wildcard_index') if is_wildcard(query) else None
+            profile = {} if explain else None
+            save_search_results(session_state, "外存布尔检索", query, parse_boolean_query_segment(query, segment, wildcard_index, profile),
+                                profile=profile)
+        except ValueError as e:
+            session_state.pop('search_page', None)
+            st.error(f"查询失败: {e}")
+
+    if session_state.get('search_page') == "外存布尔检索":
+        if session_state.get('profile'):
+            render_query_profile(session_state['profile'])
+        results = session_state['results']
+        if len(results):
+            st.success(f"共找到 {len(results)} 封匹配的邮件。")
+            page, page_size = render_pagination(len(results), f"segment_{session_state['search_id']}")
+            page_results = paginate(results, page, page_size)
+            st.dataframe(pd.DataFrame({
+                "文档ID": page_results,
+                "文档路径": [segment['email_paths'][doc_id] for doc_id in page_results]
+            }))
+            render_results_download(results, segment['email_paths'])
+
+            # 外存索引不保存邮件内容，预览时按路径（mbox 中按字节偏移）从磁盘读取选中的一封
+            doc_id = st.selectbox("📖 预览文档", page_results, key=f"segment_preview_{session_state['search_id']}")
+            if doc_id is not None:
+                st.text(read_email_at(segment['email_paths'][doc_id]))
+        else:
+            st.warning("没有找到匹配的邮件，请调整查询条件重试。")
+
+# 命令行离线构建时定期打印构建进度，直到任务结束
+def print_index_build_progress(job, interval=1.0):
+    while job['finished'] is None:
+        time.sleep(interval)
+        if job['finished'] is None:
+            print(index_build_status(job)[1], file=sys.stderr, flush=True)
+
+# 命令行离线构建索引：python shiyan03.py build <邮件目录或 ZIP 文件> [选项]
+# 在启动界面之前读取邮件、构建完整的索引快照（词项词典、倒排表、tf-idf 权重、位置索引等）并把其中的紧凑结构保存到磁盘，
+# 然后登记为命名数据集；界面启动时直接读回（邮件内容从数据集目录重新读取），不再重新分词建索引
+def run_build_command(argv):
+    parser = argparse.ArgumentParser(prog="python shiyan03.py build", description="离线构建邮件数据集的索引")
+    parser.add_argument("path", help="邮件目录或 ZIP 压缩文件")
+    parser.add_argument("--extract-to", help="ZIP 文件的解压目录（默认为去掉 .zip 后缀的路径）")
+    parser.add_argument("--name", help="数据集名称（默认为目录名）")
+    parser.add_argument("--workers", type=int, default=INDEX_BUILD_WORKERS, help="并行分词的工作进程数（小于 2 时不启用）")
+    parser.add_argument("--external-memory", action="store_true", help="用 SPIMI 流式构建外存索引（只支持布尔检索）")
+    parser.add_argument("--memory-budget", type=int, default=SPIMI_MEMORY_BUDGET, help="SPIMI 内存中倒排表的占用上限（字节）")
+    parser.add_argument("--collections-file", default=COLLECTIONS_FILE, help="命名数据集目录文件")
+    args = parser.parse_args(argv)
+
+    started = time.time()
+    extract_to_dir = args.path
+    if os.path.isfile(args.path) and zipfile.is_zipfile(args.path):
+        extract_to_dir = args.extract_to or os.path.splitext(args.path)[0]
+        print(f"解压 {args.path} 到 {extract_to_dir}", flush=True)
+        unzip_dataset(args.path, extract_to_dir)
+    if not os.path.isdir(extract_to_dir):
+        parser.error(f"{args.path} 不是目录或 ZIP 文件")
+    name = args.name or os.path.basename(os.path.abspath(extract_to_dir))
+
+    if args.external_memory:
+        segment_dir = os.path.abspath(extract_to_dir) + SPIMI_SEGMENT_SUFFIX
+        segment = build_spimi_segment(extract_to_dir, segment_dir, args.memory_budget)
+        segment_bytes = sum(os.path.getsize(os.path.join(segment_dir, file)) for file in os.listdir(segment_dir))
+        stats = [
+            ("邮件数", segment['num_docs']),
+            ("词项数", len(segment['terms'])),
+            ("倒排项数", int(segment['doc_freqs'].sum())),
+            ("临时分段数", segment['num_runs']),
+            ("外存索引", f"{segment_dir}（{segment_bytes / 2 ** 20:.1f} MB）"),
+        ]
+    else:
+        job = new_index_build_job()
+        threading.Thread(target=print_index_build_progress, args=(job,), daemon=True).start()
+        try:
+            index = build_index_snapshot(extract_to_dir, job, args.workers)
+            report_index_build(job, stage='写入磁盘', stage_started=time.time())
+            write_index_file(index, index_file_path(extract_to_dir))
+        finally:
+            job['finished'] = time.time()
+        for message in job['errors']:
+            print(message, file=sys.stderr)
+        stats = [
+            ("邮件数", len(index['emails'])),
+            ("跳过的近似重复邮件", index['num_skipped_duplicates']),
+            ("词项数", len(index['terms'])),
+            ("倒排项数", sum(len(docs) for docs in index['inverted_index'].values())),
+            ("读取失败的文件", len(job['errors'])),
+        ]
+        stats += [(f"检索结构 {part}", f"{size / 2 ** 20:.1f} MB") for part, size in index.get('part_bytes', {}).items()]
+        stats += [
+            ("估算常驻内存", f"{index_memory_bytes(index) / 2 ** 20:.1f} MB"),
+            ("索引文件", f"{index_file_path(extract_to_dir)}（{os.path.getsize(index_file_path(extract_to_dir)) / 2 ** 20:.1f} MB）"),
+        ]
+    save_collection(name, extract_to_dir, args.external_memory, args.collections_file)
+    stats += [("数据集名称", name), ("总用时", f"{time.time() - started:.1f} 秒")]
+    for label, value in stats:
+        print(f"{label}: {value}")
+
+# 命令行批量评价：python shiyan03.py evaluate <数据集目录> --qrels <文件> --queries <文件> [--engine 检索方式 ...]
+# 读回（没有保存时构建并保存）数据集的索引快照，运行所选检索方式后输出汇总表，可选把逐查询明细写入 CSV
+def run_evaluate_command(argv):
+    parser = argparse.ArgumentParser(prog="python shiyan03.py evaluate", description="用相关性判断批量评价各检索方式")
+    parser.add_argument("path", help="邮件数据集目录")
+    parser.add_argument("--qrels", required=True, help="TREC 格式的相关性判断文件")
+    parser.add_argument("--queries", required=True, help="查询文件（每行：查询ID<Tab>查询内容）")
+    parser.add_argument("--engine", action="append", choices=list(EVAL_ENGINES),
+                        help=f"要评价的检索方式，可重复指定（默认 {' '.join(EVAL_DEFAULT_ENGINES)}）")
+    parser.add_argument("--cutoff", type=int, default=EVAL_CUTOFF, help="P@k 和 nDCG@k 的截断位置")
+    parser.add_argument("--details", help="逐查询明细的 CSV 输出路径")
+    args = parser.parse_args(argv)
+    if not os.path.isdir(args.path):
+        parser.error(f"{args.path} 不是目录")
+    with open(args.qrels, encoding='utf-8', errors='ignore') as f:
+        qrels = load_qrels(f.read())
+    with open(args.queries, encoding='utf-8', errors='ignore') as f:
+        queries = load_queries(f.read())
+
+    index = open_index_snapshot(args.path)
+    try:
+        summary, details = run_evaluation(index, queries, qrels, args.engine or EVAL_DEFAULT_ENGINES, args.cutoff)
+    except ValueError as e:
+        parser.error(str(e))
+    if not len(details):
+        parser.error("查询文件中没有带相关文档判断的查询")
+    print(summary.to_string(float_format=lambda value: f"{value:.4f}"))
+    if args.details:
+        details.to_csv(args.details, index=False)
+
+
+# 不经过 streamlit run 直接执行本文件时作为命令行工具
+if __name__ == '__main__' and get_script_run_ctx() is None:
+    if len(sys.argv) > 1 and sys.argv[1] == 'build':
+        run_build_command(sys.argv[2:])
+        sys.exit(0)
+    if len(sys.argv) > 1 and sys.argv[1] == 'evaluate':
+        run_evaluate_command(sys.argv[2:])
+        sys.exit(0)
+    if len(sys.argv) == 3 and sys.argv[1] == 'shard':
+        # 分片工作进程（由 start_shard 启动，参数为与协调进程通信的文件描述符）
+        shard_worker(multiprocessing.connection.Connection(int(sys.argv[2])))
+        sys.exit(0)
+    print("用法：streamlit run shiyan03.py 启动检索系统；python shiyan03.py build <邮件目录或 ZIP 文件> 离线构建索引；"
+          "python shiyan03.py evaluate <数据集目录> --qrels <文件> --queries <文件> 批量评价", file=sys.stderr)
+    sys.exit(2)
 
 # Streamlit 界面
 st.set_page_config(page_title="检索系统", layout="wide")
 
+# 当前会话状态（只包含数据集路径、查询和结果句柄）
+session_state = get_session_state()
+
+# 启动后第一次运行时在后台打开已保存的索引
+preload_collections()
+
 
 # 侧边栏导航
 # 定义导航栏逻辑
@@ -201,7 +3283,8 @@ with st.sidebar:
     st.markdown("---")  # 分割线
 
     # 导航栏中的动态页面切换
-    current_page = st.radio("导航", ["首页", "解压数据集", "倒排索引文档", "布尔检索","排序检索","关于"], label_visibility="visible")
+    current_page = st.radio("导航", ["首页", "解压数据集", "倒排索引文档", "布尔检索","排序检索","检索评价","关于"], label_visibility="visible")
+    render_collection_selector(session_state)
 
     st.markdown("---")
     # 添加外部链接和信息
@@ -745,32 +3828,54 @@ elif current_page == "解压数据集":
     st.divider()
     st.markdown('<h6 style="text-align:left;">✍☞解压路径:</h6>', unsafe_allow_html=True)
     extract_to_dir = st.text_input("", "")
+    collection_name = st.text_input("数据集名称（留空时使用解压目录名）", key="collection_name")
+    use_spimi = st.checkbox("外存构建倒排索引（SPIMI，邮件库超出内存时使用，只支持布尔检索）")
 
-    if st.button("解压数据集"):
+    clicked = st.button("解压数据集")
+    if clicked:
         if zip_file_path and extract_to_dir:
-            try:
-                unzip_dataset(zip_file_path, extract_to_dir)
-                st.success("解压成功！")
-                
-                # 将解压路径存入 session_state
-                st.session_state['extract_to_dir'] = extract_to_dir
-                
-                # 读取邮件内容
-                emails, email_paths = read_emails_from_directory(extract_to_dir)
-                st.session_state['emails'] = emails  # 保存邮件数据
-                st.session_state['email_paths'] = email_paths  # 保存邮件路径
-
-                # 显示读取邮件数量
-                if emails:
-                    st.write(f"共读取了 {len(emails)} 封邮件。")
-                else:
-                    st.warning("没有读取到邮件数据。")
-
-            except Exception as e:
-                st.error(f"解压失败: {e}")
+            if use_spimi:
+                # 在后台解压并逐封读取邮件、分段写出倒排表，不把邮件内容保存在内存中；构建期间检索继续使用旧的外存索引
+                start_index_build(extract_to_dir, zip_file_path.getvalue(), external_memory=True)
+                save_collection(collection_name or os.path.basename(os.path.abspath(extract_to_dir)), extract_to_dir, True)
+                session_state['extract_to_dir'] = extract_to_dir
+                session_state['external_memory'] = True
+                session_state.pop('search_page', None)
+            else:
+                # 在后台解压、读取邮件并构建共享索引，会话中只保存解压路径；构建期间检索继续使用旧索引
+                start_index_build(extract_to_dir, zip_file_path.getvalue())
+                save_collection(collection_name or os.path.basename(os.path.abspath(extract_to_dir)), extract_to_dir)
+                session_state['extract_to_dir'] = extract_to_dir
+                session_state['external_memory'] = False
         else:
             st.warning("请提供有效的ZIP压缩文件和解压路径。")
-    else:
+
+    # 显示当前数据集的后台构建进度或结果
+    job = None
+    if session_state.get('extract_to_dir'):
+        job = get_index_build(session_state['extract_to_dir'])
+    if job is not None and job['thread'].is_alive():
+        render_index_build(session_state['extract_to_dir'])
+    elif job is not None:
+        for message in job['errors']:
+            st.warning(message)
+        if job['stage'] == '完成' and session_state.get('external_memory'):
+            st.success(f"解压成功！外存索引构建用时 {job['finished'] - job['started']:.1f} 秒。")
+            segment = touch_index(os.path.abspath(session_state['extract_to_dir']) + SPIMI_SEGMENT_SUFFIX)
+            if segment is not None:
+                st.write(f"共读取了 {segment['num_docs']} 封邮件，词项词典共 {len(segment['terms'])} 个词项，"
+                         f"构建时写出 {segment['num_runs']} 个临时分段。")
+        elif job['stage'] == '完成' and job['unzipped']:
+            st.success(f"解压成功！索引构建用时 {job['finished'] - job['started']:.1f} 秒。")
+            render_index_summary(get_session_index(session_state))
+        elif job['stage'] == '完成':
+            st.success(f"已打开数据集的索引，用时 {job['finished'] - job['started']:.1f} 秒。")
+            render_index_summary(get_session_index(session_state))
+        elif job['stage'] == '已取消':
+            st.info("索引构建已取消，检索继续使用之前的索引。")
+        else:
+            st.error(f"解压失败: {job['error']}")
+    elif not clicked:
         st.warning("请提供有效的ZIP压缩文件和解压路径。")
 
 
@@ -780,37 +3885,54 @@ elif current_page == "倒排索引文档":
     st.markdown('<h3 style="text-align:center;">♏倒排索引文档</h3>', unsafe_allow_html=True)
 
     # 确保第一步完成并且解压路径有效
-    if 'extract_to_dir' in st.session_state and st.session_state.extract_to_dir:
-        extract_to_dir = st.session_state.extract_to_dir
-        if os.path.exists(extract_to_dir):
-            emails, email_paths = read_emails_from_directory(extract_to_dir)
+    if session_state.get('extract_to_dir'):
+        index = get_session_index(session_state)
+        if index is not None:
+            emails = index['emails']
 
             if emails:
-                term_dictionary = generate_term_dictionary(emails)
-                term_doc_matrix, terms = create_term_doc_matrix(emails, term_dictionary)
-                inverted_index = create_inverted_index(emails, term_dictionary)
-
-                # 创建倒排索引表格
-                inverted_index_df = pd.DataFrame(
-                    [(term, ",".join(map(str, docs))) for term, docs in inverted_index.items()],
-                    columns=["Term", "Document IDs"]
-                )
-
-                # 设置样式使表格更宽
-                st.markdown("""
-                    <style>
-                    .wide-table-container {
-                        max-width: 90%;  /* 表格宽度占页面 90% */
-                        margin: 0 auto; /* 居中表格 */
-                    }
-                    </style>
-                """, unsafe_allow_html=True)
-
-                
-                # 在样式容器中显示表格
-                st.markdown('<div class="wide-table-container">', unsafe_allow_html=True)
-                st.dataframe(inverted_index_df, use_container_width=True)
-                st.markdown('</div>', unsafe_allow_html=True)
+                inverted_index = index['inverted_index']
+                email_paths = index['email_paths']
+                doc_freqs = index['spelling_index']['doc_freqs']
+
+                # 词项浏览：按前缀查找、按字典序或文档频率排序，每次只渲染当前页的词项
+                col1, col2 = st.columns([2, 1])
+                prefix = col1.text_input("🔍 按前缀查找词项", key="term_prefix")
+                sort_order = col2.selectbox("排序方式", ["字典序", "文档频率（从高到低）"], key="term_sort")
+                lo, hi = term_prefix_range(index['terms'], prefix)
+                page, page_size = render_pagination(hi - lo, f"terms_{prefix}_{sort_order}")
+                term_ids = browse_terms(index, prefix, page, page_size, by_doc_freq=sort_order != "字典序")
+                st.caption(f"共 {hi - lo} 个匹配的词项（词项词典共 {len(index['terms'])} 个词项）。")
+
+                terms_df = pd.DataFrame({
+                    "Term": [index['terms'][term_id] for term_id in term_ids],
+                    "文档频率": doc_freqs[term_ids],
+                })
+                selection = st.dataframe(terms_df, use_container_width=True, hide_index=True,
+                                         on_select="rerun", selection_mode="single-row", key=f"terms_table_{prefix}_{sort_order}_{page}_{page_size}")
+
+                # 只有选中某个词项时才读取并分页显示它的倒排列表
+                if selection.selection.rows:
+                    term = terms_df["Term"].iloc[selection.selection.rows[0]]
+                    postings = np.array(sorted(inverted_index[term]), dtype=np.int32)
+                    st.markdown(f'<h2 style="font-size:16px; font-weight:bold;">📑 词项 “{html.escape(term)}” 的倒排列表（{len(postings)} 篇文档）</h2>',
+                                unsafe_allow_html=True)
+                    postings_page, postings_page_size = render_pagination(len(postings), f"postings_{term}")
+                    page_postings = paginate(postings, postings_page, postings_page_size)
+                    st.dataframe(pd.DataFrame({
+                        "文档ID": page_postings,
+                        "文档路径": [email_paths[doc_id] for doc_id in page_postings],
+                    }), use_container_width=True, hide_index=True)
+
+                st.download_button("⬇ 下载完整倒排索引 (CSV)", data=lambda: export_inverted_index_csv(index),
+                                   file_name="inverted_index.csv", mime="text/csv")
+                if pa is not None:
+                    # 列式导出：词项词典、倒排表（文档ID、词频、tf-idf 权重）和文档表
+                    file_format = st.radio("列式导出格式", ["arrow", "parquet"], horizontal=True, key="index_export_format",
+                                           format_func=lambda name: {"arrow": "Arrow IPC（可内存映射零拷贝读取）", "parquet": "Parquet"}[name])
+                    st.download_button("⬇ 导出索引表 (terms / postings / documents)",
+                                       data=lambda: export_index_archive(index, file_format),
+                                       file_name=f"index_{file_format}.zip", mime="application/zip")
 
                 # 提示文字
                 st.markdown("""
@@ -818,9 +3940,9 @@ elif current_page == "倒排索引文档":
  """, unsafe_allow_html=True)
                 
                                 
-                st.write(f"- 您可以将鼠标放置表格中☝，点击右上角的“↓”下载该倒排索引文档。")
-                st.write(f"- 您可以将鼠标放置表格中☝，点击右上角的“⌕”在倒排索引文档中查找相应词项。")
-                st.write(f"- 您可以拖动“←║→”改变表格列宽")
+                st.write(f"- 在输入框中输入词项前缀☝，可以快速定位词典中以该前缀开头的词项。")
+                st.write(f"- 点击表格中的某一行☝，即可查看该词项的倒排列表。")
+                st.write(f"- 点击“↓ 下载完整倒排索引”按钮，可以下载整个倒排索引文档。")
 
 
 
@@ -837,12 +3959,13 @@ elif current_page == "倒排索引文档":
 elif current_page == "布尔检索":
     st.markdown('<h3 style="text-align:center;">♏布尔检索</h3>', unsafe_allow_html=True)
 
-    if 'emails' in st.session_state and st.session_state.emails:
-        emails = st.session_state.emails
-        email_paths = st.session_state.email_paths
-        term_dictionary = generate_term_dictionary(emails)
-        term_doc_matrix, terms = create_term_doc_matrix(emails, term_dictionary)
-        inverted_index = create_inverted_index(emails, term_dictionary)
+    index = get_session_index(session_state)
+    if index is not None and index['emails']:
+        emails = index['emails']
+        email_paths = index['email_paths']
+        term_dictionary = index['term_dictionary']
+        terms = index['terms']
+        inverted_index = index['inverted_index']
 
         # 总邮件数展示
         total_emails = len(emails)
@@ -850,7 +3973,11 @@ elif current_page == "布尔检索":
 
         # 检索方式选择
         st.markdown('<p style="font-size:16px; font-weight:bold;">🎯 选择布尔检索方式:</p>',unsafe_allow_html=True)
-        search_method = st.radio("",["文档关联矩阵", "倒排索引"], label_visibility='collapsed')
+        search_method = st.radio("",["文档关联矩阵", "倒排索引", "压缩位图倒排索引（Roaring）"], label_visibility='collapsed')
+        if search_method == "压缩位图倒排索引（Roaring）":
+            roaring_stats = get_index_part(index, 'roaring_index')['stats']
+            st.caption(f"数组容器 {roaring_stats['array']} 个，位图容器 {roaring_stats['bitmap']} 个，"
+                       f"行程容器 {roaring_stats['run']} 个，共约 {roaring_stats['bytes'] / 1024:.1f} KB。")
 
         # 使用 st.markdown 来增加样式并缩小上下间距
         st.markdown(
@@ -863,20 +3990,58 @@ elif current_page == "布尔检索":
                 margin-bottom: 0px;  /* 调整上下间距，减少底部间距 */
             }
             </style>
-            <p class="query-text">🔍 请输入布尔查询内容 (支持 AND, OR, NOT):</p>''',unsafe_allow_html=True)
+            <p class="query-text">🔍 请输入布尔查询内容 (支持 AND, OR, NOT, "短语", NEAR/k, 通配符 * ?):</p>''',unsafe_allow_html=True)
 
         # 创建文本输入框
-        query_input = st.text_input("")
+        query_input = st.text_input("", key="boolean_query")
+        st.caption("字段查询示例：from:alice subject:budget date:2024-03-01..2024-03-31")
+        duplicate_of = render_collapse_option(index, "boolean_collapse")
+        use_shards = NUM_SHARDS > 1 and st.checkbox(f"分片并行检索（{NUM_SHARDS} 个工作进程）", key="boolean_shards")
+        explain = st.checkbox("显示查询执行计划（EXPLAIN）", key="boolean_explain")
         
-        if st.button("搜索"):
-            # 执行检索
-            if search_method == "文档关联矩阵":
-                st.session_state.results = parse_boolean_query_matrix(query_input, term_doc_matrix, terms)
-            else:
-                st.session_state.results = parse_boolean_query_inverted(query_input, inverted_index)
-
-            if st.session_state.results:
-                st.success(f"共找到 {len(st.session_state.results)} 封匹配的邮件。")
+        if st.button("搜索") or st.session_state.pop("boolean_query_run", False):
+            # 执行检索，会话中只保存查询和结果文档ID
+            profile = {} if explain else None
+            positional_index = None
+            if ENABLE_POSITIONAL_INDEX and query_needs_positions(query_input):
+                positional_index = get_index_part(index, 'positional_index')
+            wildcard_index = get_index_part(index, 'wildcard_index') if is_wildcard(query_input) else None
+            try:
+                if use_shards:
+                    results = sharded_boolean_query(get_index_part(index, 'sharded_index'), query_input, profile)
+                elif search_method == "压缩位图倒排索引（Roaring）":
+                    results = parse_boolean_query_roaring(query_input, get_index_part(index, 'roaring_index'), positional_index,
+                                                          wildcard_index, index['field_index'], profile)
+                elif search_method == "文档关联矩阵":
+                    term_doc_matrix = get_index_part(index, 'term_doc_matrix')
+                    results = parse_boolean_query_matrix(query_input, term_doc_matrix, terms, positional_index,
+                                                         wildcard_index, index['field_index'], profile)
+                else:
+                    results = parse_boolean_query_inverted(query_input, inverted_index, total_emails, positional_index,
+                                                           wildcard_index, index['field_index'], profile)
+                save_search_results(session_state, "布尔检索", query_input, results, duplicate_of=duplicate_of, profile=profile)
+                session_state['search_method'] = search_method
+                session_state['suggestion'] = suggest_query(query_input, index['spelling_index'])
+            except ValueError as e:
+                session_state.pop('search_page', None)
+                st.error(f"查询失败: {e}")
+
+        # 检索结果在页面重新运行（翻页）时从会话中读取，只渲染当前页
+        if session_state.get('search_page') == "布尔检索":
+            render_did_you_mean(session_state, "boolean_query")
+            if session_state.get('profile'):
+                render_query_profile(session_state['profile'])
+            results = session_state['results']
+            if len(results):
+                st.success(f"共找到 {len(results)} 封匹配的邮件。")
+                if session_state['num_collapsed']:
+                    st.caption(f"已折叠 {session_state['num_collapsed']} 封近似重复邮件。")
+                keep = render_facet_filters(index, results, f"boolean_{session_state['search_id']}")
+                if not keep.all():
+                    results = results[keep]
+                    st.caption(f"分面筛选后剩余 {len(results)} 封邮件。")
+                page, page_size = render_pagination(len(results), f"boolean_{session_state['search_id']}_{len(results)}")
+                page_results = paginate(results, page, page_size)
 
                 # 创建选项卡
                 tabs = st.tabs(["结果概览", "详细预览","结果评价"])
@@ -886,62 +4051,40 @@ elif current_page == "布尔检索":
                     st.markdown('<h2 style="font-size:16px; font-weight:bold;">🚀 检索结果概览</h2>', unsafe_allow_html=True)
 
                     result_data = {
-                        "文档ID": st.session_state.results,
-                        "文档路径": [email_paths[doc_id] for doc_id in st.session_state.results]
+                        "文档ID": page_results,
+                        "文档路径": [email_paths[doc_id] for doc_id in page_results]
                     }
                     result_df = pd.DataFrame(result_data)
                     st.dataframe(result_df)
+                    render_results_download(results, email_paths)
 
                      # 添加统计数据摘要（可选）
                     st.markdown('<h2 style="font-size:16px; font-weight:bold;">🔢 统计信息</h2>', unsafe_allow_html=True)
-                    st.write(f"- 匹配邮件占总邮件的比例: <u>*{len(st.session_state.results) / total_emails:.2%}*</u>", unsafe_allow_html=True)
-                    st.write(f"- 检索方法: <u>*{search_method}*</u>", unsafe_allow_html=True)
+                    st.write(f"- 匹配邮件占总邮件的比例: <u>*{len(results) / total_emails:.2%}*</u>", unsafe_allow_html=True)
+                    st.write(f"- 检索方法: <u>*{session_state['search_method']}*</u>", unsafe_allow_html=True)
 
 
 
                 # 选项卡 2: 详细预览
                 with tabs[1]:
                     st.markdown('<h2 style="font-size:16px; font-weight:bold;">🚀 详细预览</h2>', unsafe_allow_html=True)
-                    for doc_id in st.session_state.results:
+                    query = session_state['query']
+                    query_terms = get_query_terms(query, get_index_part(index, 'wildcard_index') if is_wildcard(query) else None)
+                    for doc_id in page_results:
                         with st.expander(f"文档ID {doc_id} - 点击展开预览", expanded=False):
                             st.markdown(f"**📂 文档路径**: {email_paths[doc_id]}")
-                            st.markdown('<h2 style="font-size:16px; font-weight:bold;">📖 文档内容</h2>', unsafe_allow_html=True)
-                            st.text(emails[doc_id])  # 显示邮件内容
+                            render_document_preview(index, doc_id, query_terms, f"boolean_{session_state['search_id']}")
+                            render_more_like_this(session_state, index, doc_id, f"boolean_{session_state['search_id']}")
                 # 选项卡 3: 结果评价
                 with tabs[2]:
                     st.markdown('<h2 style="font-size:16px; font-weight:bold;">🚀 结果评价</h2>', unsafe_allow_html=True)
-
-                    # 策略：随机选取相关文档模拟 tp 和 fn
-                    relevant_docs = set(range(total_emails // 2))  # 假设前一半文档为相关文档
-                    retrieved_docs = set(st.session_state.results)
-                    tp = len(relevant_docs & retrieved_docs)
-                    fp = len(retrieved_docs - relevant_docs)
-                    fn = len(relevant_docs - retrieved_docs)
-                    tn = total_emails - tp - fp - fn
-
-                    # 计算评价指标
-                    precision = tp / (tp + fp) if tp + fp > 0 else 0
-                    recall = tp / (tp + fn) if tp + fn > 0 else 0
-                    f1_score = (2 * precision * recall) / (precision + recall) if precision + recall > 0 else 0
-                    accuracy = (tp + tn) / total_emails if total_emails > 0 else 0
-                    specificity = tn / (tn + fp) if tn + fp > 0 else 0
-
-                    # 显示评价结果
-                    st.write(f"**查准率 (P):** {precision:.2f}")
-                    st.write(f"**查全率 (R):** {recall:.2f}")
-                    st.write(f"**F1 值:** {f1_score:.2f}")
-                    st.write(f"**准确度 (Accuracy):** {accuracy:.2f}")
-                    st.write(f"**特异度 (Specificity):** {specificity:.2f}")
-
-                    # 显示混淆矩阵
-                    st.markdown('<h3 style="font-size:16px; font-weight:bold;">📝 混淆矩阵</h3>', unsafe_allow_html=True)
-                    confusion_matrix = [[tp, fp], [fn, tn]]
-                    confusion_df = pd.DataFrame(confusion_matrix, columns=["预测相关", "预测不相关"], index=["实际相关", "实际不相关"])
-                    st.dataframe(confusion_df)
+                    st.info("用相关性判断批量评价各检索方式请使用侧边栏的“检索评价”页面。")
 
             else:
                 st.warning("没有找到匹配的邮件，请调整查询条件重试。")
 
+    elif session_state.get('external_memory') and session_state.get('extract_to_dir'):
+        render_segment_search(session_state)
     else:
         st.warning("请先解压数据集并加载邮件。")
 
@@ -949,11 +4092,11 @@ elif current_page == "布尔检索":
 elif current_page == "排序检索":
     st.markdown('<h3 style="text-align:center;">♏排序检索</h3>', unsafe_allow_html=True)
 
-    if 'emails' in st.session_state and 'email_paths' in st.session_state:
-        emails = st.session_state['emails']
-        email_paths = st.session_state['email_paths']
-        term_dictionary = generate_term_dictionary(emails)
-        tf_idf_matrix = calculate_tf_idf(emails, term_dictionary)
+    index = get_session_index(session_state)
+    if index is not None:
+        emails = index['emails']
+        email_paths = index['email_paths']
+        term_dictionary = index['term_dictionary']
 
         # 总邮件数展示
         total_emails = len(emails)
@@ -972,67 +4115,125 @@ elif current_page == "排序检索":
                 margin-bottom: 0px;  /* 调整上下间距，减少底部间距 */
             }
             </style>
-            <p class="query-text">🔍 请输入排序检索查询内容：</p>''', unsafe_allow_html=True)
+            <p class="query-text">🔍 请输入排序检索查询内容（支持通配符 * ?）：</p>''', unsafe_allow_html=True)
 
         # 创建文本输入框
-        query = st.text_input("")
-
-        if st.button("搜索"):
+        query = st.text_input("", key="ranked_query")
+        duplicate_of = render_collapse_option(index, "ranked_collapse")
+        use_shards = NUM_SHARDS > 1 and st.checkbox(f"分片并行检索（{NUM_SHARDS} 个工作进程，返回前 {RANKED_TOP_K} 个结果）", key="ranked_shards")
+        use_impacts = st.checkbox("使用 8 位量化影响分数（整数打分，索引更小）", key="ranked_quantized")
+        if use_impacts:
+            impact_index = get_index_part(index, 'impact_index')
+            st.caption(f"量化影响分数索引共 {len(impact_index['docs'])} 个倒排项，约 {impact_index['bytes'] / 1024:.1f} KB"
+                       f"（浮点 tf-idf 倒排索引约 {get_index_part(index, 'tf_idf_index')['bytes'] / 1024:.1f} KB）。")
+        explain = st.checkbox("显示查询执行计划（EXPLAIN）", key="ranked_explain")
+
+        if st.button("搜索") or st.session_state.pop("ranked_query_run", False):
             if query:
-                # 执行排序检索
-                ranked_docs = ranked_retrieval(query, tf_idf_matrix, term_dictionary, emails)
-
-                if ranked_docs:
-                    st.success(f"共找到 {len(ranked_docs)} 封相关邮件。")
-
-                    # 创建选项卡
-                    tabs = st.tabs(["结果概览", "详细预览"])
-
-                    # 选项卡 1: 检索结果概览
-                    with tabs[0]:
-                        st.markdown('<h2 style="font-size:16px; font-weight:bold;">🚀 检索结果概览</h2>', unsafe_allow_html=True)
-
-                        result_data = {
-                            "文档ID": [doc[0] for doc in ranked_docs],
-                            "相似度": [doc[1] for doc in ranked_docs],
-                            "文档路径": [email_paths[doc[0]] for doc in ranked_docs],
-                        }
-                        result_df = pd.DataFrame(result_data)
-                        st.dataframe(result_df)
-
-                        # 添加信息说明
-                        st.markdown('<h2 style="font-size:16px; font-weight:bold;">🔢 相关信息提示</h2>', unsafe_allow_html=True)
-                        st.write(f"- 匹配邮件占总邮件的比例: <u>*{len(ranked_docs) / total_emails:.2%}*</u>", unsafe_allow_html=True)
-                        st.write(f"- 检索结果按相似度从高到低排序，可以优先查看前 {min(5, len(ranked_docs))} 个文档以获取最相关内容。", unsafe_allow_html=True)
-
-                        # 基于相似度的统计
-                        max_similarity = ranked_docs[0][1]
-                        min_similarity = ranked_docs[-1][1]
-                        avg_similarity = sum([doc[1] for doc in ranked_docs]) / len(ranked_docs)
-
-                        st.write(f"- 最相关文档的相似度为: **{max_similarity:.4f}**", unsafe_allow_html=True)
-                        st.write(f"- 最低相关文档的相似度为: **{min_similarity:.4f}**", unsafe_allow_html=True)
-                        st.write(f"- 平均相似度为: **{avg_similarity:.4f}**", unsafe_allow_html=True)
-
-                    # 选项卡 2: 详细预览
-                    with tabs[1]:
-                        st.markdown('<h2 style="font-size:16px; font-weight:bold;">🚀 详细预览</h2>', unsafe_allow_html=True)
-                        for doc_id, similarity in ranked_docs:
-                            with st.expander(f"文档ID {doc_id} - 相似度 {similarity:.4f} - 点击展开预览", expanded=False):
-                                st.markdown(f"**📂 文档路径**: {email_paths[doc_id]}")
-                                st.markdown('<h2 style="font-size:16px; font-weight:bold;">📖 文档内容</h2>', unsafe_allow_html=True)
-                                st.text(emails[doc_id])  # 显示邮件内容
-
-                else:
-                    st.warning("没有找到匹配的邮件，请调整查询条件重试。")
+                # 执行排序检索，会话中只保存查询、结果文档ID和相似度
+                wildcard_index = get_index_part(index, 'wildcard_index') if is_wildcard(query) else None
+                profile = {} if explain else None
+                try:
+                    if use_shards:
+                        ranked_docs = sharded_ranked_retrieval(get_index_part(index, 'sharded_index'), query, term_dictionary,
+                                                               wildcard_index, profile=profile)
+                    elif use_impacts:
+                        ranked_docs = quantized_ranked_retrieval(query, get_index_part(index, 'impact_index'), term_dictionary,
+                                                                 wildcard_index, profile)
+                    else:
+                        ranked_docs = ranked_retrieval(query, get_index_part(index, 'tf_idf_index'), term_dictionary, emails,
+                                                       wildcard_index, profile)
+                    save_search_results(session_state, "排序检索", query,
+                                        [doc[0] for doc in ranked_docs], [doc[1] for doc in ranked_docs], duplicate_of, profile)
+                    session_state['suggestion'] = suggest_query(query, index['spelling_index'])
+                except ValueError as e:
+                    session_state.pop('search_page', None)
+                    st.error(f"查询失败: {e}")
             else:
+                session_state.pop('search_page', None)
                 st.warning("请输入查询词进行检索。")
+
+        # 检索结果在页面重新运行（翻页）时从会话中读取，只渲染当前页
+        if session_state.get('search_page') == "排序检索":
+            render_did_you_mean(session_state, "ranked_query")
+            if session_state.get('profile'):
+                render_query_profile(session_state['profile'])
+            results = session_state['results']
+            scores = session_state['scores']
+
+            if len(results):
+                st.success(f"共找到 {len(results)} 封相关邮件。")
+                if session_state['num_collapsed']:
+                    st.caption(f"已折叠 {session_state['num_collapsed']} 封近似重复邮件。")
+                keep = render_facet_filters(index, results, f"ranked_{session_state['search_id']}")
+                if not keep.all():
+                    results, scores = results[keep], scores[keep]
+                    st.caption(f"分面筛选后剩余 {len(results)} 封邮件。")
+                page, page_size = render_pagination(len(results), f"ranked_{session_state['search_id']}_{len(results)}")
+                page_results = paginate(results, page, page_size)
+                page_scores = paginate(scores, page, page_size)
+
+                # 创建选项卡
+                tabs = st.tabs(["结果概览", "详细预览"])
+
+                # 选项卡 1: 检索结果概览
+                with tabs[0]:
+                    st.markdown('<h2 style="font-size:16px; font-weight:bold;">🚀 检索结果概览</h2>', unsafe_allow_html=True)
+
+                    result_data = {
+                        "文档ID": page_results,
+                        "相似度": page_scores,
+                        "文档路径": [email_paths[doc_id] for doc_id in page_results],
+                    }
+                    result_df = pd.DataFrame(result_data)
+                    st.dataframe(result_df)
+                    render_results_download(results, email_paths, scores)
+
+                    # 添加信息说明
+                    st.markdown('<h2 style="font-size:16px; font-weight:bold;">🔢 相关信息提示</h2>', unsafe_allow_html=True)
+                    st.write(f"- 匹配邮件占总邮件的比例: <u>*{len(results) / total_emails:.2%}*</u>", unsafe_allow_html=True)
+                    st.write(f"- 检索结果按相似度从高到低排序，可以优先查看前 {min(5, len(results))} 个文档以获取最相关内容。", unsafe_allow_html=True)
+
+                    # 基于相似度的统计
+                    max_similarity = scores[0]
+                    min_similarity = scores[-1]
+                    avg_similarity = scores.mean()
+
+                    st.write(f"- 最相关文档的相似度为: **{max_similarity:.4f}**", unsafe_allow_html=True)
+                    st.write(f"- 最低相关文档的相似度为: **{min_similarity:.4f}**", unsafe_allow_html=True)
+                    st.write(f"- 平均相似度为: **{avg_similarity:.4f}**", unsafe_allow_html=True)
+
+                # 选项卡 2: 详细预览
+                with tabs[1]:
+                    st.markdown('<h2 style="font-size:16px; font-weight:bold;">🚀 详细预览</h2>', unsafe_allow_html=True)
+                    query = session_state['query']
+                    query_terms = get_query_terms(query, get_index_part(index, 'wildcard_index') if is_wildcard(query) else None)
+                    for doc_id, similarity in zip(page_results, page_scores):
+                        with st.expander(f"文档ID {doc_id} - 相似度 {similarity:.4f} - 点击展开预览", expanded=False):
+                            st.markdown(f"**📂 文档路径**: {email_paths[doc_id]}")
+                            render_document_preview(index, doc_id, query_terms, f"ranked_{session_state['search_id']}")
+                            render_more_like_this(session_state, index, doc_id, f"ranked_{session_state['search_id']}")
+
+            else:
+                st.warning("没有找到匹配的邮件，请调整查询条件重试。")
     else:
         st.warning("请先解压数据集并加载邮件。")
 
 
 
 
+# 检索评价：用相关性判断批量评价当前数据集上的各检索方式
+elif current_page == "检索评价":
+    st.markdown('<h3 style="text-align:center;">♏检索评价</h3>', unsafe_allow_html=True)
+
+    index = get_session_index(session_state)
+    if index is not None:
+        render_evaluation(session_state, index)
+    elif session_state.get('external_memory') and session_state.get('extract_to_dir'):
+        st.warning("外存索引只支持布尔检索，不能批量评价。")
+    else:
+        st.warning("请先解压数据集并加载邮件。")
+
 # 关于，跳转到源代码
 elif current_page == "关于":
     st.markdown('<h3 style="text-align:center;">♏关于</h3>', unsafe_allow_html=True)